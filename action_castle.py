@@ -10,12 +10,399 @@
 # 2. __The game__, which represents the world (a collection of __locations__ and __items__), and describes what the player sees.
 # 3. __The data__, which you input to create your own unique game.
 
+# In[1]:
+import array
+import collections
+import collections.abc
+import functools
+import heapq
+import marshal
+import sys
+import time
+import types
+
+
+# ## Output
+# Everything that the player sees is written to the game's output sink rather than straight to `print()`.  This lets us run games headless: a `BufferedOutput` collects the text as a string, a `NullOutput` throws it away (handy for benchmarks and solvers), and a `StreamOutput` writes it to stdout, a file or a socket.
+
+class StreamOutput:
+  """Writes the game's output to a stream.  The stream can be any object 
+     with a write method, like an open file or socket.makefile('w').  By
+     default the output goes to whatever sys.stdout currently is."""
+  # True if the output is thrown away, so there's no need to describe
+  # anything.
+  silent = False
+
+  def __init__(self, stream=None):
+    self.stream = stream
+
+  def write(self, text):
+    (self.stream or sys.stdout).write(text)
+
+  def print(self, *values, sep=" ", end="\n"):
+    """Print the values, just like the builtin print function."""
+    self.write(sep.join(map(str, values)) + end)
+
+
+class BufferedOutput(StreamOutput):
+  """Collects the game's output in memory."""
+  def __init__(self):
+    self.chunks = []
+
+  def write(self, text):
+    self.chunks.append(text)
+
+  def getvalue(self):
+    """Returns the text collected so far."""
+    return "".join(self.chunks)
+
+  def clear(self):
+    """Throws away the text collected so far."""
+    self.chunks = []
+
+
+class NullOutput(StreamOutput):
+  """Discards the game's output."""
+  silent = True
+
+  def __init__(self):
+    self.stream = None
+
+  def write(self, text):
+    pass
+
+  def print(self, *values, sep=" ", end="\n"):
+    pass
+
+
+# ## Caching descriptions
+# Describing a location means walking its exits and items and joining up every item's special commands, which is the same work every time the player looks around or comes back.  So the text is kept in a least recently used cache, along with a version stamp of what it was made from: the location's own version, which goes up whenever its exits or items in the world change, and the game's version of its items, which goes up whenever they change during play.  The cache is keyed by the location, how the text was rendered and whether the game prints special commands, and text that has gone stale is rendered again when it is next asked for.
+#
+# Locations whose items haven't changed in a game look the same in every game of the world, so their text is kept in one cache shared by all the world's games.  Each game keeps a smaller cache of its own for the locations it has changed.
+#
+# The descriptions of items and their special commands are taken to be fixed once play has started.  `Game.reindex_commands`, which is for adding actions to items during play, clears the caches.
+
+# The most rendered texts that a world's games share, and that each game
+# keeps for the locations it has changed
+WORLD_RENDER_CACHE_SIZE = 4096
+GAME_RENDER_CACHE_SIZE = 256
+
+
+class LRUCache:
+  """A dictionary that holds at most size entries, forgetting the least
+     recently used entry to make room for a new one."""
+  def __init__(self, size):
+    self.size = size
+    self.entries = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, key):
+    """Returns the value for a key, or None."""
+    value = self.entries.get(key)
+    if value is not None:
+      self.entries.move_to_end(key)
+    return value
+
+  def put(self, key, value):
+    self.entries[key] = value
+    self.entries.move_to_end(key)
+    if len(self.entries) > self.size:
+      self.entries.popitem(last=False)
+
+  def clear(self):
+    self.entries.clear()
+
+
+def render_description(game, location):
+  """Returns the text that describes a location in a game: its description,
+     exits and items."""
+  output = game.output
+  game.output = BufferedOutput()
+  try:
+    game.describe_current_location(location)
+    game.describe_exits(location)
+    game.describe_items(location)
+    return game.output.getvalue()
+  finally:
+    game.output = output
+
+
+# ## Undoing turns
+# The parser keeps only the last `HISTORY_SIZE` commands, so a long session doesn't grow without end.  A game can also keep a `Journal` of what the same number of turns changed (see `Game.keep_journal`), so that the player can type "undo" to take back the last turn.  Each change is a small tuple recorded as it happens: the player moving, an item entering or leaving the inventory or a location, a flag changing, the player marrying, or the princess being given something.  Undoing a turn applies its changes backwards, which costs as much as the turn changed rather than replaying the game from the start.
+#
+# Every `CHECKPOINT_EVERY` turns the journal also takes a snapshot of the game.  Going back many turns at once restores the latest snapshot before the turn and applies the changes after it forwards, if that is less work than applying every change since then backwards.  `Journal.game_at` does the same to a fork, to look at an earlier turn without changing the game.
+#
+# Changes made in other ways than these (like restoring a snapshot) start the journal again.
+
+# The most commands that the parser keeps in its history, and turns that a
+# journal keeps
+HISTORY_SIZE = 1000
+# The number of turns between the journal's snapshots
+CHECKPOINT_EVERY = 50
+# Restoring a snapshot costs about as much as applying RESTORE_COST changes,
+# and one more for every SNAPSHOT_BYTES_PER_CHANGE bytes of the snapshot
+# (it also throws away the game's cached blocks and routes).
+RESTORE_COST = 10
+SNAPSHOT_BYTES_PER_CHANGE = 64
+
+
+class Journal:
+  """The changes that each of the last turns of a game made, and snapshots
+     of the game every checkpoint_every turns."""
+  def __init__(self, game, turns=HISTORY_SIZE, checkpoint_every=CHECKPOINT_EVERY):
+    self.game = game
+    self.checkpoint_every = checkpoint_every
+    # The number of turns played: the game is in the state of this turn.
+    self.turn = 0
+    # The list of changes of each of the last turns, oldest first
+    self.turns = collections.deque(maxlen=turns)
+    # The changes made since the last turn ended
+    self.changes = []
+    # Dictionary mapping from turns to snapshots of the game in them
+    self.checkpoints = {0: game.snapshot()}
+
+  @property
+  def first_turn(self):
+    """The earliest turn that the game can go back to."""
+    return self.turn - len(self.turns)
+
+  def end_turn(self):
+    """Called after each command, to start the next turn."""
+    self.turns.append(self.changes)
+    self.changes = []
+    self.turn += 1
+    if self.turn % self.checkpoint_every == 0:
+      self.checkpoints[self.turn] = self.game.snapshot()
+      first_turn = self.first_turn
+      for turn in [turn for turn in self.checkpoints if turn < first_turn]:
+        del self.checkpoints[turn]
+
+  def reset(self):
+    """Forgets every turn so far, keeping the game as it is now."""
+    self.turns.clear()
+    self.changes = []
+    self.checkpoints = {self.turn: self.game.snapshot()}
+
+  def undo(self, turns=1):
+    """Takes back the last turns of the game, as far as the first turn.  
+       Returns the number of turns taken back."""
+    turn = max(self.turn - turns, self.first_turn)
+    undone = self.turn - turn
+    if undone or self.changes:
+      self.go_back(turn)
+    return undone
+
+  def go_back(self, turn):
+    """Puts the game back into the state of an earlier turn, forgetting 
+       the turns after it."""
+    self.move(self.game, turn)
+    for _ in range(self.turn - turn):
+      self.turns.pop()
+    self.changes = []
+    self.turn = turn
+    for later in [later for later in self.checkpoints if later > turn]:
+      del self.checkpoints[later]
+
+  def game_at(self, turn, output=None):
+    """Returns a fork of the game in the state of an earlier turn."""
+    game = self.game.fork(output)
+    self.move(game, turn)
+    return game
+
+  def move(self, game, turn):
+    """Puts a game that is in the same state as this journal's game into
+       the state of an earlier turn, restoring a snapshot if that is less
+       work than applying every change since then backwards."""
+    if not self.first_turn <= turn <= self.turn:
+      raise ValueError("turn %d is not in the journal" % turn)
+    first_turn = self.first_turn
+    backwards = len(self.changes) + sum(
+        len(self.turns[i - first_turn]) for i in range(turn, self.turn))
+    checkpoint = max((earlier for earlier in self.checkpoints if earlier <= turn),
+                     default=None)
+    journal = game.journal
+    game.journal = None
+    try:
+      snapshot = self.checkpoints.get(checkpoint)
+      if snapshot is not None and (
+          RESTORE_COST + len(snapshot) // SNAPSHOT_BYTES_PER_CHANGE + sum(
+              len(self.turns[i - first_turn]) for i in range(checkpoint, turn))
+          < backwards):
+        game.restore(snapshot)
+        for i in range(checkpoint, turn):
+          apply_changes(game, self.turns[i - first_turn], False)
+      else:
+        apply_changes(game, self.changes, True)
+        for i in range(self.turn - 1, turn - 1, -1):
+          apply_changes(game, self.turns[i - first_turn], True)
+    finally:
+      game.journal = journal
+
+
+def apply_changes(game, changes, undo):
+  """Makes a list of changes recorded in a journal to a game again, or
+     takes them back (in reverse order) if undo is True."""
+  for change in (reversed(changes) if undo else changes):
+    kind = change[0]
+    if kind == "move":
+      (kind, old_location, new_location, first_visit) = change
+      if undo:
+        game.curr_location = old_location
+        if first_visit:
+          game.visited.discard(new_location)
+      else:
+        game.curr_location = new_location
+    elif kind == "inventory":
+      (kind, item, added) = change
+      if added != undo:
+        game.add_to_inventory(item)
+      else:
+        game.remove_from_inventory(item)
+    elif kind == "items":
+      (kind, location, item, added) = change
+      if added != undo:
+        game.add_to_location(item, location)
+      else:
+        game.remove_from_location(item, location)
+    elif kind == "flag":
+      (kind, item, flag, old_value, new_value) = change
+      if not undo:
+        game.set_flag(item, flag, new_value)
+      elif old_value is None:
+        # The flag hadn't been changed before.
+        game.reset_flag(item, flag)
+      else:
+        game.set_flag(item, flag, old_value)
+    elif kind == "married":
+      (kind, old_value, new_value) = change
+      game.is_married = old_value if undo else new_value
+    elif kind == "won":
+      (kind, old_value, new_value) = change
+      game.has_won = old_value if undo else new_value
+    elif kind == "princess":
+      (kind, item) = change
+      if undo:
+        names = list(game.princess_has)
+        names.remove(item.name)
+        game.princess_has = names
+        game.changed(("princess", item.name))
+      else:
+        game.give_to_princess(item)
+
+
+# ## The World
+# The world is the static part of a game: its locations and their connections, blocks and items, the actions that belong to the items, and what the player starts out carrying.  It never changes while the game is played, so a single world can be shared by any number of games.
+
+class World:
+  """The World class is the template that games are started from.  It 
+     holds the graph of Location and Item objects as they are at the start
+     of the game.  Everything that changes during play is kept by the Game.
+  """
+  def __init__(self, start_at):
+    # The location where the player starts
+    self.start_at = start_at
+    # Dictionary mapping from item name to the items the player starts with
+    self.inventory = {}
+    # Locations that are dangerous for the player
+    self.dangerous_locations = []
+    # Lists of every location and every item in the world.  The position of
+    # a location or item in its list is its id in game snapshots.  They are
+    # filled in by index() the first time they are needed.
+    self.locations = None
+    self.items = None
+    # Dictionary mapping from lowercased names to locations, and the
+    # Landmarks for finding routes, made when they're first needed
+    self.location_names = None
+    self.landmarks = None
+    # The TypoIndex of the words the parser knows, made when it's first
+    # needed
+    self.typos = None
+    # The text rendered about locations, shared by every game of the world
+    # (see Game.rendered)
+    self.renders = LRUCache(WORLD_RENDER_CACHE_SIZE)
+
+  def add_to_inventory(self, item):
+    """Add an item to the inventory that the player starts with."""
+    self.inventory[item.name] = item
+
+  def location_named(self, name):
+    """Returns the location with this name (in any case), or None."""
+    if self.location_names is None:
+      self.index()
+      self.location_names = {location.name.lower(): location
+                             for location in self.locations}
+    return self.location_names.get(name.lower())
+
+  def typo_index(self):
+    """Returns the TypoIndex of the world's words."""
+    if self.typos is None:
+      self.index()
+      self.typos = TypoIndex(PARSER_WORDS + DIRECTIONS)
+      for item in self.items:
+        self.typos.add_item(item)
+    return self.typos
+
+  def route_index(self):
+    """Returns the Landmarks of this world."""
+    if self.landmarks is None:
+      self.landmarks = Landmarks(self)
+    return self.landmarks
+
+  def index(self):
+    """Find every location and item in the world and give each one a small
+       integer id.  Locations are found by following connections from the 
+       start.  Items are found in locations, in the starting inventory, and
+       in the arguments and preconditions of actions and blocks (which is 
+       where items that appear during the game, like the fish, live)."""
+    if self.locations is not None:
+      return
+    self.locations = []
+    self.location_ids = {}
+    self.items = []
+    self.item_ids = {}
+    pending = []
+
+    def find(value):
+      if isinstance(value, Item):
+        if value not in self.item_ids:
+          self.item_ids[value] = len(self.items)
+          self.items.append(value)
+          pending.append(value)
+      elif isinstance(value, Location):
+        if value not in self.location_ids:
+          self.location_ids[value] = len(self.locations)
+          self.locations.append(value)
+          pending.append(value)
+      elif isinstance(value, Preconditions):
+        find(value.preconditions)
+      elif isinstance(value, collections.abc.Mapping):
+        for each in value.values():
+          find(each)
+      elif isinstance(value, (tuple, list)):
+        for each in value:
+          find(each)
+
+    find(self.start_at)
+    find(self.inventory)
+    while pending:
+      value = pending.pop()
+      if isinstance(value, Location):
+        find(value.exit_locations)
+        find(value.items)
+        find(value.blocks)
+      else:
+        find(value.commands)
+
+  def new_game(self, output=None):
+    """Start a new game in this world."""
+    return Game(self, output)
+
+
 # ## The Game Class
 # The game keeps track of the state of the world, and describes what the player sees as they move through different locations.
 
-# In[1]:
-from IPython import embed
-
 class Game:
   """The Game class represents the world.  Internally, we use a 
      graph of Location objects and Item objects, which can be at a 
@@ -23,70 +410,569 @@ class Game:
      exits which are the directions that a player can move to get to an
      adjacent location. The player can move from one location to another
      location by typing a command like "Go North".
+
+     The locations and items themselves belong to a World that is shared 
+     with other games.  The game only keeps what has changed since the 
+     start: where the player is, their inventory, which items have moved
+     and the items' flags (like whether the lamp is lit).
   """
 
-  def __init__(self, start_at):
-    # start_at is the location in the game where the player starts
-    self.curr_location = start_at
-    self.curr_location.has_been_visited = True
+  def __init__(self, start_at, output=None):
+    # start_at is either the World to play in or the location in the game 
+    # where the player starts
+    if isinstance(start_at, World):
+      self.world = start_at
+    else:
+      self.world = World(start_at)
+    # The output sink that everything the player sees is written to.
+    self.output = output or StreamOutput()
+    # Index from normalised special command text to the (item, command) pairs
+    # currently in scope.  It is kept up to date as items enter or leave the
+    # current location and the inventory, so that matching a special command
+    # is a single dictionary lookup.
+    self.command_index = {}
+    # Dictionary mapping from a location (or None for the inventory) to the
+    # ItemNames of the items in it, for the places with more than 
+    # SMALL_SCOPE items that commands have been matched against.  They are
+    # kept up to date as items are added and removed.
+    self.item_names = {}
+    # Dictionary mapping from Location to the items in it, for the locations
+    # whose items have changed since the start of the game.  Every other 
+    # location still shares its items dictionary with the world.
+    self.location_items = {}
+    # Dictionary mapping from the locations in location_items to the number
+    # of times their items have changed, and the text rendered about those
+    # locations (see rendered)
+    self.item_versions = {}
+    self.renders = LRUCache(GAME_RENDER_CACHE_SIZE)
+    # The Metrics that commands, special actions and precondition checks 
+    # are recorded in, or None (see the instrument module)
+    self.metrics = None
+    # The Capture that profiles this game's commands while they're recorded
+    # in metrics, or None
+    self.capture = None
+    # The Journal of what the last few turns changed, for undoing them, or
+    # None (see keep_journal)
+    self.journal = None
+    # Dictionary mapping from (item, flag name) to the value of flags that 
+    # have been changed since the start of the game, like ("lamp", "lit").
+    self.flags = {}
+    # The set of locations that the player has visited
+    self.visited = set()
+    # Dictionary mapping from (location, direction) to whether the block in
+    # that direction is open, for the blocks checked since the things they
+    # depend on last changed.
+    self.open_blocks = {}
+    # Dictionary mapping from the key of a change (see changed) to the list
+    # of the (location, direction) blocks in open_blocks that depend on it.
+    self.block_dependents = {}
+    # Dictionary mapping from (source, target, ignore_blocks) to the routes
+    # found so far, and from each block to the keys of the routes whose 
+    # search came across it.
+    self.routes = {}
+    self.route_dependents = {}
     # inventory is the set of objects that the player has collected/
-    self.inventory = {}
+    self.inventory = dict(self.world.inventory)
+    for item in self.inventory.values():
+      self.index_commands(item)
+    # The location the player is currently in
+    self._curr_location = None
+    self.curr_location = self.world.start_at
     self.is_married = False
     self.princess_has = []
+    # Set to True when the player wins the game
+    self.has_won = False
     # Print the special commands associated with items in the game (helpful 
     # for debugging and for novice players).
     self.print_commands = True
 
+  @property
+  def dangerous_locations(self):
+    return self.world.dangerous_locations
+
+  @property
+  def is_married(self):
+    return self._is_married
+
+  @is_married.setter
+  def is_married(self, value):
+    if self.journal is not None:
+      self.journal.changes.append(("married", self._is_married, value))
+    self._is_married = value
+    self.changed(("married",))
+
+  @property
+  def has_won(self):
+    return self._has_won
+
+  @has_won.setter
+  def has_won(self, value):
+    if self.journal is not None:
+      self.journal.changes.append(("won", self._has_won, value))
+    self._has_won = value
+
+  def say(self, *values, sep=" ", end="\n"):
+    """Show some text to the player by writing it to the output sink."""
+    self.output.print(*values, sep=sep, end=end)
+
   def describe(self):
     """Describe the current game state by first describing the current 
        location, then listing any exits, and then describing any objects
        in the current location."""
-    self.describe_current_location()
-    self.describe_exits()
-    self.describe_items()
-
-  def describe_current_location(self):
+    if self.output.silent:
+      return
+    self.output.write(self.rendered(self.curr_location, render_description))
+
+  def rendered(self, location, render, *arguments):
+    """Returns the text render(game, location, *arguments) about a 
+       location, rendering it again only if the location's exits or items
+       have changed since it was cached."""
+    if location in self.location_items:
+      cache = self.renders
+      stamp = (location.version, self.item_versions.get(location, 0))
+    else:
+      cache = self.world.renders
+      stamp = (location.version, 0)
+    key = (location, render, arguments, self.print_commands)
+    entry = cache.get(key)
+    if entry is not None and entry[0] == stamp:
+      return entry[1]
+    text = render(self, location, *arguments)
+    cache.put(key, (stamp, text))
+    return text
+
+  def describe_current_location(self, location=None):
     """Describe the current location by printing its description field."""
-    print(self.curr_location.description)
+    self.say((location or self.curr_location).description)
 
-  def describe_exits(self):
+  def describe_exits(self, location=None):
     """List the directions that the player can take to exit from the current
        location."""
     exits = []
-    for exit in self.curr_location.connections.keys():
+    for exit in (location or self.curr_location).exits():
       exits.append(exit.capitalize())
     if len(exits) > 0:
-      print("Exits: ", end = '')
-      print(*exits, sep = ", ",)
+      self.say("Exits: ", end = '')
+      self.say(*exits, sep = ", ",)
   
-  def describe_items(self):
+  def describe_items(self, location=None):
     """Describe what objects are in the current location."""
-    if len(self.curr_location.items) > 0:
-      print("You see: ")
-      for item_name in self.curr_location.items:
-        item = self.curr_location.items[item_name]
-        print(item.description)
+    items = self.items_at(location)
+    if len(items) > 0:
+      self.say("You see: ")
+      for item_name in items:
+        item = items[item_name]
+        self.say(item.description)
         if self.print_commands:
           special_commands = item.get_commands()
           for cmd in special_commands:
-            print('\t', cmd)
+            self.say('\t', cmd)
+
+  @property
+  def curr_location(self):
+    """The location that the player is currently in."""
+    return self._curr_location
+
+  @curr_location.setter
+  def curr_location(self, location):
+    """Move the player, swapping the items of the old location out of the
+       command index and the items of the new location into it."""
+    if self._curr_location is not None:
+      if self.journal is not None:
+        self.journal.changes.append(("move", self._curr_location, location,
+                                     location not in self.visited))
+      for item in self.items_at().values():
+        self.unindex_commands(item)
+    self._curr_location = location
+    self.visited.add(location)
+    for item in self.items_at().values():
+      self.index_commands(item)
 
   def add_to_inventory(self, item):
     """Add an item to the player's inventory."""
+    if item.name not in self.inventory:
+      self.index_commands(item)
+      if self.journal is not None:
+        self.journal.changes.append(("inventory", item, True))
     self.inventory[item.name] = item
+    if None in self.item_names:
+      self.item_names[None].add(item)
+    self.changed(("inventory", item))
+
+  def remove_from_inventory(self, item):
+    """Remove an item from the player's inventory."""
+    self.inventory.pop(item.name)
+    if self.journal is not None:
+      self.journal.changes.append(("inventory", item, False))
+    self.unindex_commands(item)
+    if None in self.item_names:
+      self.item_names[None].remove(item)
+    self.changed(("inventory", item))
   
   def is_in_inventory(self,item):
     return item.name in self.inventory
 
+  def items_at(self, location=None):
+    """Returns the dictionary of items that are in a location (by default 
+       the current location).  The dictionary may be shared with the world,
+       so use add_to_location and remove_from_location to change it."""
+    location = location or self.curr_location
+    items = self.location_items.get(location)
+    if items is None:
+      return location.items
+    return items
+
+  def own_items_at(self, location):
+    """Returns this game's own copy of the items in a location, copying the
+       world's dictionary the first time the location's items change."""
+    items = self.location_items.get(location)
+    if items is None:
+      items = self.location_items[location] = dict(location.items)
+    return items
+
+  def add_to_location(self, item, location=None):
+    """Put an item in a location (by default the current location)."""
+    location = location or self.curr_location
+    items = self.own_items_at(location)
+    if item.name not in items:
+      if location is self.curr_location:
+        self.index_commands(item)
+      if self.journal is not None:
+        self.journal.changes.append(("items", location, item, True))
+    items[item.name] = item
+    self.item_versions[location] = self.item_versions.get(location, 0) + 1
+    if location in self.item_names:
+      self.item_names[location].add(item)
+    self.changed(("items", location))
+
+  def remove_from_location(self, item, location=None):
+    """Remove an item from a location (by default the current location)."""
+    location = location or self.curr_location
+    self.own_items_at(location).pop(item.name)
+    if self.journal is not None:
+      self.journal.changes.append(("items", location, item, False))
+    self.item_versions[location] = self.item_versions.get(location, 0) + 1
+    if location is self.curr_location:
+      self.unindex_commands(item)
+    if location in self.item_names:
+      self.item_names[location].remove(item)
+    self.changed(("items", location))
+
+  def get_flag(self, item, flag):
+    """Returns the value of one of an item's flags, like whether it is lit.
+       Items keep the starting value of their flags."""
+    value = self.flags.get((item, flag))
+    if value is None:
+      return item.get_flag(flag)
+    return value
+
+  def set_flag(self, item, flag, value):
+    """Change the value of one of an item's flags in this game."""
+    if self.journal is not None:
+      self.journal.changes.append(("flag", item, flag, self.flags.get((item, flag)), value))
+    self.flags[(item, flag)] = value
+    self.changed(("flag", item, flag))
+
+  def reset_flag(self, item, flag):
+    """Puts one of an item's flags back to its starting value, as if it
+       had never been changed in this game."""
+    self.flags.pop((item, flag), None)
+    self.changed(("flag", item, flag))
+
+  def changed_flags(self):
+    """Returns a dictionary mapping from (item, flag name) to the value of
+       every flag that has been set in this game."""
+    return self.flags
+
+  def give_to_princess(self, item):
+    """Give an item to the princess."""
+    if self.journal is not None:
+      self.journal.changes.append(("princess", item))
+    self.princess_has.append(item.name)
+    self.changed(("princess", item.name))
+
+  def check(self, preconditions, print_failure_reasons=True):
+    """Checks whether the player has met compiled preconditions in this 
+       game."""
+    return preconditions(self, print_failure_reasons)
+
+  def run_action(self, function, arguments):
+    """Calls the function of a special action with its arguments.  Returns
+       whether the action ended the game."""
+    return function(self, arguments)
+
+  ### Blocks ###
+
+  def changed(self, key):
+    """Called whenever something that preconditions can depend on changes,
+       to forget whether the blocks that depend on it are open.  The keys 
+       are ("inventory", item), ("items", location), ("flag", item, flag),
+       ("princess", item name) and ("married",)."""
+    dependents = self.block_dependents.pop(key, None)
+    if dependents:
+      for block in dependents:
+        self.open_blocks.pop(block, None)
+        for route in self.route_dependents.pop(block, ()):
+          self.routes.pop(route, None)
+
+  def is_open(self, location, direction):
+    """Returns True if the way in a direction from a location is not 
+       blocked, as if the player were there.  The answer is cached until 
+       something that the block depends on changes."""
+    block = (location, direction)
+    is_open = self.open_blocks.get(block)
+    if is_open is not None:
+      return is_open
+    if direction not in location.blocks:
+      return True
+    (block_description, preconditions) = location.blocks[direction]
+    # Check the preconditions from the location of the block.
+    curr_location = self._curr_location
+    self._curr_location = location
+    try:
+      is_open = self.check(preconditions, False)
+    finally:
+      self._curr_location = curr_location
+    if preconditions.dependencies is not None:
+      self.open_blocks[block] = is_open
+      for key in preconditions.dependencies:
+        if HERE in key:
+          key = tuple(location if part is HERE else part for part in key)
+        self.block_dependents.setdefault(key, []).append(block)
+    return is_open
+
+  def open_exits(self, location=None):
+    """Returns a list of the (direction, location) pairs of the exits from 
+       a location (by default the current location) that are open."""
+    location = location or self.curr_location
+    return [(direction, connected) for direction, connected 
+            in location.connections.items() if self.is_open(location, direction)]
+
+  def find_route(self, target, source=None, ignore_blocks=False):
+    """Returns the shortest route from a location (by default the current
+       location) to the target, as a list of (direction, location) steps,
+       or None if there's no way there.  The route only uses exits that are
+       open right now, unless ignore_blocks is True.  Routes never go 
+       through locations that end the game, unless they end there."""
+    source = source or self.curr_location
+    key = (source, target, ignore_blocks)
+    if key in self.routes:
+      return self.routes[key]
+    index = self.world.route_index()
+    if ignore_blocks:
+      route, blocks = index.search(self, source, target, ignore_blocks=True)
+    else:
+      route = self.find_route(target, source, ignore_blocks=True)
+      blocks = []
+      if route is not None:
+        # The blocks on the direct way
+        location = source
+        for direction, next_location in route:
+          if direction in location.blocks:
+            blocks.append((location, direction))
+          location = next_location
+        if any(location.blocks[direction][1].dependencies is None
+               for location, direction in blocks):
+          blocks = None
+        if not all(self.is_open(location, direction)
+                   for location, direction in blocks or ()):
+          (times, extra) = DETOUR
+          route, blocks = index.search(self, source, target,
+                                       limit=times * len(route) + extra)
+    if blocks is not None:
+      self.routes[key] = route
+      for block in blocks:
+        self.route_dependents.setdefault(block, []).append(key)
+    return route
+
+  def open_edges(self):
+    """Returns a list of every open (location, direction, location) edge of
+       the map."""
+    self.world.index()
+    return [(location, direction, connected) for location in self.world.locations
+            for direction, connected in self.open_exits(location)]
+
   def get_items_in_scope(self):
     """Returns a list of items in the current location and in the inventory"""
-    items_in_scope = []
-    for item_name in self.curr_location.items:
-      items_in_scope.append(self.curr_location.items[item_name])
+    items_in_scope = list(self.items_at().values())
     for item_name in self.inventory:
       items_in_scope.append(self.inventory[item_name])
     return items_in_scope
 
+  def index_commands(self, item):
+    """Add the special commands of an item that came into scope to the 
+       command index."""
+    for key, command_text in item.command_keys.items():
+      self.command_index.setdefault(key, []).append((item, command_text))
+
+  def unindex_commands(self, item):
+    """Remove the special commands of an item that left scope from the
+       command index."""
+    for key in item.command_keys:
+      entries = self.command_index.get(key)
+      if not entries:
+        continue
+      for i, (indexed_item, command_text) in enumerate(entries):
+        if indexed_item is item:
+          del entries[i]
+          break
+      if not entries:
+        del self.command_index[key]
+
+  def reindex_commands(self):
+    """Rebuild the command index from scratch (for instance after adding
+       actions to items that are already in scope).  The rendered text of
+       locations, which lists the items' commands, is thrown away too."""
+    self.renders.clear()
+    self.world.renders.clear()
+    self.command_index = {}
+    for item in self.get_items_in_scope():
+      self.index_commands(item)
+
+  def find_special_command(self, command):
+    """Look up a special command of an item in scope.  Returns an 
+       (item, command_text) pair, or None if no item in scope has it."""
+    entries = self.command_index.get(command.lower())
+    if not entries:
+      return None
+    if len(entries) == 1:
+      return entries[0]
+    # Entries are in the order that their items came into scope, but when
+    # several items have the command, the first item in scope wins: the 
+    # items in the location, and then the inventory.
+    for items in (self.items_at(), self.inventory):
+      for item in items.values():
+        for entry in entries:
+          if entry[0] is item:
+            return entry
+    return entries[0]
+
+  def find_item(self, command, accept=None):
+    """Returns the item in the current location or the inventory with the
+       longest name in a command (of the items for which accept(item) is
+       true), or None.  Of names of the same length, the first in the 
+       command wins, and then the one in the location."""
+    best = None
+    for key, items in ((self.curr_location, self.items_at()),
+                       (None, self.inventory)):
+      if len(items) > SMALL_SCOPE:
+        names = self.item_names.get(key)
+        if names is None:
+          names = self.item_names[key] = ItemNames(items.values())
+        item = names.longest_match(command, accept)
+      else:
+        item = longest_name(items, command, accept)
+      if item is not None and (
+          best is None or (len(item.name), -command.find(item.name)) >
+                          (len(best.name), -command.find(best.name))):
+        best = item
+    return best
+
+  ### Saving and restoring ###
+
+  def get_state(self):
+    """Returns everything that has changed since the start of the game as a
+       tuple of small integers and strings.  Locations and items are 
+       referred to by their ids in the world."""
+    self.world.index()
+    location_ids = self.world.location_ids
+    item_ids = self.world.item_ids
+    return (location_ids[self.curr_location],
+            tuple(item_ids[item] for item in self.inventory.values()),
+            tuple((location_ids[location], 
+                   tuple(item_ids[item] for item in items.values()))
+                  for location, items in self.location_items.items()),
+            tuple((item_ids[item], flag, value) 
+                  for (item, flag), value in self.changed_flags().items()),
+            self.is_married,
+            tuple(self.princess_has),
+            tuple(location_ids[location] for location in self.visited),
+            self.has_won)
+
+  def set_state(self, state):
+    """Puts the game back into a state returned by get_state.  A journal
+       starts again from this state."""
+    self.world.index()
+    journal = self.journal
+    self.journal = None
+    locations = self.world.locations
+    items = self.world.items
+    (curr_location, inventory, location_items, flags, is_married, 
+     princess_has, visited, has_won) = state
+    self.inventory = {items[i].name: items[i] for i in inventory}
+    self.location_items = {
+        locations[l]: {items[i].name: items[i] for i in placed}
+        for l, placed in location_items}
+    self.flags = {}
+    for i, flag, value in flags:
+      self.set_flag(items[i], flag, value)
+    self.is_married = is_married
+    self.princess_has = list(princess_has)
+    self.visited = {locations[l] for l in visited}
+    self.has_won = has_won
+    self._curr_location = locations[curr_location]
+    self.command_index = {}
+    for item in self.get_items_in_scope():
+      self.index_commands(item)
+    self.item_names = {}
+    # Versions start again, so this game's rendered text is out of date.
+    self.item_versions = {}
+    self.renders.clear()
+    self.open_blocks = {}
+    self.block_dependents = {}
+    self.routes = {}
+    self.route_dependents = {}
+    self.journal = journal
+    if journal is not None:
+      journal.reset()
+
+  def snapshot(self):
+    """Returns the state of the game as compact bytes, for saving a game or
+       rolling it back later with restore."""
+    return marshal.dumps(self.get_state())
+
+  def restore(self, snapshot):
+    """Puts the game back into the state saved by snapshot."""
+    self.set_state(marshal.loads(snapshot))
+
+  def keep_journal(self, turns=HISTORY_SIZE, checkpoint_every=CHECKPOINT_EVERY):
+    """Starts keeping a Journal of what the last turns changed, so that 
+       they can be undone.  Returns the journal."""
+    self.journal = Journal(self, turns, checkpoint_every)
+    return self.journal
+
+  def fork(self, output=None):
+    """Returns an independent copy of this game in the same world, for 
+       exploring what would happen without changing this game.  The copy
+       discards its output unless it is given an output sink."""
+    game = object.__new__(type(self))
+    # Immutable values are shared, and everything that can change during 
+    # play is copied.
+    game.__dict__.update(self.__dict__)
+    game.output = output or NullOutput()
+    game.command_index = {key: list(entries) 
+                          for key, entries in self.command_index.items()}
+    # Forks build their own item names when they first need them.
+    game.item_names = {}
+    game.location_items = {location: dict(items) 
+                           for location, items in self.location_items.items()}
+    # The fork's items change separately from here on, so it can't share 
+    # this game's rendered text.
+    game.item_versions = dict(self.item_versions)
+    game.renders = LRUCache(GAME_RENDER_CACHE_SIZE)
+    game.flags = dict(self.flags)
+    game.visited = set(self.visited)
+    # Forks start with no blocks or routes cached.
+    game.open_blocks = {}
+    game.block_dependents = {}
+    game.routes = {}
+    game.route_dependents = {}
+    # Forks don't keep a journal.
+    game.journal = None
+    game.inventory = dict(self.inventory)
+    game.princess_has = list(self.princess_has)
+    return game
+
 
 # ## Locations
 # 
@@ -95,16 +981,88 @@ class Game:
 # In[2]:
 
 
+# The direction back, for the directions whose connections go both ways
+REVERSE_DIRECTIONS = {"north": "south", "south": "north", "east": "west",
+                      "west": "east", "up": "down", "down": "up",
+                      "in": "out", "out": "in"}
+
+# Directions are given small integer ids, in the order that they're first
+# used, so that each location can keep its exits in compact arrays instead
+# of dictionaries.  DIRECTIONS lists the directions by id.
+DIRECTIONS = list(REVERSE_DIRECTIONS)
+DIRECTION_IDS = {direction: i for i, direction in enumerate(DIRECTIONS)}
+
+
+def direction_id(direction):
+  """Returns the id of a direction, giving it one if it's new."""
+  i = DIRECTION_IDS.get(direction)
+  if i is None:
+    i = len(DIRECTIONS)
+    if i > 255:
+      raise ValueError("too many different directions")
+    DIRECTIONS.append(direction)
+    DIRECTION_IDS[direction] = i
+  return i
+
+# Most locations have no items or blocks when the world is built, and most 
+# items have no actions or flags, so they all share these empty (read only)
+# dictionaries until something is added.
+NO_ITEMS = types.MappingProxyType({})
+NO_BLOCKS = types.MappingProxyType({})
+NO_COMMANDS = types.MappingProxyType({})
+NO_FLAGS = types.MappingProxyType({})
+
+
+class Connections(collections.abc.Mapping):
+  """A read only dictionary view of a location's exits, mapping from 
+     directions to the locations they lead to."""
+  __slots__ = ("location",)
+
+  def __init__(self, location):
+    self.location = location
+
+  def __getitem__(self, direction):
+    connected = self.location.connection(direction)
+    if connected is None:
+      raise KeyError(direction)
+    return connected
+
+  def __contains__(self, direction):
+    return self.location.connection(direction) is not None
+
+  def __iter__(self):
+    return iter(self.location.exits())
+
+  def __len__(self):
+    return len(self.location.exit_directions)
+
+  def items(self):
+    location = self.location
+    return [(DIRECTIONS[i], location.exit_at(position))
+            for position, i in enumerate(location.exit_directions)]
+
+  def values(self):
+    location = self.location
+    return [location.exit_at(position)
+            for position in range(len(location.exit_directions))]
+
+
 class Location:
   """Locations are the places in the game that a player can visit.
      Internally they are represented nodes in a graph.  Each location stores
      a description of the location, any items in the location, its connections
      to adjacent locations, and any blocks that prevent movement to an adjacent
-     location.  The connections is a dictionary whose keys are directions and
-     whose values are the location that is the result of traveling in that 
-     direction.  The travel_descriptions also has directions as keys, and its 
-     values are an optional short desciption of traveling to that location.
+     location.  The connections are kept as two arrays: the ids of the 
+     directions of the exits (in the order that they were added) and the 
+     locations that they lead to.  The connections property presents them 
+     as a dictionary whose keys are directions and whose values are the 
+     location that is the result of traveling in that direction.  The 
+     travel_descriptions also has directions as keys, and its values are an
+     optional short desciption of traveling to that location.
   """
+  __slots__ = ("name", "description", "end_game", "exit_directions",
+               "exit_locations", "travel", "items", "blocks", "version")
+
   def __init__(self, name, description, end_game=False):
     # A short name for the location
     self.name = name
@@ -112,70 +1070,113 @@ class Location:
     self.description = description
     # True if entering this location should end the game
     self.end_game = end_game
-    # Dictionary mapping from directions to other Location objects
-    self.connections = {}
-    # Dictionary mapping from directions to text description of the path there
-    self.travel_descriptions = {}
+    # The ids of the directions of the exits, as bytes
+    self.exit_directions = b""
+    # Tuple of the Location objects that the exits lead to
+    self.exit_locations = ()
+    # Dictionary mapping from directions to text description of the path 
+    # there, or None if none of the paths have a description
+    self.travel = None
     # Dictionary mapping from item name to Item objects present in this location
-    self.items = {}
+    self.items = NO_ITEMS
     # Dictionary mapping from direction to Block object in that direction
-    self.blocks = {}
-    # Flag that gets set to True once this location has been visited by player
-    self.has_been_visited = False
+    self.blocks = NO_BLOCKS
+    # Goes up whenever the exits or items change, so that rendered text
+    # about the location can tell when it is out of date
+    self.version = 0
+
+  @property
+  def connections(self):
+    return Connections(self)
+
+  @connections.setter
+  def connections(self, connections):
+    self.exit_directions = bytes(direction_id(direction) for direction in connections)
+    self.exit_locations = tuple(connections.values())
+    self.version += 1
+
+  @property
+  def travel_descriptions(self):
+    travel = self.travel or {}
+    return {direction: travel.get(direction, "") for direction in self.exits()}
+
+  @travel_descriptions.setter
+  def travel_descriptions(self, travel_descriptions):
+    self.travel = {direction: text for direction, text
+                   in travel_descriptions.items() if text} or None
+
+  def exits(self):
+    """Returns a list of the directions that lead out of this location."""
+    return [DIRECTIONS[i] for i in self.exit_directions]
+
+  def connection(self, direction):
+    """Returns the location in this direction, or None."""
+    i = DIRECTION_IDS.get(direction)
+    if i is None:
+      return None
+    position = self.exit_directions.find(i)
+    if position < 0:
+      return None
+    return self.exit_at(position)
+
+  def exit_at(self, position):
+    """Returns the location that the exit at this position leads to."""
+    return self.exit_locations[position]
+
+  def set_connection(self, direction, connected_location, travel_description=""):
+    """Connect this location to another one in one direction only."""
+    i = direction_id(direction)
+    position = self.exit_directions.find(i)
+    if position < 0:
+      self.exit_directions += bytes((i,))
+      self.exit_locations += (connected_location,)
+    else:
+      self.exit_locations = (self.exit_locations[:position] + (connected_location,)
+                             + self.exit_locations[position + 1:])
+    if travel_description:
+      if self.travel is None:
+        self.travel = {}
+      self.travel[direction] = travel_description
+    elif self.travel:
+      self.travel.pop(direction, None)
+    self.version += 1
 
   def add_connection(self, direction, connected_location, travel_description=""):
     """Add a connection from the current location to a connected location.
        Direction is a string that the player can use to get to the connected
        location.  If the direction is a cardinal direction, then we also 
        automatically make a connection in the reverse direction."""
-    self.connections[direction] = connected_location
-    self.travel_descriptions[direction] = travel_description
-    if direction == 'north':
-      connected_location.connections["south"] = self
-      connected_location.travel_descriptions["south"] = ""
-    if direction == 'south':
-      connected_location.connections["north"] = self
-      connected_location.travel_descriptions["north"] = ""
-    if direction == 'east':
-      connected_location.connections["west"] = self
-      connected_location.travel_descriptions["west"] = ""
-    if direction == 'west':
-      connected_location.connections["east"] = self
-      connected_location.travel_descriptions["east"] = ""
-    if direction == 'up':
-      connected_location.connections["down"] = self
-      connected_location.travel_descriptions["down"] = ""
-    if direction == 'down':
-      connected_location.connections["up"] = self
-      connected_location.travel_descriptions["up"] = ""
-    if direction == 'in':
-      connected_location.connections["out"] = self
-      connected_location.travel_descriptions["out"] = ""
-    if direction == 'out':
-      connected_location.connections["in"] = self
-      connected_location.travel_descriptions["in"] = ""
+    self.set_connection(direction, connected_location, travel_description)
+    if direction in REVERSE_DIRECTIONS:
+      connected_location.set_connection(REVERSE_DIRECTIONS[direction], self)
 
 
   def add_item(self, name, item):
     """Put an item in this location."""
+    if self.items is NO_ITEMS:
+      self.items = {}
     self.items[name] = item
+    self.version += 1
 
   def remove_item(self, item):
     """Remove an item from this location (for instance, if the player picks it
        up and puts it in their inventory)."""
     self.items.pop(item.name)
+    self.version += 1
 
 
   def is_blocked(self, direction, game):
     """Check to if there is an obstacle in this direction."""
     if not direction in self.blocks:
         return False
-    (block_description, preconditions) = self.blocks[direction]
-    if check_preconditions(preconditions, game):
+    if game.is_open(self, direction):
       # All the preconditions have been met.  You may pass.
       return False
     else: 
-      # There are still obstalces to overcome or puzzles to solve.
+      # There are still obstalces to overcome or puzzles to solve.  Check
+      # the preconditions again to say why.
+      (block_description, preconditions) = self.blocks[direction]
+      game.check(preconditions)
       return True
 
   def get_block_description(self, direction):
@@ -189,67 +1190,361 @@ class Location:
   def add_block(self, blocked_direction, block_description, preconditions):
     """Create an obstacle that prevents a player from moving in the blocked 
        location until the preconditions are all met."""
-    self.blocks[blocked_direction] = (block_description, preconditions)
+    if self.blocks is NO_BLOCKS:
+      self.blocks = {}
+    self.blocks[blocked_direction] = (block_description,
+                                      keep_preconditions(preconditions))
+
+
+# ## Routes
+# Players can travel to any location they have a name for with "go to <location>".  The game finds the shortest way there through the exits that are open right now, with an A* search guided by a few landmark locations.  The distances between every location and each landmark are worked out once per world, over every connection whether it's blocked or not.  Blocks can only make the way between two locations longer, never shorter, so the landmark distances stay a valid lower bound on the real distance however the blocks change, and never need to be worked out again.
+#
+# The direct way (ignoring blocks) is found first, and if it's open then it's the shortest open route too.  Otherwise the search looks for a detour around the blocks, but only one up to `DETOUR` times as long as the direct way, so that asking for a location that is shut off doesn't search the whole map.  When there is no open route, the player heads the direct way until the first block.
+#
+# Compiled world files are loaded as they're explored, so working out the landmark distances would load the whole world.  Their routes are found with a plain breadth-first search instead, which only loads the locations it reaches.
+#
+# Each game keeps the routes it has found, along with the blocks that each search came across.  When something that one of those blocks depends on changes, only the routes that came across it are forgotten.
+
+# A distance longer than any route, for locations that can't be reached
+UNREACHABLE = 1 << 30
+
+# The longest detour around blocks that routes take, as a multiple of the 
+# direct way and a number of extra steps
+DETOUR = (4, 64)
+
+
+def breadth_first_distances(neighbours, start):
+  """Returns an array of the number of steps from start to every location,
+     where neighbours[i] lists the ids of the locations one step from i."""
+  distances = array.array("i", [UNREACHABLE]) * len(neighbours)
+  distances[start] = 0
+  frontier = [start]
+  distance = 0
+  while frontier:
+    distance += 1
+    next_frontier = []
+    for i in frontier:
+      for j in neighbours[i]:
+        if distances[j] == UNREACHABLE:
+          distances[j] = distance
+          next_frontier.append(j)
+    frontier = next_frontier
+  return distances
+
+
+class Landmarks:
+  """The connections of a world as lists of ids, and the distances from and
+     to a few landmark locations, for finding routes."""
+  def __init__(self, world, count=8):
+    world.index()
+    ids = world.location_ids
+    self.world = world
+    # For each location id, the directions of its exits and the ids of the
+    # locations they lead to
+    self.directions = []
+    self.neighbours = []
+    entrances = [[] for _ in range(len(world.locations))]
+    for i, location in enumerate(world.locations):
+      connections = location.connections.items()
+      self.directions.append(tuple(direction for direction, connected in connections))
+      self.neighbours.append(tuple(ids[connected] for direction, connected in connections))
+      for j in self.neighbours[-1]:
+        entrances[j].append(i)
+    # Landmarks are chosen one at a time, each as far as possible from the
+    # ones before, starting from the start of the game.  forward[k][i] is
+    # the distance from landmark k to location i, and backward[k][i] is 
+    # the distance from location i to landmark k.
+    self.landmarks = []
+    self.forward = []
+    self.backward = []
+    closest = array.array("i", [UNREACHABLE]) * len(self.neighbours)
+    landmark = ids[world.start_at]
+    for _ in range(min(count, len(self.neighbours))):
+      self.landmarks.append(landmark)
+      self.forward.append(breadth_first_distances(self.neighbours, landmark))
+      self.backward.append(breadth_first_distances(entrances, landmark))
+      for i, distance in enumerate(self.forward[-1]):
+        if distance < closest[i]:
+          closest[i] = distance
+      farthest = max((distance, i) for i, distance in enumerate(closest)
+                     if distance != UNREACHABLE)
+      if farthest[0] == 0:
+        break
+      landmark = farthest[1]
+
+  def search(self, game, source, target, ignore_blocks=False,
+             limit=UNREACHABLE):
+    """Finds the shortest route from source to target in a game, of at most
+       limit steps.  Returns the route (a list of (direction, location) 
+       steps, or None) and the list of blocks the search came across, or 
+       None if some of them can't be cached."""
+    world = self.world
+    ids = world.location_ids
+    locations = world.locations
+    start = ids[source]
+    goal = ids[target]
+    landmarks = [(forward, backward, forward[goal], backward[goal])
+                 for forward, backward in zip(self.forward, self.backward)]
+
+    def estimate(i):
+      # The longest distance to the goal allowed by the triangle inequality
+      best = 0
+      for forward, backward, forward_goal, backward_goal in landmarks:
+        bound = max(forward_goal - forward[i], backward[i] - backward_goal)
+        if bound > best:
+          best = bound
+      return best
+
+    blocks = []
+    cacheable = True
+    distances = {start: 0}
+    previous = {}
+    frontier = [(estimate(start), 0, start)]
+    while frontier:
+      estimated, distance, i = heapq.heappop(frontier)
+      if i == goal:
+        break
+      if distance > distances[i]:
+        continue
+      location = locations[i]
+      # Routes don't go through locations that end the game.
+      if location.end_game and i != start:
+        continue
+      for direction, j in zip(self.directions[i], self.neighbours[i]):
+        if not ignore_blocks and direction in location.blocks:
+          blocks.append((location, direction))
+          if location.blocks[direction][1].dependencies is None:
+            cacheable = False
+          if not game.is_open(location, direction):
+            continue
+        if distance + 1 < distances.get(j, UNREACHABLE):
+          bound = estimate(j)
+          if distance + 1 + bound > limit:
+            # The goal can't be reached from there in time.
+            continue
+          distances[j] = distance + 1
+          previous[j] = (i, direction)
+          heapq.heappush(frontier, (distance + 1 + bound, distance + 1, j))
+    else:
+      return None, (blocks if cacheable else None)
+
+    route = []
+    i = goal
+    while i != start:
+      (i_before, direction) = previous[i]
+      route.append((direction, locations[i]))
+      i = i_before
+    route.reverse()
+    return route, (blocks if cacheable else None)
+
+
+class BreadthFirstRoutes:
+  """Finds routes with a plain breadth-first search from the source, for
+     worlds that are loaded as they're explored, where working out the 
+     landmark distances would load every location.  Only the locations 
+     the search reaches are loaded."""
+  def __init__(self, world):
+    self.world = world
+
+  def search(self, game, source, target, ignore_blocks=False,
+             limit=UNREACHABLE):
+    """Finds the shortest route like Landmarks.search."""
+    blocks = []
+    cacheable = True
+    previous = {source: None}
+    frontier = [source]
+    distance = 0
+    while target not in previous:
+      if not frontier or distance >= limit:
+        return None, (blocks if cacheable else None)
+      distance += 1
+      next_frontier = []
+      for location in frontier:
+        # Routes don't go through locations that end the game.
+        if location.end_game and location is not source:
+          continue
+        for direction, connected in location.connections.items():
+          if not ignore_blocks and direction in location.blocks:
+            blocks.append((location, direction))
+            if location.blocks[direction][1].dependencies is None:
+              cacheable = False
+            if not game.is_open(location, direction):
+              continue
+          if connected not in previous:
+            previous[connected] = (location, direction)
+            next_frontier.append(connected)
+      frontier = next_frontier
+
+    route = []
+    location = target
+    while location is not source:
+      (location_before, direction) = previous[location]
+      route.append((direction, location))
+      location = location_before
+    route.reverse()
+    return route, (blocks if cacheable else None)
 
 
 # ## Checking Preconditions 
 # In text adventure games it's common to block a player's progress by creating blocks that prevent them from moving to a location.  For instance, a drawbridge might have a troll that you need to get rig of before you can cross into the castle, or a locked door might prevent you from entering a building until you have a key.  
 # 
-# This is a function that you can modify to include other preconditions.
+# Each kind of precondition is registered with `register_precondition`, so you can add other preconditions without modifying `check_preconditions`.  Preconditions are compiled once, when an action or block is added, into a predicate that tries the cheapest checks first.
+#
+# A kind of precondition can also declare which changes to the game it depends on, like an item moving in or out of the inventory or a flag changing.  The game caches whether each block is open, and only checks a block's preconditions again when one of the things they depend on changes.
 
 # In[3]:
 
 
 def check_preconditions(preconditions, game, print_failure_reasons=True):
   """Checks whether the player has met all of the specified preconditions"""
-  all_conditions_met = True
-  for check in preconditions: 
-    if check == "inventory_contains":
-      item = preconditions[check]
-      if not game.is_in_inventory(item):
-        all_conditions_met = False
-        if print_failure_reasons:
-          print("You don't have the %s" % item.name)
-    if check == "in_location":
-      location = preconditions[check]
-      if not game.curr_location == location:
-        all_conditions_met = False
-        if print_failure_reasons:
-          print("You aren't in the correct location")
-    if check == "location_has_item":
-      item = preconditions[check]
-      if not item.name in game.curr_location.items:
-        all_conditions_met = False
-        if print_failure_reasons:
-          print("The %s isn't in this location" % item.name)
-    if check == 'is_gone':
-      item = preconditions[check]
-      if(item.name in game.curr_location.items):
-        all_conditions_met = False
-    if check == 'princess_has':
-      item = preconditions[check]
-      if(item.name not in game.princess_has):
-        all_conditions_met = False
-    if check == 'is_lit':
-      item = preconditions[check]
-      if(not item.lit):
-        all_conditions_met = False
-    if check == 'is_wearing':
-      item = preconditions[check]
-      if(not item.is_wearing):
-        all_conditions_met = False
-    if check == 'is_married':
-      if (game.is_married != preconditions[check]):
-        all_conditions_met = False
-    if check == 'is_unlocked':
-      item = preconditions[check]
-      if(not item.is_unlocked):
-        all_conditions_met = False
-
-
-      
-    # todo - add other types of preconditions
-  return all_conditions_met
+  return game.check(compile_preconditions(preconditions), print_failure_reasons)
+
+
+# The precondition registry maps the name of each kind of precondition to a
+# (cost, compile_check) pair.  compile_check takes the value given for that
+# precondition and returns a (test, failure_reason) pair, where test(game) 
+# returns True when the condition holds and failure_reason is the message 
+# printed when it doesn't (or None for a silent check).  The cost orders the
+# tests so that cheap ones are tried first.
+PRECONDITIONS = {}
+
+# DEPENDENCIES maps the name of each kind of precondition to a function that
+# takes the value given for that precondition and returns the keys of the 
+# changes that it depends on (see Game.changed).  The location where the 
+# precondition is checked is written as HERE in the keys.  Preconditions of 
+# kinds without dependencies are checked every time.
+DEPENDENCIES = {}
+HERE = object()
+
+def register_precondition(kind, cost=1, depends_on=None):
+  """Decorator that adds a new kind of precondition to the registry."""
+  def register(compile_check):
+    PRECONDITIONS[kind] = (cost, compile_check)
+    if depends_on is not None:
+      DEPENDENCIES[kind] = depends_on
+    return compile_check
+  return register
+
+
+class Preconditions:
+  """A preconditions dictionary compiled into a predicate.  Calling it with
+     a game checks whether the player has met all of the preconditions."""
+  def __init__(self, preconditions):
+    # The original preconditions dictionary.
+    self.preconditions = dict(preconditions)
+    # (test, failure_reason) pairs in the order they were given, used to 
+    # report every failed precondition just like the original check did.
+    self.checks = []
+    costs = []
+    for check in self.preconditions:
+      if check not in PRECONDITIONS:
+        # Unknown kinds of preconditions are ignored.
+        continue
+      cost, compile_check = PRECONDITIONS[check]
+      test, failure_reason = compile_check(self.preconditions[check])
+      self.checks.append((test, failure_reason))
+      costs.append(cost)
+    # The tests sorted from cheapest to most expensive.
+    order = sorted(range(len(costs)), key=lambda i: costs[i])
+    self.tests = tuple(self.checks[i][0] for i in order)
+    # The keys of the changes that the preconditions depend on, or None if
+    # some of them don't say.
+    self.dependencies = []
+    for check, value in self.preconditions.items():
+      if check not in PRECONDITIONS:
+        continue
+      if check not in DEPENDENCIES:
+        self.dependencies = None
+        break
+      self.dependencies.extend(DEPENDENCIES[check](value))
+    # Whether a block or an action keeps these preconditions, so that they
+    # live as long as the world and what is worked out about them can be
+    # cached (see keep_preconditions).  check_preconditions compiles a new
+    # Preconditions for every check, which nothing should cache.
+    self.kept = False
+
+  def __call__(self, game, print_failure_reasons=True):
+    for test in self.tests:
+      if not test(game):
+        break
+    else:
+      return True
+    if print_failure_reasons:
+      for test, failure_reason in self.checks:
+        if failure_reason and not test(game):
+          game.say(failure_reason)
+    return False
+
+
+def compile_preconditions(preconditions):
+  """Turns a preconditions dictionary into a Preconditions predicate."""
+  if isinstance(preconditions, Preconditions):
+    return preconditions
+  if not preconditions:
+    # Most actions have no preconditions, so they all share one predicate.
+    return NO_PRECONDITIONS
+  return Preconditions(preconditions)
+
+
+def keep_preconditions(preconditions):
+  """Compiles the preconditions of a block or an action, which are kept as
+     long as the world."""
+  preconditions = compile_preconditions(preconditions)
+  preconditions.kept = True
+  return preconditions
+
+
+NO_PRECONDITIONS = keep_preconditions(Preconditions({}))
+
+
+@register_precondition("is_married", cost=0,
+                       depends_on=lambda value: [("married",)])
+def is_married(value):
+  return (lambda game: game.is_married == value), None
+
+@register_precondition("is_lit", cost=1,
+                       depends_on=lambda item: [("flag", item, "lit")])
+def is_lit(item):
+  return (lambda game: game.get_flag(item, "lit")), None
+
+@register_precondition("is_wearing", cost=1,
+                       depends_on=lambda item: [("flag", item, "is_wearing")])
+def is_wearing(item):
+  return (lambda game: game.get_flag(item, "is_wearing")), None
+
+@register_precondition("is_unlocked", cost=1,
+                       depends_on=lambda item: [("flag", item, "is_unlocked")])
+def is_unlocked(item):
+  return (lambda game: game.get_flag(item, "is_unlocked")), None
+
+# Blocks are always checked from their own location, so whether the player
+# is in a location never changes for them.
+@register_precondition("in_location", cost=1, depends_on=lambda location: [])
+def in_location(location):
+  return ((lambda game: game.curr_location == location),
+          "You aren't in the correct location")
+
+@register_precondition("inventory_contains", cost=2,
+                       depends_on=lambda item: [("inventory", item)])
+def inventory_contains(item):
+  return ((lambda game: item.name in game.inventory),
+          "You don't have the %s" % item.name)
+
+@register_precondition("location_has_item", cost=2,
+                       depends_on=lambda item: [("items", HERE)])
+def location_has_item(item):
+  return ((lambda game: item.name in game.items_at()),
+          "The %s isn't in this location" % item.name)
+
+@register_precondition("is_gone", cost=2,
+                       depends_on=lambda item: [("items", HERE)])
+def is_gone(item):
+  return (lambda game: item.name not in game.items_at()), None
+
+@register_precondition("princess_has", cost=3,
+                       depends_on=lambda item: [("princess", item.name)])
+def princess_has(item):
+  return (lambda game: item.name in game.princess_has), None
 
 
 # ## Items
@@ -261,6 +1556,13 @@ def check_preconditions(preconditions, game, print_failure_reasons=True):
 class Item:
   """Items are objects that a player can get, or scenery that a player can
      examine."""
+  __slots__ = ("name", "description", "examine_text", "custom_take_text",
+               "gettable", "end_game", "commands", "command_keys", "flags")
+
+  # The flags that items can have, like whether they are lit.  Each one is
+  # False unless it is given a starting value.
+  FLAGS = ("lit", "is_wearing", "is_unlocked")
+
   def __init__(self,
                name,
                description,
@@ -275,8 +1577,8 @@ class Item:
     self.description = description
     # The detailed description of the player examines the object.
     self.examine_text = examine_text
-    # Text that displays when player takes an object.
-    self.take_text = take_text if take_text else ("You take the %s." % self.name)
+    # Text that displays when player takes an object, if it isn't the usual.
+    self.custom_take_text = take_text
     # Indicates whether a player can get the object and put it in their inventory.
     self.gettable = gettable
     # True if entering this location should end the game.
@@ -284,8 +1586,26 @@ class Item:
     # The location in the Game where the object starts.
     if start_at:
       start_at.add_item(name, self)
-    self.commands = {}
-
+    self.commands = NO_COMMANDS
+    # Maps the normalised (lowercased) text of each special command to the 
+    # command text, for the Game's command index.
+    self.command_keys = NO_COMMANDS
+    # Dictionary mapping from flags to their starting values
+    self.flags = NO_FLAGS
+
+  @property
+  def take_text(self):
+    return self.custom_take_text or ("You take the %s." % self.name)
+
+  def get_flag(self, flag):
+    """Returns the starting value of one of the item's flags."""
+    return self.flags.get(flag, False)
+
+  def set_flag(self, flag, value):
+    """Sets the starting value of one of the item's flags."""
+    if self.flags is NO_FLAGS:
+      self.flags = {}
+    self.flags[flag] = value
 
   def get_commands(self):
     """Returns a list of special commands associated with this object"""
@@ -293,29 +1613,287 @@ class Item:
 
   def add_action(self, command_text, function, arguments, preconditions={}, fail_text=""):
     """Add a special action associated with this item"""
+    preconditions = keep_preconditions(preconditions)
+    if self.commands is NO_COMMANDS:
+      self.commands = {}
+      self.command_keys = {}
     self.commands[command_text] = (function, arguments, preconditions, fail_text)
+    self.command_keys[command_text.lower()] = command_text
 
   def do_action(self, command_text, game):
     """Perform a special action associated with this item"""
     end_game = False  # Switches to True if this action ends the game.
     if command_text in self.commands:
       function, arguments, preconditions, fail_text = self.commands[command_text]
-      if check_preconditions(preconditions, game):
-        end_game = function(game, arguments)
+      if game.check(preconditions):
+        end_game = game.run_action(function, arguments)
       else:
         if(fail_text):
           if(self.name == "princess"):
-            if('rose' in self.inventory):
-              print(fail_text)
+            if('rose' in game.princess_has):
+              game.say(fail_text)
             else:
-              print("The princess will not talk to you unless she has the rose")
+              game.say("The princess will not talk to you unless she has the rose")
           else:
-            print(fail_text)
+            game.say(fail_text)
     else:
-      print("Cannot perform the action %s" % command_text)
+      game.say("Cannot perform the action %s" % command_text)
     return end_game
 
 
+# Each flag can also be read and set as an attribute, like `lamp.lit = False`.
+def flag_property(flag):
+  return property(lambda item: item.get_flag(flag),
+                  lambda item, value: item.set_flag(flag, value))
+
+for flag in Item.FLAGS:
+  setattr(Item, flag, flag_property(flag))
+
+
+# ## Matching item names
+# The parser finds the item that a command is about by looking for the names of the items in scope in the command.  The names are kept in a trie of characters, so finding every name in a command takes one walk down the trie from each character of the command, however many items there are (like in a treasure room, or where the player has dropped everything they carry).  When names overlap, like "key" and "brass key", the longest name in the command wins.
+#
+# Checking a handful of names one by one is quicker than walking a trie, so each game only builds tries for the inventory and the locations that hold more than `SMALL_SCOPE` items, the first time a command is matched against them.  After that they are kept up to date as items are added and removed, and moving around doesn't touch them.
+
+# The most items in a place that are matched one by one, without a trie
+SMALL_SCOPE = 8
+
+
+def longest_name(items, command, accept=None):
+  """Returns the item with the longest name in the command, of a dictionary
+     mapping from names to items, like ItemNames.longest_match."""
+  best = None
+  best_length = 0
+  best_start = 0
+  for name in items:
+    if name in command and len(name) >= best_length:
+      start = command.find(name)
+      if ((len(name) > best_length or start < best_start)
+          and (accept is None or accept(items[name]))):
+        best = items[name]
+        best_length = len(name)
+        best_start = start
+  return best
+
+
+class ItemNames:
+  """A trie of the names of a set of items."""
+  def __init__(self, items=()):
+    # Nested dictionaries mapping from each character of a name to the rest
+    # of the trie.  The key None maps to the list of items whose names end
+    # there.
+    self.root = {}
+    # The number of items in the trie, and the number of names that have
+    # been removed from it since it was built.  The branches of removed 
+    # names are left in place, since the same items often come back (like
+    # something taken and dropped again), and the trie is only built again
+    # once they add up.
+    self.size = 0
+    self.removed = 0
+    for item in items:
+      self.add(item)
+
+  def __iter__(self):
+    nodes = [self.root]
+    while nodes:
+      node = nodes.pop()
+      for character, child in node.items():
+        if character is None:
+          yield from child
+        else:
+          nodes.append(child)
+
+  def add(self, item):
+    node = self.root
+    for character in item.name:
+      node = node.setdefault(character, {})
+    items = node.get(None)
+    if items is None:
+      node[None] = [item]
+    else:
+      if not items:
+        self.removed -= 1
+      items.append(item)
+    self.size += 1
+
+  def remove(self, item):
+    node = self.root
+    for character in item.name:
+      node = node.get(character)
+      if node is None:
+        return
+    items = node.get(None, ())
+    for i, named in enumerate(items):
+      if named is item:
+        del items[i]
+        break
+    else:
+      return
+    self.size -= 1
+    if not items:
+      self.removed += 1
+      if self.removed > max(self.size, SMALL_SCOPE):
+        self.__init__(list(self))
+
+  def longest_match(self, command, accept=None):
+    """Returns the item with the longest name in the command, of the items
+       for which accept(item) is true (by default all of them), or None."""
+    root = self.root
+    best = None
+    best_length = 0
+    length = len(command)
+    for start in range(length):
+      if length - start <= best_length:
+        # No name starting here could be longer.
+        break
+      node = root.get(command[start])
+      end = start + 1
+      while node is not None:
+        items = node.get(None)
+        if items and end - start > best_length:
+          for item in items:
+            if accept is None or accept(item):
+              best = item
+              best_length = end - start
+              break
+        if end == length:
+          break
+        node = node.get(command[end])
+        end += 1
+    return best
+
+
+# ## Correcting typos
+# When a command doesn't make sense, or names no item that is in scope, the parser looks for typos in it, like "tak polle" or "go nrth".  Each word of the command that the parser doesn't know is replaced by the closest known word, if there is one within a couple of edits (insertions, deletions, substitutions or swaps of neighbouring letters), and the corrected command is tried instead.  The known words are the parser's own words, the directions, and the words in the names and special commands of the world's items (apart from numbers).  Exact commands never get this far, so correcting typos costs them nothing.  The index keeps count of how many commands it has been asked to correct, how many it corrected and how long that took, which `TypoIndex.stats` reports.
+#
+# The words are kept in a SymSpell dictionary: every word is stored under every string that can be made by deleting up to two of its letters.  Two words are within that many edits of each other only if deleting letters from each can make them the same, so the candidates for a typo are found by looking up the strings made by deleting letters from the typo.  That's a fixed number of lookups for a word of a given length, however many words there are.  The dictionary is made for each world the first time it's needed, and new words are added to it as they turn up.
+#
+# When two words are just as close to a typo, the ones for the items in scope and the exits of the current location win.
+
+# The most typos whose corrections are remembered
+TYPO_CACHE_SIZE = 4096
+
+# The parser's own words
+PARSER_WORDS = ["look", "examine", "take", "get", "drop", "inventory", "jump",
+                "go", "to"]
+
+
+def max_edits(length):
+  """The most edits that a word of this length can have and still be
+     corrected."""
+  return 0 if length < 3 else 1 if length < 5 else 2
+
+
+def deletions(word, edits):
+  """Returns the set of strings made by deleting up to edits letters from
+     word, including the word itself."""
+  variants = {word}
+  frontier = {word}
+  for _ in range(edits):
+    frontier = {variant[:i] + variant[i + 1:]
+                for variant in frontier for i in range(len(variant))}
+    variants |= frontier
+  return variants
+
+
+def edit_distance(a, b):
+  """Returns the number of insertions, deletions, substitutions and swaps
+     of neighbouring letters that turn a into b."""
+  previous2 = None
+  previous = list(range(len(b) + 1))
+  for i in range(1, len(a) + 1):
+    current = [i] + [0] * len(b)
+    for j in range(1, len(b) + 1):
+      cost = a[i - 1] != b[j - 1]
+      current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+      if (i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+        current[j] = min(current[j], previous2[j - 2] + 1)
+    previous2, previous = previous, current
+  return previous[len(b)]
+
+
+class TypoIndex:
+  """A SymSpell dictionary of known words, for correcting typos.  It also
+     counts how often it has been asked to correct a command, how often it
+     found a correction, and the time it took."""
+  def __init__(self, words=()):
+    # The set of known words
+    self.words = set()
+    # Dictionary mapping from every string made by deleting up to 
+    # max_edits letters from a known word to the list of those words
+    self.deletes = {}
+    # The (distance, word) candidates for recent typos
+    self.candidates = LRUCache(TYPO_CACHE_SIZE)
+    self.lookups = 0
+    self.corrections = 0
+    self.seconds = 0.0
+    for word in words:
+      self.add(word)
+
+  def add(self, word):
+    """Adds a word, if it's new."""
+    if word in self.words:
+      return
+    self.words.add(word)
+    for variant in deletions(word, max_edits(len(word))):
+      self.deletes.setdefault(variant, []).append(word)
+    self.candidates.clear()
+
+  def add_item(self, item):
+    """Adds the words of an item's name and special commands.  Numbers are
+       left out, since a number close to another one is no typo."""
+    for text in [item.name, *item.commands]:
+      for word in text.lower().split():
+        if not word.isdigit():
+          self.add(word)
+
+  def closest(self, token, preferred=()):
+    """Returns the known word closest to token, or None if there isn't one
+       within max_edits of it."""
+    candidates = self.candidates.get(token)
+    if candidates is None:
+      limit = max_edits(len(token))
+      words = set()
+      for variant in deletions(token, limit):
+        words.update(self.deletes.get(variant, ()))
+      candidates = []
+      for word in words:
+        if abs(len(word) - len(token)) <= limit:
+          distance = edit_distance(token, word)
+          if distance <= min(limit, max_edits(len(word))):
+            candidates.append((distance, word))
+      candidates = tuple(candidates)
+      self.candidates.put(token, candidates)
+    best = min(((distance, word not in preferred, word)
+                for distance, word in candidates), default=None)
+    return best and best[2]
+
+  def correct(self, command, preferred=()):
+    """Returns the command with every unknown word replaced by the closest
+       known word (preferring the words in preferred), or None if nothing
+       could be corrected."""
+    start = time.perf_counter()
+    self.lookups += 1
+    words = command.lower().split()
+    corrected = []
+    for word in words:
+      if word not in self.words and not word.isdigit():
+        word = self.closest(word, preferred) or word
+      corrected.append(word)
+    self.seconds += time.perf_counter() - start
+    if corrected == words:
+      return None
+    self.corrections += 1
+    return " ".join(corrected)
+
+  def stats(self):
+    """Returns the number of commands looked at, the fraction of them that
+       were corrected, and the average time each one took."""
+    return {"lookups": self.lookups,
+            "hit_rate": self.corrections / self.lookups if self.lookups else 0.0,
+            "seconds_per_lookup": self.seconds / self.lookups if self.lookups else 0.0}
+
+
 # ## The Parser
 # The parser is the module that handles the natural language understanding in the game.  The players enter commands in text, and the parser interprets them and performs the actions that the player intends.  This is the module with the most potential for improvement using modern natural language processing.  The implementation that I have given below only uses simple keyword matching.
 
@@ -329,8 +1907,8 @@ class Parser:
      is reflected in the simulated world. 
   """
   def __init__(self, game):
-    # A list of all of the commands that the player has issued.
-    self.command_history = []
+    # The last HISTORY_SIZE commands that the player has issued.
+    self.command_history = collections.deque(maxlen=HISTORY_SIZE)
     # A pointer to the game.
     self.game = game
 
@@ -339,6 +1917,8 @@ class Parser:
     if "," in command:
       # Let the player type in a comma separted sequence of commands
       return "sequence"
+    elif self.get_destination(command):
+      return "go to"
     elif self.get_direction(command):
       # Check for the direction intent
       return "direction"
@@ -355,17 +1935,36 @@ class Parser:
       return "inventory"
     elif command.lower() == "jump":
       return "jump"
-    else:
-      for item in self.game.get_items_in_scope():
-        special_commands = item.get_commands()
-        for special_command in special_commands:
-          if command == special_command.lower():
-            return "special"
+    elif command == "undo":
+      return "undo"
+    elif self.game.find_special_command(command):
+      return "special"
 
   def parse_command(self, command):
     # add this command to the history
     self.command_history.append(command)
+    intent, end_game = self.run_command(command)
+    self.end_turn(intent)
+    return end_game
 
+  def end_turn(self, intent):
+    """Starts the next turn in the game's journal, if it keeps one, after
+       a command in the history.  Undoing doesn't take a turn."""
+    journal = self.game.journal
+    if journal is not None and intent != "undo":
+      journal.end_turn()
+
+  def run_command(self, command):
+    """Works out what the player intends by a command and carries it out,
+       without adding it to the history.  Returns the intent and whether 
+       the command ended the game."""
+    if self.game.metrics is not None:
+      return self.game.metrics.time_command(self, command)
+    return self.dispatch(command)
+
+  def dispatch(self, command):
+    """Carries out a command for run_command.  Returns the intent and
+       whether the command ended the game."""
     # By default, none of the intents end the game. The following are ways this
     # flag can be changed to True.
     # * Going to a certain place.
@@ -376,8 +1975,17 @@ class Parser:
 
     # Intents are functions that can be executed
     intent = self.get_player_intent(command)
+    if intent is None:
+      # Try again with any typos corrected.
+      corrected = self.correct_typos(command)
+      if corrected is not None:
+        intent = self.get_player_intent(corrected)
+        if intent is not None:
+          command = corrected
     if intent == "direction":
       end_game = self.go_in_direction(command)
+    elif intent == "go to":
+      end_game = self.go_to(command)
     elif intent == "redescribe":
       self.game.describe()
     elif intent == "examine":
@@ -394,9 +2002,57 @@ class Parser:
       end_game = self.execute_sequence(command)
     elif intent == "jump":
       end_game = self.jump(command)
+    elif intent == "undo":
+      self.undo(command)
     else:
-      print("I'm not sure what you want to do.")
-    return end_game
+      self.game.say("I'm not sure what you want to do.")
+    return intent, end_game
+
+  def execute_batch(self, commands, capture=False, record=True):
+    """Runs a list (or any iterable) of commands in order, stopping at the
+       first one that ends the game.  Blank commands are skipped, and the 
+       rest are added to the history unless record is False.  Returns a 
+       list with a dictionary for each command that ran, with the command,
+       its intent, whether it ended the game and, if capture is True, the
+       text that the player would have seen (which then isn't written to
+       the game's output sink)."""
+    results = []
+    output = self.game.output
+    if capture:
+      self.game.output = BufferedOutput()
+    try:
+      for command in commands:
+        command = command.strip()
+        if not command:
+          continue
+        if record:
+          self.command_history.append(command)
+        intent, end_game = self.run_command(command)
+        if record:
+          self.end_turn(intent)
+        result = {"command": command, "intent": intent,
+                  "end_game": bool(end_game)}
+        if capture:
+          result["text"] = self.game.output.getvalue()
+          self.game.output.clear()
+        results.append(result)
+        if end_game:
+          break
+    finally:
+      self.game.output = output
+    return results
+
+  def respond(self, command):
+    """Parse and execute a command without writing to the game's output 
+       sink.  Returns a pair of whether the command ended the game and the
+       text that the player would have seen."""
+    output = self.game.output
+    self.game.output = BufferedOutput()
+    try:
+      end_game = self.parse_command(command)
+      return end_game, self.game.output.getvalue()
+    finally:
+      self.game.output = output
 
   ### Intent Functions ###
 
@@ -405,13 +2061,14 @@ class Parser:
     direction = self.get_direction(command)
 
     if direction:
-      if direction in self.game.curr_location.connections:
+      connected_location = self.game.curr_location.connection(direction)
+      if connected_location is not None:
         if self.game.curr_location.is_blocked(direction, self.game):
           # check to see whether that direction is blocked.
-          print(self.game.curr_location.get_block_description(direction))
+          self.game.say(self.game.curr_location.get_block_description(direction))
         else:
           # if it's not blocked, then move there 
-          self.game.curr_location = self.game.curr_location.connections[direction]
+          self.game.curr_location = connected_location
 
           # If moving to this location ends the game, only describe the location
           # and not the available items or actions.
@@ -422,116 +2079,177 @@ class Parser:
 
 
       else:
-        print("You can't go %s from here." % direction.capitalize())
+        self.game.say("You can't go %s from here." % direction.capitalize())
     return self.game.curr_location.end_game
 
+  def go_to(self, command):
+    """ The player wants to travel to a location by name """
+    game = self.game
+    destination = self.get_destination(command)
+    if destination is game.curr_location:
+      game.say("You are already there.")
+      return False
+    route = game.find_route(destination)
+    if route is None:
+      # Head that way anyway, to find out what is in the way.
+      route = game.find_route(destination, ignore_blocks=True)
+      if route is None:
+        game.say("You can't get there from here.")
+        return False
+    moved = False
+    for direction, location in route:
+      if not game.is_open(game.curr_location, direction):
+        if moved:
+          game.describe()
+        game.curr_location.is_blocked(direction, game)
+        game.say(game.curr_location.get_block_description(direction))
+        return False
+      game.curr_location = location
+      moved = True
+      if location.end_game:
+        game.describe_current_location()
+        return True
+    game.describe()
+    return False
+
   def check_inventory(self,command):
     """ The player wants to check their inventory"""
     if len(self.game.inventory) == 0:
-      print("You don't have anything.")
+      self.game.say("You don't have anything.")
     else:
       descriptions = []
       for item_name in self.game.inventory:
         item = self.game.inventory[item_name]
         descriptions.append(item.description)
-      print("You have: ", end = '')
-      print(*descriptions, sep = ", ",)
+      self.game.say("You have: ", end = '')
+      self.game.say(*descriptions, sep = ", ",)
   
 
   def examine(self, command):
     """ The player wants to examine something """
     command = command.lower()
-    matched_item = False
-    # check whether any of the items at this location match the command
-    for item_name in self.game.curr_location.items:
-      if item_name in command:
-        item = self.game.curr_location.items[item_name]
-        if item.examine_text:
-          print(item.examine_text)
-          matched_item = True
-        break
-    # check whether any of the items in the inventory match the command
-    for item_name in self.game.inventory:
-      if item_name in command:
-        item = self.game.inventory[item_name]
-        if item.examine_text:
-          print(item.examine_text)
-          matched_item = True
+    # check whether any of the items at this location or in the inventory
+    # match the command
+    item = self.find_item(command)
+    if item and item.examine_text:
+      self.game.say(item.examine_text)
     # fail
-    if not matched_item:
-      print("You don't see anything special.")
+    else:
+      self.game.say("You don't see anything special.")
 
 
   def take(self, command):
     """ The player wants to put something in their inventory """
     command = command.lower()
-    matched_item = False
 
     # This gets set to True if posession of this object ends the game.
     end_game = False
 
-    # check whether any of the items at this location match the command
-    for item_name in self.game.curr_location.items:
-      if item_name in command:
-        item = self.game.curr_location.items[item_name]
-        if item.gettable:
-          self.game.add_to_inventory(item)
-          self.game.curr_location.remove_item(item)
-          print(item.take_text)
-          end_game = item.end_game
-        else:
-          print("You cannot take the %s." % item_name)
-        matched_item = True
-        break
-    # check whether any of the items in the inventory match the command
-    if not matched_item:
-      for item_name in self.game.inventory:
-        if item_name in command:
-          print("You already have the %s." % item_name)
-          matched_item = True
-    # fail
-    if not matched_item:
-      print("You can't find it.")
+    # check whether any of the items at this location match the command,
+    # and then the inventory (an item can be in both, like a fish that was
+    # dropped and caught again)
+    items = self.game.items_at()
+    item = self.find_item(command, lambda item: items.get(item.name) is item,
+                          None)
+    if item is None:
+      # fail
+      self.game.say("You can't find it.")
+    elif items.get(item.name) is not item:
+      self.game.say("You already have the %s." % item.name)
+    elif item.gettable:
+      self.game.remove_from_location(item)
+      self.game.add_to_inventory(item)
+      self.game.say(item.take_text)
+      end_game = item.end_game
+    else:
+      self.game.say("You cannot take the %s." % item.name)
 
     return end_game
 
   def drop(self, command):
     """ The player wants to remove something from their inventory """
     command = command.lower()
-    matched_item = False
+    inventory = self.game.inventory
     # check whether any of the items in the inventory match the command
-    if not matched_item:
-      for item_name in self.game.inventory:
-        if item_name in command:
-          matched_item = True
-          item = self.game.inventory[item_name]
-          self.game.curr_location.add_item(item_name, item)
-          self.game.inventory.pop(item_name)
-          print("You drop the %s." % item_name)
-          break
+    item = self.find_item(
+        command, lambda item: inventory.get(item.name) is item)
+    if item:
+      self.game.remove_from_inventory(item)
+      self.game.add_to_location(item)
+      self.game.say("You drop the %s." % item.name)
     # fail
-    if not matched_item:
-      print("You don't have that.")
+    else:
+      self.game.say("You don't have that.")
+
+
+  def find_item(self, command, *accepts):
+    """Returns the item in scope that a command is about (see 
+       Game.find_item), trying each accept function in order (None accepts
+       every item).  Typos in the command are only corrected if it doesn't
+       name an item that any of them accept."""
+    accepts = accepts or (None,)
+    for accept in accepts:
+      item = self.game.find_item(command, accept)
+      if item is not None:
+        return item
+    corrected = self.correct_typos(command)
+    if corrected is not None:
+      for accept in accepts:
+        item = self.game.find_item(corrected, accept)
+        if item is not None:
+          return item
+    return None
 
+  def correct_typos(self, command):
+    """Returns the command with its typos corrected, or None."""
+    game = self.game
+    typos = game.world.typo_index()
+    preferred = set(game.curr_location.exits())
+    for item in game.get_items_in_scope():
+      preferred.update(item.name.lower().split())
+    # Directions can be new to the index.
+    for direction in preferred:
+      typos.add(direction)
+    return typos.correct(command, preferred)
 
   def run_special_command(self, command):
     """Run a special command associated with one of the items in this location
        or in the player's inventory"""
-    for item in self.game.get_items_in_scope():
-        special_commands = item.get_commands()
-        for special_command in special_commands:
-          if command == special_command.lower():
-            return item.do_action(special_command, self.game)
+    match = self.game.find_special_command(command)
+    if match:
+      (item, special_command) = match
+      return item.do_action(special_command, self.game)
 
   def execute_sequence(self, command):
-    for cmd in command.split(","):
-      cmd = cmd.strip()
-      self.parse_command(cmd)
+    """Runs the comma separated commands of a sequence, which is already in
+       the history as a whole, until one of them ends the game."""
+    results = self.execute_batch(command.split(","), record=False)
+    return bool(results) and results[-1]["end_game"]
 
   def jump(self, command):
     if(self.game.curr_location.name.lower() == "top of the tall tree"):
       return end_game(self.game, ("You jumped from the tree and died"))
 
+  def undo(self, command):
+    """Takes back the last turn, if the game keeps a journal."""
+    journal = self.game.journal
+    if journal is None or not journal.undo():
+      self.game.say("There is nothing to undo.")
+      return
+    self.game.say("You take back your last move.")
+    self.game.describe()
+
+
+  def get_destination(self, command):
+    """Returns the location that a "go to <location>" command names, or
+       None."""
+    command = command.lower()
+    if not command.startswith("go to "):
+      return None
+    name = command[len("go to "):].strip()
+    if name.startswith("the "):
+      name = name[len("the "):]
+    return self.game.world.location_named(name)
 
   def get_direction(self, command):
     command = command.lower()
@@ -551,7 +2269,7 @@ class Parser:
       return "out"
     if command.startswith("go in"):
       return "in"
-    for exit in self.game.curr_location.connections.keys():
+    for exit in self.game.curr_location.exits():
       if command == exit.lower() or command == "go " + exit.lower():
         return exit
     return None
@@ -569,50 +2287,55 @@ def add_item_to_inventory(game, *args):
   """ Add a newly created Item and add it to your inventory."""
   (item, action_description, already_done_description) = args[0]
   if(not game.is_in_inventory(item)):
-    print(action_description)
+    game.say(action_description)
     game.add_to_inventory(item)
   else:
-    print(already_done_description)
+    game.say(already_done_description)
   return False
 
 def describe_something(game, *args):
   """Describe some aspect of the Item"""
   (description) = args[0]
-  print(description)
+  game.say(description)
   return False
 
 def destroy_item(game, *args):
   """Removes an Item from the game by setting its location is set to None."""
   (item, action_description) = args[0]
   if game.is_in_inventory(item):
-    game.inventory.pop(item.name)
-    print(action_description)
-  elif item.name in game.curr_location.items:
-    game.curr_location.remove_item(item)
-    print(action_description)
+    game.remove_from_inventory(item)
+    game.say(action_description)
+  elif item.name in game.items_at():
+    game.remove_from_location(item)
+    game.say(action_description)
   else:
-    print(already_done_description)
+    game.say(already_done_description)
   return False
 
 def end_game(game, *args):
   """Ends the game."""
   end_message = args[0]
-  print(end_message)
+  game.say(end_message)
   return True
 
+def win_game(game, *args):
+  """Ends the game with the player winning."""
+  game.has_won = True
+  return end_game(game, *args)
+
 
 def marry(game, *args):
   """Marry a person"""
   (item, description) = args[0]
   if(item.name != "princess"):
-    print("You cannot marry %s" % item.name)
+    game.say("You cannot marry %s" % item.name)
   else:
     if(game.is_married):
-      print("You are already married!")
+      game.say("You are already married!")
     else:
       game.is_married = True
-      game.inventory['crown'].is_wearing = True
-      print(description)
+      game.set_flag(game.inventory['crown'], "is_wearing", True)
+      game.say(description)
 
   return False
 
@@ -620,20 +2343,19 @@ def give_to(game, *args):
   (item_to_give, receiver, items_left, description) = args[0]
   if(receiver.name == 'princess'):
     if(item_to_give.name == 'rose'):
-      game.inventory.pop(item_to_give.name)
-      game.princess_has.append('rose')
-      receiver.inventory['rose'] = item_to_give
-      print(description)
+      game.remove_from_inventory(item_to_give)
+      game.give_to_princess(item_to_give)
+      game.say(description)
   if(receiver.name == 'troll'):
     if(item_to_give.name == 'fish'):
-      game.inventory.pop(item_to_give.name)
+      game.remove_from_inventory(item_to_give)
       destroy_item(game, (receiver, description))
   if(receiver.name == 'guard'):
     if(item_to_give.name == 'branch'):
-      game.inventory.pop(item_to_give.name)
+      game.remove_from_inventory(item_to_give)
       destroy_item(game, (receiver, description))
       for item_left in items_left:
-        game.curr_location.items[item_left.name] = item_left 
+        game.add_to_location(item_left)
 
   return False
 
@@ -645,7 +2367,7 @@ def light_candle(game, *args):
   destroy_item(game, (item, "You have burnt the candle! It cannot be used again."))
   if(game.curr_location.name == "Dungeon"):
     for item_left in items_left:
-      game.curr_location.items[item_left.name] = item_left
+      game.add_to_location(item_left)
     destroy_item(game, (item_destroyed, "The ghost has been destroyed"))
 
   return False
@@ -654,44 +2376,41 @@ def light_candle(game, *args):
 
 def light_item(game, *args):
   (item, description, already_done_description) = args[0]
-  try:
-    if(game.inventory[item.name].lit):
-      print(already_done_description)
-    else:
-      game.inventory[item.name].lit = True
-      print(description)
-
-  except:
-    print("%s cannot be lit" % item.name)
+  if(not game.is_in_inventory(item)):
+    game.say("%s cannot be lit" % item.name)
+  elif(game.get_flag(item, "lit")):
+    game.say(already_done_description)
+  else:
+    game.set_flag(item, "lit", True)
+    game.say(description)
 
   return False
 
 def wear_item(game, *args):
   (item, description, already_done_description) = args[0]
-  try:
-    if(game.inventory[item.name].is_wearing):
-      print(already_done_description)
-    else:
-      game.inventory[item.name].is_wearing = True
-      print(description)
-  except:
-    print("%s cannot be worn" % item.name)
+  if(not game.is_in_inventory(item)):
+    game.say("%s cannot be worn" % item.name)
+  elif(game.get_flag(item, "is_wearing")):
+    game.say(already_done_description)
+  else:
+    game.set_flag(item, "is_wearing", True)
+    game.say(description)
 
   return False
 
 def unlock_item(game, *args):
   (item, description, already_done_description) = args[0]
-  if(item.is_unlocked):
-    print(already_done_description)
+  if(game.get_flag(item, "is_unlocked")):
+    game.say(already_done_description)
   else:
-    item.is_unlocked = True
-    print(description)
+    game.set_flag(item, "is_unlocked", True)
+    game.say(description)
 
   return False
 
 def kiss(game, *args):
   (item, description) = args[0]
-  print("Princess: %s" % description)
+  game.say("Princess: %s" % description)
 
   return False
 
@@ -714,7 +2433,7 @@ def kiss(game, *args):
 # In[17]:
 
 
-def build_game():
+def build_world():
   # Locations
   cottage = Location("Cottage", "You are standing in a small cottage. There is a fishing pole here")
   garden_path = Location("Garden Path", "You are standing on a lush garden path. There is a rosebush here. There is a cottage here.")
@@ -791,7 +2510,7 @@ def build_game():
   troll.add_action("attack troll", end_game, ("The troll has killed you."))
   troll.add_action("hit troll with branch", end_game, ("The troll has killed you."))
   troll.add_action("club troll with branch", end_game, ("The troll has killed you."))
-  throne.add_action("sit on throne", end_game, ("You have become the king and the people cheer for you!"), preconditions={'is_wearing':crown})
+  throne.add_action("sit on throne", win_game, ("You have become the king and the people cheer for you!"), preconditions={'is_wearing':crown})
   door.add_action("unlock door", unlock_item, (door, "The door is now unlocked", "The door is already unlocked"), preconditions = {'inventory_contains': key})
 
 
@@ -815,12 +2534,23 @@ def build_game():
   dungeon_stairs.add_block('down', 'You shall not pass unless the lamp is lit', preconditions={'is_lit': lamp})
 
 
-  game = Game(cottage)
-  game.add_to_inventory(lamp)
-  game.dangerous_locations = [drawbridge, courtyard, dungeon]
-  princess.inventory = {}
+  world = World(cottage)
+  world.add_to_inventory(lamp)
+  world.dangerous_locations = [drawbridge, courtyard, dungeon]
     
-  return game
+  return world
+
+
+@functools.lru_cache(maxsize=None)
+def world_template():
+  """Returns the Action Castle world.  It is built once and shared by every
+     game started with build_game."""
+  return build_world()
+
+
+def build_game(output=None):
+  """Start a new game of Action Castle."""
+  return world_template().new_game(output)
   
   
 
@@ -831,8 +2561,9 @@ def build_game():
 # In[10]:
 
 
-def game_loop():
-  game = build_game()
+def game_loop(game=None):
+  game = game or build_game()
+  game.keep_journal()
   parser = Parser(game)
   game.describe()
 
@@ -843,85 +2574,11 @@ def game_loop():
     if end_game:
       return
 
-game_loop()
-print('THE GAME HAS ENDED.')
-
-
-# # Visualize your game
-# The code below allows you to create a directed graph that shows the locations in your game and how they are connected.  You can also save a PDF of your graph to your Google Drive with the `save_to_drive` method.  The output file will be called `game-visualization.pdf`.
-
-# In[12]:
-
-
-# get_ipython().system('pip install graphviz')
-from graphviz import Digraph
-from IPython.display import Image
-import queue
-
-def DFS(game, graph):
-  """Do a depth-first-search traversal of the locations in the game
-     starting at the start location, and create a GraphViz graph 
-     to vizualize the connections between the locations, and the items
-     that are located at each location."""
-  start_location = game.curr_location
-  frontier = queue.Queue()
-  frontier.put(start_location)
-  visited = {}
-  visited[start_location.name] = True
-
-  while not frontier.empty():
-    current_location = frontier.get()
-    game.curr_location = current_location
-    name = current_location.name
-    description = current_location.description
-    items = current_location.items
-    items_html = describe_items(current_location)
-    html = "<<b>%s</b><br />%s<br />%s>" % (name, description, items_html)
-    # Create a new node in the graph for this location
-    graph.node(name, label=html)  
-
-    connections = current_location.connections
-    for direction in connections.keys():
-      next_location = connections[direction]
-      if not current_location.is_blocked(direction, game):
-        # Create an edge between the current location and its successor
-        graph.edge(name, next_location.name, label=direction.capitalize())
-      else:
-        # Create a dotted edge for connected locations that are blocked
-        block_description = "%s\n%s" % (direction.capitalize(), current_location.get_block_description(direction))
-        graph.edge(name, next_location.name, label=block_description, style="dotted")
-      if not next_location.name in visited:
-        visited[next_location.name] = True
-        frontier.put(next_location)
-
-def describe_items(location, print_commands=True):
-    """Describe what objects are in the current location."""
-    items_html = ""
-    if len(location.items.keys()) > 0:
-      items_html = "You see: "
-    for item_name in location.items:
-      item = location.items[item_name]
-      items_html += item.description
-      if print_commands:
-        special_commands = item.get_commands()
-        for cmd in special_commands:
-          items_html += "<br/><i>%s</i>" % cmd
-    return items_html
-
-def save_to_drive(graph):
-  from google.colab import drive
-  drive.mount('/content/drive/')
-  graph.render('/content/drive/My Drive/game-visualization', view=True)  
-
-graph = Digraph(node_attr={'color': 'lightblue2', 'style': 'filled'})
-game = build_game()
-DFS(game, graph)
-#save_to_drive(graph)
-graph
-
-
-# In[ ]:
-
-
+def main():
+  """Play the game from the command line: python -m action_castle"""
+  game_loop()
+  print('THE GAME HAS ENDED.')
 
 
+if __name__ == "__main__":
+  main()
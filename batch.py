@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Batched games
+# For training agents we want to play millions of commands a minute, across many games at once.  Playing them through a `Game` and a `Parser` each costs microseconds per command, so instead the game is compiled into tables, and a `BatchEnv` plays a whole batch of games with one NumPy lookup per step.
+#
+# Compiling the game explores every state that can be reached from the start with a fixed list of encoded actions (the commands that can be typed: going in each direction, taking each item and every special command), in the same way as the solver.  Each (state, action) pair is played once with the real parser, and the tables record the state it leads to, its reward (1 for winning the game and 0 otherwise) and whether it ended the game.  Because the tables are built from `Parser.parse_command` itself, stepping a batch follows the same rules as playing the commands one at a time.  `check` plays random commands both ways to confirm it.
+#
+# A game in the batch is just the number of its state.  The tables also have the parts of each state as arrays: the current location, the inventory, where each item is and the items' flags, so they can be gathered for a whole batch at once as observations.
+#
+# Dropping items is left out of the actions by default, since it lets every item end up in every location, which multiplies the number of states (see the solver).  Compiling is meant for small worlds like Action Castle; `max_states` stops it from running away on bigger ones.
+#
+# This module needs NumPy.
+#
+# Usage: `python -m batch [--instances N] [--steps N] [--check N]`
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from action_castle import NullOutput, Parser, build_game
+from replay import DEFAULT_WORLD, load_factory
+from solver import play, state_key, won
+
+
+def vocabulary(world, drops=False):
+  """Returns the list of commands that make up the encoded actions of a
+     world: going in every direction, taking (and if drops is True,
+     dropping) every item that can be taken, and every special command."""
+  world.index()
+  commands = []
+  for location in world.locations:
+    for direction in location.exits():
+      commands.append("go " + direction)
+  for item in world.items:
+    if item.gettable:
+      commands.append("take " + item.name)
+      if drops:
+        commands.append("drop " + item.name)
+  for item in world.items:
+    commands.extend(item.commands)
+  # Keep the first of any duplicates.
+  return list(dict.fromkeys(commands))
+
+
+class Tables:
+  """The states of a game and the transition tables between them.  State 0
+     is the start of the game."""
+  def __init__(self, world, actions):
+    # The list of commands, indexed by action
+    self.actions = actions
+    self.action_ids = {command: i for i, command in enumerate(actions)}
+    self.world = world
+    # Dictionary mapping from the solver's state key to the number of the
+    # state, and a snapshot of a game in each state
+    self.states = {}
+    self.snapshots = []
+    # Arrays indexed by [state, action]: the next state, the reward and
+    # whether the game ended.  A command that ends the game leaves it in
+    # the same state.
+    self.transitions = None
+    self.rewards = None
+    self.done = None
+    # Arrays indexed by state: the id of the current location, and for each
+    # item whether it's in the inventory and the id of the location it's in
+    # (or -1)
+    self.locations = None
+    self.inventory = None
+    self.placement = None
+    # The (item id, flag) pairs of the flags that ever change, and an array
+    # indexed by [state, flag] with their values
+    self.flag_names = []
+    self.flags = None
+
+  def __len__(self):
+    return len(self.snapshots)
+
+  def game(self, state, output=None):
+    """Returns a new Game in a state."""
+    game = self.world.new_game(output or NullOutput())
+    game.restore(self.snapshots[state])
+    return game
+
+
+def compile_tables(factory=build_game, drops=False, max_states=100000):
+  """Explores every state of the game started by factory, and returns its
+     Tables."""
+  start = factory(NullOutput())
+  world = start.world
+  tables = Tables(world, vocabulary(world, drops))
+  tables.states[state_key(start)] = 0
+  games = [start]
+  transitions = []
+  rewards = []
+  done = []
+  i = 0
+  while i < len(games):
+    game = games[i]
+    for command in tables.actions:
+      next_game, end_game = play(game, command)
+      rewards.append(1.0 if won(next_game, end_game) else 0.0)
+      done.append(bool(end_game))
+      if end_game:
+        transitions.append(i)
+        continue
+      key = state_key(next_game)
+      j = tables.states.get(key)
+      if j is None:
+        if len(games) >= max_states:
+          raise ValueError("the game has more than %d states" % max_states)
+        j = tables.states[key] = len(games)
+        games.append(next_game)
+      transitions.append(j)
+    i += 1
+
+  shape = (len(games), len(tables.actions))
+  tables.transitions = np.array(transitions, dtype=np.int32).reshape(shape)
+  tables.rewards = np.array(rewards, dtype=np.float32).reshape(shape)
+  tables.done = np.array(done, dtype=bool).reshape(shape)
+  fill_state_arrays(tables, games)
+  return tables
+
+
+def fill_state_arrays(tables, games):
+  """Fills in the snapshot and the parts of every state."""
+  world = tables.world
+  location_ids = world.location_ids
+  item_ids = world.item_ids
+  flag_names = {}
+  for game in games:
+    for (item, flag) in game.changed_flags():
+      flag_names.setdefault((item_ids[item], flag), len(flag_names))
+  tables.flag_names = list(flag_names)
+  tables.locations = np.zeros(len(games), dtype=np.int32)
+  tables.inventory = np.zeros((len(games), len(world.items)), dtype=bool)
+  tables.placement = np.full((len(games), len(world.items)), -1, dtype=np.int32)
+  tables.flags = np.zeros((len(games), len(flag_names)), dtype=bool)
+  for state, game in enumerate(games):
+    tables.snapshots.append(game.snapshot())
+    tables.locations[state] = location_ids[game.curr_location]
+    for item in game.inventory.values():
+      tables.inventory[state, item_ids[item]] = True
+    for location in world.locations:
+      for item in game.items_at(location).values():
+        tables.placement[state, item_ids[item]] = location_ids[location]
+    for (item_id, flag), column in flag_names.items():
+      tables.flags[state, column] = game.get_flag(world.items[item_id], flag)
+
+
+class BatchEnv:
+  """Plays a batch of games at once.  Each step takes an array with one
+     action for every game, and returns the rewards and whether each game
+     ended.  Games that end start again from the beginning, unless
+     auto_reset is False."""
+  def __init__(self, tables, instances, auto_reset=True):
+    self.tables = tables
+    self.auto_reset = auto_reset
+    # The state of every game in the batch
+    self.state = np.zeros(instances, dtype=np.int32)
+
+  def reset(self, mask=None):
+    """Starts every game again, or just the games where mask is True."""
+    if mask is None:
+      self.state[:] = 0
+    else:
+      self.state[mask] = 0
+    return self.state
+
+  def step(self, actions):
+    """Plays one action in every game.  Returns the new states, the
+       rewards and whether each game ended."""
+    state = self.state
+    rewards = self.tables.rewards[state, actions]
+    done = self.tables.done[state, actions]
+    state = self.tables.transitions[state, actions]
+    if self.auto_reset:
+      state = np.where(done, 0, state)
+    self.state = state
+    return state, rewards, done
+
+  def observation(self):
+    """Returns the current location, inventory, placement of items and
+       flags of every game in the batch."""
+    tables = self.tables
+    return {"location": tables.locations[self.state],
+            "inventory": tables.inventory[self.state],
+            "placement": tables.placement[self.state],
+            "flags": tables.flags[self.state]}
+
+  def game(self, i, output=None):
+    """Returns a Game in the same state as game i of the batch."""
+    return self.tables.game(int(self.state[i]), output)
+
+
+def check(tables, factory=build_game, steps=10000, seed=0):
+  """Plays random actions in a Game with its Parser and in the tables, and
+     returns the number of the first step where they disagree, or None."""
+  random_numbers = random.Random(seed)
+  game = factory(NullOutput())
+  parser = Parser(game)
+  state = 0
+  for step in range(steps):
+    action = random_numbers.randrange(len(tables.actions))
+    end_game = bool(parser.parse_command(tables.actions[action]))
+    reward = 1.0 if won(game, end_game) else 0.0
+    if (end_game != tables.done[state, action]
+        or reward != tables.rewards[state, action]):
+      return step
+    if end_game:
+      game = factory(NullOutput())
+      parser = Parser(game)
+      state = 0
+      continue
+    state = tables.transitions[state, action]
+    if tables.states.get(state_key(game)) != state:
+      return step
+  return None
+
+
+def main(argv=None):
+  arguments = argparse.ArgumentParser(description="Play batches of games with NumPy.")
+  arguments.add_argument("--world", default=DEFAULT_WORLD,
+                         help="module:function that starts a new game")
+  arguments.add_argument("--drops", action="store_true",
+                         help="include dropping items in the actions")
+  arguments.add_argument("--instances", type=int, default=4096)
+  arguments.add_argument("--steps", type=int, default=1000)
+  arguments.add_argument("--check", type=int, default=10000, metavar="STEPS",
+                         help="random steps to compare with the parser")
+  args = arguments.parse_args(argv)
+  factory = load_factory(args.world)
+
+  start = time.perf_counter()
+  tables = compile_tables(factory, args.drops)
+  print("Compiled %d states x %d actions in %.2f s." % (
+      len(tables), len(tables.actions), time.perf_counter() - start))
+  if args.check:
+    step = check(tables, factory, args.check)
+    if step is None:
+      print("%d random steps match the parser." % args.check)
+    else:
+      print("Step %d DOES NOT match the parser." % step)
+
+  env = BatchEnv(tables, args.instances)
+  random_actions = np.random.default_rng(0).integers(
+      len(tables.actions), size=(args.steps, args.instances), dtype=np.int32)
+  start = time.perf_counter()
+  for actions in random_actions:
+    env.step(actions)
+  elapsed = time.perf_counter() - start
+  print("%d games x %d steps: %.0f steps/sec." % (
+      args.instances, args.steps, args.instances * args.steps / elapsed))
+
+
+if __name__ == "__main__":
+  main()
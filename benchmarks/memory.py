@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Memory benchmarks
+# How many bytes each location and each item of a world takes.  Two numbers are measured for every world:
+# * the bytes owned by each location and item: the object itself and the dictionaries, tuples and strings that only it refers to (anything shared, like direction names, is only counted once, and other locations and items are never counted as part of the one referring to them),
+# * the bytes allocated while building the whole world, divided by the number of locations, as measured by `tracemalloc`.
+#
+# Usage:
+#
+#     python benchmarks/memory.py --output before.json
+#     ... change something ...
+#     python benchmarks/memory.py --output after.json
+#     python benchmarks/memory.py --compare before.json after.json
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import types
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from action_castle import Item, Location, Preconditions, build_world
+from run import revision, synthetic_world
+import worldgen
+
+# Containers whose contents are counted as owned by whoever refers to them
+CONTAINERS = (dict, types.MappingProxyType, list, tuple, set, frozenset)
+
+
+def attributes(obj):
+  """Returns the values of an object's attributes, whether it keeps them in
+     a __dict__ or in __slots__."""
+  values = list(getattr(obj, "__dict__", {}).values())
+  for cls in type(obj).__mro__:
+    for slot in cls.__dict__.get("__slots__", ()):
+      if hasattr(obj, slot):
+        values.append(getattr(obj, slot))
+  return values
+
+
+def owned_size(obj, seen, root=True):
+  """Returns the bytes used by obj and everything it owns, skipping
+     anything already in seen (a set of ids)."""
+  if id(obj) in seen or obj is None or isinstance(obj, (bool, int)):
+    return 0
+  if not root and isinstance(obj, (Location, Item)):
+    return 0
+  seen.add(id(obj))
+  size = sys.getsizeof(obj)
+  if isinstance(obj, (str, bytes, float)):
+    return size
+  if hasattr(obj, "__dict__"):
+    size += sys.getsizeof(obj.__dict__)
+  if isinstance(obj, (dict, types.MappingProxyType)):
+    children = list(obj.keys()) + list(obj.values())
+  elif isinstance(obj, CONTAINERS):
+    children = obj
+  elif isinstance(obj, (Location, Item, Preconditions)):
+    children = attributes(obj)
+  else:
+    # Functions, classes and the like are shared by the whole program.
+    return size
+  for child in children:
+    size += owned_size(child, seen, root=False)
+  return size
+
+
+def measure(name, build):
+  """Builds a world and returns its memory benchmarks."""
+  tracemalloc.start()
+  start = tracemalloc.get_traced_memory()[0]
+  world = build()
+  world.index()
+  allocated = tracemalloc.get_traced_memory()[0] - start
+  tracemalloc.stop()
+  seen = set()
+  location_bytes = sum(owned_size(location, seen) for location in world.locations)
+  item_bytes = sum(owned_size(item, seen) for item in world.items)
+  return {"%s/bytes_per_location" % name: location_bytes / len(world.locations),
+          "%s/bytes_per_item" % name: item_bytes / max(1, len(world.items)),
+          "%s/allocated_per_location" % name: allocated / len(world.locations)}
+
+
+def run(sizes):
+  results = measure("action_castle", build_world)
+  for size in sizes:
+    results.update(measure("synthetic_%d" % size, lambda: synthetic_world(size)))
+    results.update(measure("worldgen_%d" % size,
+                           lambda: worldgen.generate(size)[0]))
+  return {"revision": revision(),
+          "python": "%d.%d.%d" % sys.version_info[:3],
+          "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+          "bytes": results}
+
+
+def compare(before, after):
+  """Prints the benchmarks of two runs side by side."""
+  print("%-45s %12s %12s %8s" % ("benchmark", before["revision"],
+                                 after["revision"], "change"))
+  for name in sorted(set(before["bytes"]) | set(after["bytes"])):
+    old = before["bytes"].get(name)
+    new = after["bytes"].get(name)
+    change = "%+.0f%%" % ((new / old - 1) * 100) if old and new else ""
+    print("%-45s %12s %12s %8s" % (name, "%.0f" % old if old else "-",
+                                   "%.0f" % new if new else "-", change))
+
+
+def main(argv=None):
+  arguments = argparse.ArgumentParser(description="Measure the memory used by worlds.")
+  arguments.add_argument("--sizes", default="10000,100000",
+                         help="comma separated sizes of the synthetic and generated worlds")
+  arguments.add_argument("--output", help="save the results to this JSON file")
+  arguments.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                         help="compare two saved results instead of running")
+  args = arguments.parse_args(argv)
+  if args.compare:
+    with open(args.compare[0]) as f:
+      before = json.load(f)
+    with open(args.compare[1]) as f:
+      after = json.load(f)
+    compare(before, after)
+    return
+  sizes = [int(size) for size in args.sizes.split(",") if size]
+  results = run(sizes)
+  for name, size in results["bytes"].items():
+    print("%-45s %12.0f" % (name, size))
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Benchmarks
+# Micro and macro benchmarks for the hot paths of the engine: the parser's intent detection and direction matching, `parse_command` for each kind of intent, precondition checks, building a game, describing a location and the visualiser's traversal of the map.  Each benchmark runs against Action Castle and against synthetic worlds with thousands to hundreds of thousands of locations and items.
+#
+# Results are saved as JSON, so they can be tracked over time and two revisions can be compared.
+#
+# Usage:
+#
+#     python benchmarks/run.py --output before.json
+#     ... change something ...
+#     python benchmarks/run.py --output after.json
+#     python benchmarks/run.py --compare before.json after.json
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from action_castle import (BufferedOutput, Item, Location, NullOutput, Parser,
+                           World, build_game, build_world, check_preconditions,
+                           describe_something, render_description)
+from visualize import DFS
+import bitset
+import env
+import solver
+
+
+class NullGraph:
+  """Stands in for a graphviz Digraph, so DFS can be timed without it."""
+  def node(self, *args, **kwargs):
+    pass
+
+  def edge(self, *args, **kwargs):
+    pass
+
+
+def timeit(function, min_time=0.05, repeat=3):
+  """Returns the best time for one call of the function, in nanoseconds.
+     The function is called in batches that take at least min_time seconds
+     (or once, if a single call takes longer)."""
+  number = 1
+  while True:
+    start = time.perf_counter()
+    for _ in range(number):
+      function()
+    elapsed = time.perf_counter() - start
+    if elapsed >= min_time or elapsed * 10 >= min_time * repeat:
+      break
+    number *= 10
+  best = elapsed / number
+  for _ in range(repeat - 1):
+    start = time.perf_counter()
+    for _ in range(number):
+      function()
+    best = min(best, (time.perf_counter() - start) / number)
+  return best * 1e9
+
+
+# ## Synthetic worlds
+
+def synthetic_world(size):
+  """Builds a world with size locations in a long east-west corridor.
+     Every location has a side room to the north, two items with a few
+     special commands each, and every tenth location has a block."""
+  locations = []
+  previous = None
+  for i in range(size):
+    location = Location("Room %d" % i, "You are in room %d." % i)
+    if previous:
+      previous.add_connection("east", location)
+    if i % 2:
+      side = Location("Side room %d" % i, "You are in a side room.")
+      location.add_connection("north", side)
+    for kind in ("coin", "statue"):
+      item = Item("%s %d" % (kind, i), "a %s" % kind, "IT IS NUMBER %d" % i,
+                  start_at=location, gettable=(kind == "coin"))
+      for verb in ("polish", "admire", "count"):
+        item.add_action("%s %s %d" % (verb, kind, i), describe_something,
+                        ("You %s the %s." % (verb, kind)))
+    if i % 10 == 9:
+      location.add_block("east", "A gate blocks the way.",
+                         preconditions={"is_gone": item})
+    locations.append(location)
+    previous = location
+  world = World(locations[0])
+  world.add_to_inventory(Item("lamp", "a lamp"))
+  return world
+
+
+# ## Benchmarks
+
+def action_castle_benchmarks():
+  # The commands are typed at the fishing pond, holding the pole and rose.
+  world = build_world()
+  game = world.new_game(NullOutput())
+  parser = Parser(game)
+  for command in ["take pole", "go out", "pick rose", "south"]:
+    parser.parse_command(command)
+  results = benchmark_world_from(
+      "action_castle", world, game, parser,
+      {"direction": "north", "back": "south", "redescribe": "look",
+       "examine": "examine pond", "take": "take rose", "drop": "drop rose",
+       "inventory": "inventory", "special": "catch fish",
+       "sequence": "look, inventory", "unknown": "xyzzy",
+       "typo": "exmaine pnod"})
+  results["action_castle/build_game"] = timeit(build_game)
+  results["action_castle/build_world"] = timeit(build_world)
+  # A random agent playing through the environment, with and without text
+  results["action_castle/env/step"] = 1e9 / env.benchmark(env.GameEnv(), 20000)
+  results["action_castle/env/step_render"] = 1e9 / env.benchmark(
+      env.GameEnv(render=True), 20000)
+  return results
+
+
+def bitset_benchmarks():
+  """Compares a Game with a BitsetGame of Action Castle: checking the 
+     preconditions of marrying the princess (which needs the crown in the
+     inventory and the rose given to her), the solver's state key, and 
+     solving the whole game."""
+  results = {}
+  for name, factory in (("game", build_game), ("bitset", bitset.build_game)):
+    game = factory(NullOutput())
+    game.world.index()
+    princess = next(item for item in game.world.items if item.name == "princess")
+    preconditions = princess.commands["marry princess"][2]
+    results["%s/check_preconditions" % name] = timeit(
+        lambda: game.check(preconditions, False))
+    results["%s/state_key" % name] = timeit(lambda: solver.state_key(game))
+    results["%s/solve" % name] = timeit(lambda: solver.solve(factory()), repeat=1)
+  return {"action_castle/%s" % key: value for key, value in results.items()}
+
+
+def synthetic_benchmarks(size):
+  world = synthetic_world(size)
+  game = world.new_game(NullOutput())
+  parser = Parser(game)
+  # Room 1 has a side room to the north.
+  parser.parse_command("east")
+  results = benchmark_world_from(
+      "synthetic_%d" % size, world, game, parser,
+      {"direction": "north", "back": "south", "redescribe": "look",
+       "examine": "examine statue 1", "take": "take coin 1",
+       "drop": "drop coin 1", "inventory": "inventory",
+       "special": "admire statue 1", "sequence": "look, inventory",
+       "unknown": "xyzzy", "typo": "exmaine statue 1"})
+  start = time.perf_counter()
+  synthetic_world(size)
+  results["synthetic_%d/build" % size] = (time.perf_counter() - start) * 1e9
+  return results
+
+
+def benchmark_world_from(name, world, game, parser, commands):
+  """Runs the benchmarks with a game and parser that have already been
+     played to where the commands make sense."""
+  results = {}
+  for intent, command in commands.items():
+    if intent != "back":
+      results["get_player_intent/%s" % intent] = timeit(
+          lambda: parser.get_player_intent(command))
+  results["get_direction/hit"] = timeit(lambda: parser.get_direction("go north"))
+  results["get_direction/miss"] = timeit(lambda: parser.get_direction("xyzzy"))
+
+  for intent, command in commands.items():
+    if intent in ("take", "drop", "direction", "back"):
+      continue
+    results["parse_command/%s" % intent] = timeit(
+        lambda: parser.parse_command(command))
+    parser.command_history.clear()
+  # Commands that change the game are timed in pairs that undo each other.
+  take, drop = commands["take"], commands["drop"]
+  results["parse_command/take+drop"] = timeit(
+      lambda: (parser.parse_command(take), parser.parse_command(drop)))
+  there, back = commands["direction"], commands["back"]
+  results["parse_command/direction+back"] = timeit(
+      lambda: (parser.parse_command(there), parser.parse_command(back)))
+  parser.command_history.clear()
+  # A bot's batch of 100 commands
+  batch = [there, back, commands["redescribe"], commands["inventory"]] * 25
+  results["execute_batch/100"] = timeit(
+      lambda: parser.execute_batch(batch, record=False))
+
+  world.index()
+  for location in world.locations:
+    if location.blocks:
+      direction, (description, preconditions) = next(iter(location.blocks.items()))
+      results["check_preconditions/compiled"] = timeit(
+          lambda: preconditions(game, False))
+      results["is_open"] = timeit(lambda: game.is_open(location, direction))
+      raw = preconditions.preconditions
+      results["check_preconditions/dict"] = timeit(
+          lambda: check_preconditions(raw, game, False))
+      break
+
+  results["open_edges"] = timeit(game.open_edges)
+  # Routes to the last location of the world, found from scratch and cached
+  target = world.locations[-1]
+  world.route_index()
+  def find_route():
+    game.routes.clear()
+    game.route_dependents.clear()
+    return game.find_route(target)
+  results["find_route/uncached"] = timeit(find_route)
+  results["find_route/cached"] = timeit(lambda: game.find_route(target))
+  # Games with a NullOutput don't describe anything, so describe into a
+  # buffer: once with the cached text, and once rendering it every time.
+  output = game.output
+  game.output = BufferedOutput()
+  def describe():
+    game.describe()
+    game.output.clear()
+  results["describe"] = timeit(describe)
+  results["describe/render"] = timeit(
+      lambda: render_description(game, game.curr_location))
+  game.output = output
+  results["new_game"] = timeit(world.new_game)
+  results["DFS"] = timeit(lambda: DFS(world.new_game(NullOutput()), NullGraph()))
+  return {"%s/%s" % (name, key): value for key, value in results.items()}
+
+
+# ## Running and comparing
+
+def revision():
+  """Returns the git revision being benchmarked."""
+  try:
+    return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO,
+                          capture_output=True, text=True).stdout.strip()
+  except OSError:
+    return "unknown"
+
+
+def run(sizes):
+  results = action_castle_benchmarks()
+  results.update(bitset_benchmarks())
+  for size in sizes:
+    results.update(synthetic_benchmarks(size))
+  return {"revision": revision(),
+          "python": platform.python_version(),
+          "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+          "ns_per_op": results}
+
+
+def format_ns(ns):
+  for unit, scale in (("s", 1e9), ("ms", 1e6), ("us", 1e3)):
+    if ns >= scale:
+      return "%.2f %s" % (ns / scale, unit)
+  return "%.0f ns" % ns
+
+
+def compare(before, after):
+  """Prints the benchmarks of two runs side by side."""
+  print("%-55s %12s %12s %8s" % ("benchmark", before["revision"],
+                                 after["revision"], "change"))
+  for name in sorted(set(before["ns_per_op"]) | set(after["ns_per_op"])):
+    old = before["ns_per_op"].get(name)
+    new = after["ns_per_op"].get(name)
+    change = "%+.0f%%" % ((new / old - 1) * 100) if old and new else ""
+    print("%-55s %12s %12s %8s" % (name, format_ns(old) if old else "-",
+                                   format_ns(new) if new else "-", change))
+
+
+def main(argv=None):
+  arguments = argparse.ArgumentParser(description="Benchmark the engine.")
+  arguments.add_argument("--sizes", default="1000,10000,100000",
+                         help="comma separated sizes of the synthetic worlds")
+  arguments.add_argument("--output", help="save the results to this JSON file")
+  arguments.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                         help="compare two saved results instead of running")
+  args = arguments.parse_args(argv)
+  if args.compare:
+    with open(args.compare[0]) as f:
+      before = json.load(f)
+    with open(args.compare[1]) as f:
+      after = json.load(f)
+    compare(before, after)
+    return
+  sizes = [int(size) for size in args.sizes.split(",") if size]
+  results = run(sizes)
+  for name, ns in results["ns_per_op"].items():
+    print("%-55s %12s" % (name, format_ns(ns)))
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+  main()
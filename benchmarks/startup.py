@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Startup benchmark
+# Measures how long a fresh interpreter takes to import the game engine and to build Action Castle.  Each run happens in its own subprocess so that nothing is already imported or cached.
+#
+# Usage: `python benchmarks/startup.py [runs]`
+
+import os
+import subprocess
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROGRAM = """
+import time
+start = time.perf_counter()
+import action_castle
+imported = time.perf_counter()
+action_castle.build_game()
+built = time.perf_counter()
+print((imported - start) * 1000, (built - imported) * 1000)
+"""
+
+def measure(runs=10):
+  """Returns a list of (import ms, build_game ms) pairs, one per run."""
+  timings = []
+  for _ in range(runs):
+    result = subprocess.run([sys.executable, "-c", PROGRAM], cwd=REPO,
+                            capture_output=True, text=True, check=True)
+    import_ms, build_ms = result.stdout.split()
+    timings.append((float(import_ms), float(build_ms)))
+  return timings
+
+def main():
+  runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+  timings = measure(runs)
+  import_ms = sorted(t[0] for t in timings)
+  build_ms = sorted(t[1] for t in timings)
+  print("import action_castle: median %.2f ms, min %.2f ms" % (import_ms[runs // 2], import_ms[0]))
+  print("build_game():         median %.2f ms, min %.2f ms" % (build_ms[runs // 2], build_ms[0]))
+
+
+if __name__ == "__main__":
+  main()
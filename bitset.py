@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Bitset games
+# A `BitsetGame` plays exactly like a `Game`, but keeps the player's state in a single integer.  Each item that can be carried, each item that can be given to the princess, each item flag (like whether the lamp is lit) and whether the player is married gets its own bit, the first time it is needed.  The inventory dictionary is still kept, since the parser lists and matches items by name, but checking whether something is in the inventory only tests a bit.
+#
+# Preconditions are compiled for a bitset game into a mask and the bits it must match, so that `inventory_contains`, `princess_has`, `is_married`, `is_lit`, `is_wearing` and `is_unlocked` are all checked at once with `bits & mask == required`.  Preconditions that depend on where things are (`in_location`, `location_has_item` and `is_gone`) are still checked one by one.  Other kinds of preconditions can be turned into masks with `register_bit_precondition`.
+#
+# Because the state is a number, the solver's key for a state is just the current location, the bits and the few items that have been moved.
+#
+# Bits are numbered in the order they're first needed, so they stay small in huge worlds where only a few items are ever touched.  Bit numbers are only meaningful within one process: snapshots still use the ids of the world, so they can be restored by any kind of game.
+#
+# Usage: `python -m replay --world bitset:build_game playthrough.txt` (or the same `--world` for the server).
+
+import weakref
+
+from action_castle import PRECONDITIONS, Game, World, world_template
+
+# The bit precondition registry maps the name of each kind of precondition
+# to a function that takes the world's BitLayout and the value given for
+# that precondition, and returns a (mask, required) pair: the precondition
+# holds when the bits of the game under the mask equal required.
+BIT_PRECONDITIONS = {}
+
+def register_bit_precondition(kind):
+  """Decorator that adds a kind of precondition that can be checked with a
+     bitmask."""
+  def register(compile_mask):
+    BIT_PRECONDITIONS[kind] = compile_mask
+    return compile_mask
+  return register
+
+
+class BitLayout:
+  """Gives every bit of the player's state in a world its position, and
+     keeps the preconditions of the world compiled into masks.  All the
+     bitset games of a world share one layout."""
+  def __init__(self):
+    # Dictionaries mapping from what each bit stands for to its mask
+    self.inventory = {}
+    self.princess = {}
+    self.flags = {}
+    # The mask of the next bit to be given out
+    self.next_bit = 1
+    self.married = self.new_bit()
+    # Dictionary mapping from the Preconditions kept by blocks and actions
+    # to their (mask, required, tests) triple.  Other preconditions are
+    # compiled again every time, so that this doesn't grow without end.
+    self.compiled = {}
+
+  def new_bit(self):
+    bit = self.next_bit
+    self.next_bit = bit << 1
+    return bit
+
+  def inventory_bit(self, item):
+    """The bit that is set while the item is in the inventory."""
+    bit = self.inventory.get(item)
+    if bit is None:
+      bit = self.inventory[item] = self.new_bit()
+    return bit
+
+  def princess_bit(self, name):
+    """The bit that is set once the princess has the item with this name."""
+    bit = self.princess.get(name)
+    if bit is None:
+      bit = self.princess[name] = self.new_bit()
+    return bit
+
+  def flag_bit(self, item, flag):
+    """The bit that is set while an item's flag is different from its
+       starting value."""
+    bit = self.flags.get((item, flag))
+    if bit is None:
+      bit = self.flags[(item, flag)] = self.new_bit()
+    return bit
+
+  def flag_mask(self, item, flag, value=True):
+    """Returns the (mask, required) pair for the flag having this value."""
+    bit = self.flag_bit(item, flag)
+    return bit, (0 if item.get_flag(flag) == value else bit)
+
+  def compile(self, preconditions):
+    """Returns the (mask, required, tests) triple for Preconditions.  The
+       tests are the preconditions that aren't masks, cheapest first."""
+    compiled = self.compiled.get(preconditions)
+    if compiled is not None:
+      return compiled
+    mask = required = 0
+    tests = []
+    for check, value in preconditions.preconditions.items():
+      if check in BIT_PRECONDITIONS:
+        check_mask, check_required = BIT_PRECONDITIONS[check](self, value)
+        mask |= check_mask
+        required |= check_required
+      elif check in PRECONDITIONS:
+        cost, compile_check = PRECONDITIONS[check]
+        tests.append((cost, len(tests), compile_check(value)[0]))
+    tests = tuple(test for cost, i, test in sorted(tests))
+    compiled = (mask, required, tests)
+    if preconditions.kept:
+      self.compiled[preconditions] = compiled
+    return compiled
+
+
+@register_bit_precondition("inventory_contains")
+def inventory_contains(layout, item):
+  bit = layout.inventory_bit(item)
+  return bit, bit
+
+@register_bit_precondition("princess_has")
+def princess_has(layout, item):
+  bit = layout.princess_bit(item.name)
+  return bit, bit
+
+@register_bit_precondition("is_married")
+def is_married(layout, value):
+  return layout.married, (layout.married if value else 0)
+
+@register_bit_precondition("is_lit")
+def is_lit(layout, item):
+  return layout.flag_mask(item, "lit")
+
+@register_bit_precondition("is_wearing")
+def is_wearing(layout, item):
+  return layout.flag_mask(item, "is_wearing")
+
+@register_bit_precondition("is_unlocked")
+def is_unlocked(layout, item):
+  return layout.flag_mask(item, "is_unlocked")
+
+
+# The layout of each world, shared by all of its bitset games
+LAYOUTS = weakref.WeakKeyDictionary()
+
+def layout_for(world):
+  layout = LAYOUTS.get(world)
+  if layout is None:
+    layout = LAYOUTS[world] = BitLayout()
+  return layout
+
+
+class BitsetGame(Game):
+  """A game that keeps the inventory, the princess's items, the flags of
+     items and whether the player is married as bits of one integer."""
+  def __init__(self, start_at, output=None):
+    world = start_at if isinstance(start_at, World) else World(start_at)
+    self.layout = layout_for(world)
+    # The player's state
+    self.bits = 0
+    super().__init__(world, output)
+    for item in self.inventory.values():
+      self.bits |= self.layout.inventory_bit(item)
+
+  @property
+  def is_married(self):
+    return bool(self.bits & self.layout.married)
+
+  @is_married.setter
+  def is_married(self, value):
+    if self.journal is not None:
+      self.journal.changes.append(("married", self.is_married, value))
+    if value:
+      self.bits |= self.layout.married
+    else:
+      self.bits &= ~self.layout.married
+    self.changed(("married",))
+
+  @property
+  def princess_has(self):
+    """The names of the items that the princess has."""
+    return [name for name, bit in self.layout.princess.items() if self.bits & bit]
+
+  @princess_has.setter
+  def princess_has(self, names):
+    for bit in self.layout.princess.values():
+      self.bits &= ~bit
+    for name in names:
+      self.bits |= self.layout.princess_bit(name)
+
+  def give_to_princess(self, item):
+    if self.journal is not None:
+      self.journal.changes.append(("princess", item))
+    self.bits |= self.layout.princess_bit(item.name)
+    self.changed(("princess", item.name))
+
+  def add_to_inventory(self, item):
+    super().add_to_inventory(item)
+    self.bits |= self.layout.inventory_bit(item)
+
+  def remove_from_inventory(self, item):
+    super().remove_from_inventory(item)
+    self.bits &= ~self.layout.inventory_bit(item)
+
+  def is_in_inventory(self, item):
+    return bool(self.bits & self.layout.inventory_bit(item))
+
+  def get_flag(self, item, flag):
+    value = item.get_flag(flag)
+    if self.bits & self.layout.flag_bit(item, flag):
+      return not value
+    return value
+
+  def set_flag(self, item, flag, value):
+    if self.journal is not None:
+      self.journal.changes.append(("flag", item, flag, self.get_flag(item, flag), value))
+    bit = self.layout.flag_bit(item, flag)
+    if bool(value) != item.get_flag(flag):
+      self.bits |= bit
+    else:
+      self.bits &= ~bit
+    self.changed(("flag", item, flag))
+
+  def reset_flag(self, item, flag):
+    self.set_flag(item, flag, item.get_flag(flag))
+
+  def changed_flags(self):
+    return {(item, flag): not item.get_flag(flag)
+            for (item, flag), bit in self.layout.flags.items() if self.bits & bit}
+
+  def check(self, preconditions, print_failure_reasons=True):
+    """Checks compiled preconditions with one mask and compare, followed by
+       any tests that aren't masks."""
+    compiled = self.layout.compiled.get(preconditions)
+    if compiled is None:
+      compiled = self.layout.compile(preconditions)
+    mask, required, tests = compiled
+    if self.bits & mask == required:
+      if not tests:
+        return True
+      for test in tests:
+        if not test(self):
+          break
+      else:
+        return True
+    if print_failure_reasons:
+      # Check them again the slow way, to say why they failed.
+      preconditions(self, True)
+    return False
+
+  def set_state(self, state):
+    self.bits = 0
+    super().set_state(state)
+    for item in self.inventory.values():
+      self.bits |= self.layout.inventory_bit(item)
+
+  def state_key(self):
+    """Returns a hashable key for the state of the game, for the solver:
+       the id of the current location, the bits, and the items that are not
+       where they started."""
+    self.world.index()
+    item_ids = self.world.item_ids
+    placed = []
+    for location, items in self.location_items.items():
+      if items.keys() != location.items.keys():
+        placed.append((self.world.location_ids[location],
+                       frozenset(item_ids[item] for item in items.values())))
+    return (self.world.location_ids[self.curr_location], self.bits,
+            frozenset(placed))
+
+
+def build_game(output=None):
+  """Starts a new bitset game of Action Castle."""
+  return BitsetGame(world_template(), output)
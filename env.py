@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Game environment
+# `GameEnv` lets an agent play the game through `reset` and `step`, in the style of a Gym environment, instead of reading what the game prints.  Every step returns a structured observation of what the player can see, a reward (1 for winning the game, 0 otherwise) and whether the game has ended.  The observation is a dictionary with:
+# * `location`: the name of the current location,
+# * `exits`: the directions that lead out of it,
+# * `items`: the names of the items that are in it,
+# * `commands`: the special commands of the items in the location and the inventory,
+# * `inventory`: the names of the items that the player is carrying.
+#
+# The text that a player would see is only produced when the environment is created with `render=True`, in which case it is returned in the `info` dictionary of each step.  Otherwise the game's output is a `NullOutput`, which throws away everything the game says, and the game doesn't even build the description of each location it moves to.  This is the fast path for agents that only look at observations.
+#
+# Usage: `python -m env [--steps N] [--render]` plays random commands and reports the steps per second.
+
+import argparse
+import random
+import time
+
+from action_castle import BufferedOutput, NullOutput, Parser
+from replay import DEFAULT_WORLD, load_factory
+
+
+class GameEnv:
+  """Plays a game one command at a time for an agent."""
+  def __init__(self, world=DEFAULT_WORLD, render=False):
+    # The function that starts a new game
+    self.game_factory = load_factory(world) if isinstance(world, str) else world
+    # Whether to keep the text that the player would see
+    self.render = render
+    self.game = None
+    self.parser = None
+    self.done = True
+    self.random = random.Random()
+
+  def reset(self, seed=None):
+    """Starts a new game.  Returns the first observation and an info
+       dictionary (with the text describing the start when rendering).
+       The game itself has no randomness; the seed is for agents that use
+       the environment's random number generator, self.random."""
+    if seed is not None:
+      self.random.seed(seed)
+    output = BufferedOutput() if self.render else NullOutput()
+    self.game = self.game_factory(output)
+    self.parser = Parser(self.game)
+    self.done = False
+    info = {}
+    if self.render:
+      self.game.describe()
+      info["text"] = self.take_text()
+    return self.observation(), info
+
+  def step(self, command):
+    """Plays a command.  Returns the observation, the reward, whether the
+       game has ended and an info dictionary."""
+    if self.done:
+      raise RuntimeError("the game has ended; call reset() to start a new one")
+    self.done = bool(self.parser.parse_command(command))
+    reward = 1.0 if self.done and self.game.has_won else 0.0
+    info = {}
+    if self.render:
+      info["text"] = self.take_text()
+    return self.observation(), reward, self.done, info
+
+  def take_text(self):
+    text = self.game.output.getvalue()
+    self.game.output.clear()
+    return text
+
+  def observation(self):
+    """Returns what the player can see, as a dictionary."""
+    game = self.game
+    # The game's command index already has the special commands of every 
+    # item in scope.
+    commands = [command_text for entries in game.command_index.values()
+                for item, command_text in entries]
+    return {"location": game.curr_location.name,
+            "exits": game.curr_location.exits(),
+            "items": list(game.items_at()),
+            "commands": commands,
+            "inventory": list(game.inventory)}
+
+
+def random_command(env, observation):
+  """Chooses a random command that makes sense in an observation."""
+  commands = (["go " + direction for direction in observation["exits"]] +
+              ["take " + name for name in observation["items"]] +
+              observation["commands"])
+  return env.random.choice(commands)
+
+
+def benchmark(env, steps, seed=0):
+  """Plays random commands for a number of steps, starting new games when
+     they end.  Returns the steps per second."""
+  observation, info = env.reset(seed)
+  start = time.perf_counter()
+  for _ in range(steps):
+    observation, reward, done, info = env.step(random_command(env, observation))
+    if done:
+      observation, info = env.reset()
+  return steps / (time.perf_counter() - start)
+
+
+def main(argv=None):
+  arguments = argparse.ArgumentParser(description="Benchmark the game environment.")
+  arguments.add_argument("--world", default=DEFAULT_WORLD,
+                         help="module:function that starts a new game")
+  arguments.add_argument("--steps", type=int, default=100000)
+  arguments.add_argument("--render", action="store_true",
+                         help="keep the text of every step")
+  args = arguments.parse_args(argv)
+  env = GameEnv(args.world, render=args.render)
+  print("%.0f steps/sec" % benchmark(env, args.steps))
+
+
+if __name__ == "__main__":
+  main()
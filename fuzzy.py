@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Fuzzy command matching
+# Special commands have to be typed exactly, so a near miss like "give the fish to troll" (for "give fish to troll") gets "I'm not sure what you want to do."  A `FuzzyGame` plays exactly like a `Game`, except that when a command doesn't match anything else, it is compared with the special commands in scope, and the most similar one runs if it is similar enough.  Commands that end the game (like "attack troll") are never guessed: they only run when they're typed exactly.
+#
+# Commands are compared by their TF-IDF vectors over character trigrams and words, with cosine similarity.  Every special command in the world is a row of one sparse matrix, which is built the first time it is needed and shared by every game of the world.  The matrix is kept by column (for each trigram or word, the commands that have it and their weights), so scoring an input is one sparse matrix-vector product: the columns of the input's features are gathered and summed per command with NumPy, and only commands that share a feature with the input are touched.
+#
+# `CommandMatcher.best_matches` scores a whole batch of inputs with the same product, for bots sending lots of commands at once.
+#
+# This module needs NumPy.
+#
+# Usage: `python -m replay --world fuzzy:build_game playthrough.txt` (or the same `--world` for the server), or `python -m fuzzy "give the fish to troll" ...` to see what inputs match.
+
+import argparse
+import math
+import re
+import time
+import weakref
+
+import numpy as np
+
+from action_castle import Game, end_game, win_game, world_template
+from replay import DEFAULT_WORLD, load_factory
+
+# The least cosine similarity between an input and a special command for
+# the command to run
+THRESHOLD = 0.6
+# The action functions that end the game.  Their commands are left out of
+# fuzzy matching.
+ENDING_ACTIONS = {end_game, win_game}
+
+
+def features(text):
+  """Returns the list of features of a command: its words, and the
+     character trigrams of its words with a space on each side."""
+  words = re.findall(r"[a-z0-9']+", text.lower())
+  padded = " %s " % " ".join(words)
+  return (["w:" + word for word in words] +
+          [padded[i:i + 3] for i in range(len(padded) - 2)])
+
+
+class CommandMatcher:
+  """The TF-IDF matrix of every special command in a world."""
+  def __init__(self, world):
+    world.index()
+    # The (item, command text) pair of each row
+    self.commands = [(item, command_text) for item in world.items
+                     for command_text in item.commands]
+    self.rows = {command: row for row, command in enumerate(self.commands)}
+    # Whether the command of each row can be matched fuzzily
+    self.guessable = np.array([item.commands[command_text][0] not in ENDING_ACTIONS
+                               for item, command_text in self.commands], dtype=bool)
+    rows = [features(command_text) for item, command_text in self.commands]
+    # Dictionary mapping from each feature to its column
+    self.columns = {}
+    for row in rows:
+      for feature in row:
+        self.columns.setdefault(feature, len(self.columns))
+    # The number of commands that have each feature, and its inverse
+    # document frequency
+    frequencies = np.zeros(len(self.columns))
+    for row in rows:
+      for column in {self.columns[feature] for feature in row}:
+        frequencies[column] += 1
+    self.idf = (np.log((1 + len(rows)) / (1 + frequencies)) + 1).tolist()
+    # The weight of features that no command has
+    self.unknown_idf = math.log(1 + len(rows)) + 1
+    # The matrix by column: the rows and weights of column c are at
+    # positions starts[c] to starts[c + 1] of row_ids and weights.
+    entries = []
+    for i, row in enumerate(rows):
+      vector = self.vector(row)
+      entries.extend((column, i, weight) for column, weight in vector.items())
+    entries.sort()
+    self.row_ids = np.array([i for column, i, weight in entries], dtype=np.int64)
+    self.weights = np.array([weight for column, i, weight in entries])
+    self.starts = np.searchsorted(
+        np.array([column for column, i, weight in entries], dtype=np.int64),
+        np.arange(len(self.columns) + 1))
+
+  def __len__(self):
+    return len(self.commands)
+
+  def vector(self, row):
+    """Returns the TF-IDF vector of a list of features, normalised to unit
+       length, as a dictionary mapping from columns to weights.  Features
+       that no command has count towards its length but aren't kept."""
+    counts = {}
+    for feature in row:
+      counts[feature] = counts.get(feature, 0) + 1
+    vector = {}
+    length = 0.0
+    for feature, count in counts.items():
+      column = self.columns.get(feature)
+      weight = count * (self.idf[column] if column is not None else self.unknown_idf)
+      length += weight * weight
+      if column is not None:
+        vector[column] = weight
+    length = math.sqrt(length) or 1.0
+    return {column: weight / length for column, weight in vector.items()}
+
+  def best_matches(self, inputs, allowed=None):
+    """Scores a batch of inputs against every command, or only the rows
+       where the boolean array allowed is True.  Returns a list with the
+       (row, similarity) of the most similar command to each input, or None
+       for inputs that share nothing with any command."""
+    queries = []
+    columns = []
+    query_weights = []
+    for i, text in enumerate(inputs):
+      for column, weight in self.vector(features(text)).items():
+        queries.append(i)
+        columns.append(column)
+        query_weights.append(weight)
+    best = [None] * len(inputs)
+    if not columns:
+      return best
+    columns = np.array(columns, dtype=np.int64)
+    # Gather the entries of every column of every query.
+    starts = self.starts[columns]
+    lengths = self.starts[columns + 1] - starts
+    entry_queries = np.repeat(np.array(queries, dtype=np.int64), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions = np.repeat(starts, lengths) + offsets
+    rows = self.row_ids[positions]
+    products = self.weights[positions] * np.repeat(np.array(query_weights), lengths)
+    if allowed is not None:
+      keep = allowed[rows]
+      entry_queries, rows, products = entry_queries[keep], rows[keep], products[keep]
+    if not len(rows):
+      return best
+    # Sum the products for each (query, row) pair.
+    pairs, inverse = np.unique(entry_queries * len(self.commands) + rows,
+                               return_inverse=True)
+    scores = np.bincount(inverse.reshape(-1), weights=products)
+    pair_queries = pairs // len(self.commands)
+    pair_rows = pairs % len(self.commands)
+    # The best row of each query
+    order = np.lexsort((-scores, pair_queries))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = pair_queries[order][1:] != pair_queries[order][:-1]
+    for j in order[first]:
+      best[pair_queries[j]] = (int(pair_rows[j]), float(scores[j]))
+    return best
+
+  def match(self, game, command, threshold=THRESHOLD):
+    """Returns the (item, command text) pair of the special command in
+       scope in a game that is most similar to command, or None if none is
+       at least as similar as threshold.  Commands that end the game are
+       never matched."""
+    allowed = np.zeros(len(self.commands), dtype=bool)
+    for entries in game.command_index.values():
+      for entry in entries:
+        row = self.rows.get(entry)
+        if row is not None:
+          allowed[row] = self.guessable[row]
+    (best,) = self.best_matches([command], allowed)
+    if best is None or best[1] < threshold:
+      return None
+    return self.commands[best[0]]
+
+
+# The matcher of each world, shared by all of its games
+MATCHERS = weakref.WeakKeyDictionary()
+
+def matcher_for(world):
+  matcher = MATCHERS.get(world)
+  if matcher is None:
+    matcher = MATCHERS[world] = CommandMatcher(world)
+  return matcher
+
+
+class FuzzyGame(Game):
+  """A game that runs the most similar special command in scope when a
+     command doesn't match anything else."""
+  def __init__(self, start_at, output=None):
+    super().__init__(start_at, output)
+    self.threshold = THRESHOLD
+    # The last command matched fuzzily and its match, since the parser
+    # looks up a special command twice: once to find the intent and again
+    # to run it.
+    self.last_match = (None, None)
+
+  def find_special_command(self, command):
+    match = super().find_special_command(command)
+    if match is not None or not self.command_index:
+      return match
+    last_command, match = self.last_match
+    if last_command == command and match is not None:
+      (item, command_text) = match
+      if match in self.command_index.get(command_text.lower(), ()):
+        return match
+    match = matcher_for(self.world).match(self, command, self.threshold)
+    self.last_match = (command, match)
+    return match
+
+
+def build_game(output=None):
+  """Starts a new fuzzy game of Action Castle."""
+  return FuzzyGame(world_template(), output)
+
+
+def main(argv=None):
+  arguments = argparse.ArgumentParser(description="Match commands fuzzily.")
+  arguments.add_argument("inputs", nargs="*", help="commands to match")
+  arguments.add_argument("--world", default=DEFAULT_WORLD,
+                         help="module:function that starts a new game")
+  arguments.add_argument("--batch", type=int, default=10000,
+                         help="inputs to score at once for timing")
+  args = arguments.parse_args(argv)
+  world = load_factory(args.world)().world
+  start = time.perf_counter()
+  matcher = matcher_for(world)
+  print("Built the matrix of %d commands x %d features in %.3f s." % (
+      len(matcher), len(matcher.columns), time.perf_counter() - start))
+  for text, best in zip(args.inputs, matcher.best_matches(args.inputs)):
+    if best is None:
+      print("%r matches nothing" % text)
+    else:
+      print("%r -> %r (%.2f)" % (text, matcher.commands[best[0]][1], best[1]))
+  if args.batch and len(matcher):
+    inputs = [matcher.commands[i % len(matcher)][1].replace(" ", "  the ", 1)
+              for i in range(args.batch)]
+    start = time.perf_counter()
+    matcher.best_matches(inputs)
+    elapsed = time.perf_counter() - start
+    print("Scored %d inputs in %.3f s: %.0f inputs/sec." % (
+        len(inputs), elapsed, len(inputs) / elapsed))
+
+
+if __name__ == "__main__":
+  main()
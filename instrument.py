@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Instrumentation
+# `Metrics` counts the commands that a game runs by intent (direction, examine, take, special and so on, counting each part of a comma separated sequence on its own and the sequences themselves separately), the special actions it carries out by the name of their function (like `give_to` or `light_candle`) and the preconditions it checks by kind, and keeps a latency histogram for every intent and every action function.
+#
+# A game only records metrics once `attach` has given it a `Metrics`, which any number of games (and their forks) can share.  Until then the parser checks a single attribute per command, so the engine is as fast as before.  Counting is always on for an attached game, but only one command in every `sample_every` is timed, along with the special actions it carries out, so that metrics can be left on in production.
+#
+# The histograms are in the style of HDR histograms: each power of two of nanoseconds is split into 8 buckets, so every latency from a nanosecond to hours is kept to within 12.5% in a few dozen counters, and recording a latency is a couple of integer operations.  `Metrics.write` saves everything to a local file, either as JSON or in the Prometheus text format (for instance for the textfile collector of the node exporter).
+#
+# For finding out where the time goes, a `Capture` can also be attached to one game, to run each of its commands under `cProfile` and, optionally, to trace the memory they allocate with `tracemalloc`.  This is much slower and meant for one session at a time.
+#
+# Usage: `python -m instrument [--world W] [--steps N] [--sample-every N] [--output metrics.prom] [--profile] [--memory]` plays random commands in an instrumented game and writes the metrics, or `--world instrument:build_game` for the other tools.
+
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+from action_castle import build_game as build_action_castle
+from replay import DEFAULT_WORLD, load_factory
+
+# The number of buckets that each power of two is split into, as a power of
+# two: 3 bits gives 8 buckets, each at most 12.5% wide.
+PRECISION = 3
+# The upper bounds, in seconds, of the buckets of exported Prometheus
+# histograms
+EXPORT_BOUNDS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+                 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+# The quantiles given for each histogram in JSON
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+# The prefix of the names of exported Prometheus metrics
+PREFIX = "adventure_"
+
+
+def bucket(value):
+  """Returns the number of the histogram bucket that a value in
+     nanoseconds falls in."""
+  if value < 2 << PRECISION:
+    return value
+  shift = value.bit_length() - PRECISION - 1
+  return (shift << PRECISION) + (value >> shift)
+
+
+def bucket_bounds(number):
+  """Returns the least and greatest values in a bucket."""
+  if number < 2 << PRECISION:
+    return number, number
+  shift = (number >> PRECISION) - 1
+  mantissa = (number & ((1 << PRECISION) - 1)) | (1 << PRECISION)
+  return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+
+class Histogram:
+  """A histogram of latencies in nanoseconds, with buckets of roughly equal
+     relative width."""
+  def __init__(self):
+    # Dictionary mapping from the number of each bucket that has a latency
+    # in it to how many it has
+    self.buckets = {}
+    self.count = 0
+    self.total = 0
+    self.max = 0
+
+  def record(self, value):
+    number = bucket(value)
+    self.buckets[number] = self.buckets.get(number, 0) + 1
+    self.count += 1
+    self.total += value
+    if value > self.max:
+      self.max = value
+
+  def merge(self, other):
+    """Adds the latencies of another histogram to this one."""
+    for number, count in other.buckets.items():
+      self.buckets[number] = self.buckets.get(number, 0) + count
+    self.count += other.count
+    self.total += other.total
+    self.max = max(self.max, other.max)
+
+  def quantile(self, q):
+    """Returns the latency that a fraction q of the latencies are at most,
+       as the greatest value of its bucket (but never more than the
+       maximum)."""
+    if not self.count:
+      return 0
+    rank = q * self.count
+    seen = 0
+    for number in sorted(self.buckets):
+      seen += self.buckets[number]
+      if seen >= rank:
+        return min(bucket_bounds(number)[1], self.max)
+    return self.max
+
+  def cumulative(self, bounds):
+    """Returns the number of latencies at most each of a list of bounds, in
+       nanoseconds, to within the width of the buckets."""
+    counts = [0] * len(bounds)
+    for number, count in self.buckets.items():
+      greatest = bucket_bounds(number)[1]
+      for i, bound in enumerate(bounds):
+        if greatest <= bound:
+          counts[i] += count
+    return counts
+
+  def summary(self):
+    """Returns the count, mean, quantiles and maximum in seconds."""
+    summary = {"count": self.count,
+               "mean": self.total / self.count / 1e9 if self.count else 0.0,
+               "max": self.max / 1e9}
+    for q in QUANTILES:
+      summary["p%g" % (q * 100)] = self.quantile(q) / 1e9
+    return summary
+
+
+class Metrics:
+  """Counters and latency histograms of the commands, special actions and
+     precondition checks of the games attached to it.  One command in every
+     sample_every is timed."""
+  def __init__(self, sample_every=1, clock=time.perf_counter_ns):
+    self.sample_every = sample_every
+    self.clock = clock
+    # Dictionaries mapping from each intent (None for commands that weren't
+    # understood) to the number of commands, and to the Histogram of the
+    # commands that were timed
+    self.commands = {}
+    self.command_latency = {}
+    # The same for the special actions, by their function.  They are only
+    # counted up by the name of the function when exporting.
+    self.actions = {}
+    self.action_latency = {}
+    # Dictionary mapping from the Preconditions kept by the world to the
+    # number of times they were checked.  They are only counted up by kind
+    # when exporting.
+    self.checks = {}
+    # Dictionary mapping from the tuple of kinds of other Preconditions,
+    # which are compiled for one check and thrown away, to the number of
+    # times they were checked
+    self.check_kinds = {}
+    # The number of comma separated sequences run.  Their parts are counted
+    # as commands.
+    self.sequences = 0
+    # The number of commands left to run before the next one is timed
+    self.countdown = 0
+    # Whether the command running now is being timed
+    self.timing = False
+    self.started = time.time()
+
+  def time_command(self, parser, command):
+    """Runs a command for Parser.run_command, counting it by intent and
+       timing it if it is sampled.  Returns the intent and whether it ended
+       the game."""
+    capture = parser.game.capture
+    if self.countdown and capture is None:
+      self.countdown -= 1
+      intent, end_game = parser.dispatch(command)
+      self.count_command(intent)
+      return intent, end_game
+    self.countdown = self.sample_every - 1
+    # Commands can run other commands (a sequence runs each of its parts),
+    # so put back whether the outer command is being timed afterwards.
+    timing = self.timing
+    self.timing = True
+    if capture is not None and not timing:
+      capture.start()
+    start = self.clock()
+    try:
+      intent, end_game = parser.dispatch(command)
+    finally:
+      elapsed = self.clock() - start
+      if capture is not None and not timing:
+        capture.stop()
+      self.timing = timing
+    self.count_command(intent)
+    histogram = self.command_latency.get(intent)
+    if histogram is None:
+      histogram = self.command_latency[intent] = Histogram()
+    histogram.record(elapsed)
+    return intent, end_game
+
+  def count_command(self, intent):
+    """Counts a command that ran with an intent."""
+    if intent == "sequence":
+      self.sequences += 1
+    else:
+      commands = self.commands
+      commands[intent] = commands.get(intent, 0) + 1
+
+  def count_check(self, preconditions):
+    """Counts a check of compiled preconditions."""
+    if preconditions.kept:
+      checks = self.checks
+      checks[preconditions] = checks.get(preconditions, 0) + 1
+    else:
+      kinds = tuple(preconditions.preconditions)
+      self.check_kinds[kinds] = self.check_kinds.get(kinds, 0) + 1
+
+  def time_action(self, game, function, arguments):
+    """Calls the function of a special action for Game.run_action, counting
+       it and timing it if the command that runs it is being timed."""
+    actions = self.actions
+    actions[function] = actions.get(function, 0) + 1
+    if not self.timing:
+      return function(game, arguments)
+    start = self.clock()
+    try:
+      return function(game, arguments)
+    finally:
+      elapsed = self.clock() - start
+      histogram = self.action_latency.get(function)
+      if histogram is None:
+        histogram = self.action_latency[function] = Histogram()
+      histogram.record(elapsed)
+
+  def action_counts(self):
+    """Returns a dictionary mapping from the name of each action function
+       to the number of times it was called."""
+    counts = {}
+    for function, count in self.actions.items():
+      name = function_name(function)
+      counts[name] = counts.get(name, 0) + count
+    return counts
+
+  def action_latencies(self):
+    """Returns a dictionary mapping from the name of each action function
+       to the Histogram of its latencies."""
+    latencies = {}
+    for function, histogram in self.action_latency.items():
+      name = function_name(function)
+      if name not in latencies:
+        latencies[name] = Histogram()
+      latencies[name].merge(histogram)
+    return latencies
+
+  def check_counts(self):
+    """Returns a dictionary mapping from each kind of precondition to the
+       number of times one was checked."""
+    counts = {}
+    for preconditions, count in self.checks.items():
+      for kind in preconditions.preconditions:
+        counts[kind] = counts.get(kind, 0) + count
+    for kinds, count in self.check_kinds.items():
+      for kind in kinds:
+        counts[kind] = counts.get(kind, 0) + count
+    return counts
+
+  def reset(self):
+    """Forgets everything recorded so far."""
+    self.__init__(self.sample_every, self.clock)
+
+  def to_dict(self):
+    """Returns everything recorded, with latencies in seconds, as a
+       dictionary that can be saved as JSON."""
+    return {"started": self.started,
+            "sample_every": self.sample_every,
+            "commands": {str(intent): count for intent, count in self.commands.items()},
+            "sequences": self.sequences,
+            "command_latency": {str(intent): histogram.summary()
+                                for intent, histogram in self.command_latency.items()},
+            "actions": self.action_counts(),
+            "action_latency": {name: histogram.summary()
+                               for name, histogram in self.action_latencies().items()},
+            "precondition_checks": self.check_counts(),
+            "precondition_evaluations": (sum(self.checks.values()) +
+                                         sum(self.check_kinds.values()))}
+
+  def to_prometheus(self):
+    """Returns everything recorded in the Prometheus text format."""
+    lines = []
+    def counter(name, help_text, label, counts):
+      lines.append("# HELP %s%s %s" % (PREFIX, name, help_text))
+      lines.append("# TYPE %s%s counter" % (PREFIX, name))
+      for key in sorted(counts, key=str):
+        lines.append('%s%s{%s="%s"} %d' % (PREFIX, name, label, escape(key), counts[key]))
+    def histograms(name, help_text, label, latencies):
+      bounds = [round(bound * 1e9) for bound in EXPORT_BOUNDS]
+      lines.append("# HELP %s%s %s" % (PREFIX, name, help_text))
+      lines.append("# TYPE %s%s histogram" % (PREFIX, name))
+      for key in sorted(latencies, key=str):
+        histogram = latencies[key]
+        labels = '%s="%s"' % (label, escape(key))
+        for bound, count in zip(EXPORT_BOUNDS, histogram.cumulative(bounds)):
+          lines.append('%s%s_bucket{%s,le="%g"} %d' % (PREFIX, name, labels, bound, count))
+        lines.append('%s%s_bucket{%s,le="+Inf"} %d' % (PREFIX, name, labels, histogram.count))
+        lines.append("%s%s_sum{%s} %.9f" % (PREFIX, name, labels, histogram.total / 1e9))
+        lines.append("%s%s_count{%s} %d" % (PREFIX, name, labels, histogram.count))
+    counter("commands_total", "Commands run, by intent.", "intent", self.commands)
+    lines.append("# HELP %ssequences_total Comma separated sequences of "
+                 "commands run." % PREFIX)
+    lines.append("# TYPE %ssequences_total counter" % PREFIX)
+    lines.append("%ssequences_total %d" % (PREFIX, self.sequences))
+    histograms("command_seconds", "Latency of sampled commands, by intent.",
+               "intent", self.command_latency)
+    counter("actions_total", "Special actions carried out, by function.",
+            "function", self.action_counts())
+    histograms("action_seconds", "Latency of the special actions of sampled "
+               "commands, by function.", "function", self.action_latencies())
+    counter("precondition_checks_total", "Preconditions checked, by kind.",
+            "kind", self.check_counts())
+    return "\n".join(lines) + "\n"
+
+  def write(self, path, format=None):
+    """Saves everything recorded to a file, as JSON or in the Prometheus
+       text format ("json" or "prometheus"; by default, JSON unless the
+       file name ends in .prom).  The file is replaced at once, so readers
+       never see half of it."""
+    if format is None:
+      format = "prometheus" if path.endswith(".prom") else "json"
+    if format == "json":
+      text = json.dumps(self.to_dict(), indent=1, sort_keys=True)
+    elif format == "prometheus":
+      text = self.to_prometheus()
+    else:
+      raise ValueError("unknown metrics format %r" % format)
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+      f.write(text)
+    os.replace(temporary, path)
+
+
+def function_name(function):
+  return getattr(function, "__name__", None) or repr(function)
+
+
+def escape(value):
+  """Escapes a label value for the Prometheus text format."""
+  return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+          .replace("\n", "\\n"))
+
+
+class Capture:
+  """Profiles the commands of one game with cProfile and, if memory is
+     True, traces the memory they allocate with tracemalloc."""
+  def __init__(self, memory=False):
+    self.profile = cProfile.Profile()
+    self.memory = memory
+    # Whether tracemalloc was started here, so that it is stopped here
+    self.tracing = False
+    # The memory traced when the current command started, in bytes
+    self.baseline = 0
+    # The number of commands profiled and the most memory that any of them
+    # allocated, in bytes
+    self.commands = 0
+    self.peak = 0
+
+  def start(self):
+    if self.memory:
+      if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        self.tracing = True
+      tracemalloc.reset_peak()
+      self.baseline = tracemalloc.get_traced_memory()[0]
+    self.profile.enable()
+
+  def stop(self):
+    self.profile.disable()
+    self.commands += 1
+    if self.memory:
+      self.peak = max(self.peak, tracemalloc.get_traced_memory()[1] - self.baseline)
+
+  def report(self, limit=20):
+    """Returns the functions that took the most time, and the lines that
+       hold the most memory allocated while tracing, as text."""
+    snapshot = None
+    if self.memory and tracemalloc.is_tracing():
+      # Leave out what the profilers themselves allocated.
+      snapshot = tracemalloc.take_snapshot().filter_traces(
+          [tracemalloc.Filter(False, module.__file__)
+           for module in (cProfile, pstats, tracemalloc)])
+    text = io.StringIO()
+    text.write("%d commands profiled\n" % self.commands)
+    pstats.Stats(self.profile, stream=text).sort_stats("cumulative").print_stats(limit)
+    if snapshot is not None:
+      text.write("Most memory allocated by one command: %d bytes\n" % self.peak)
+      for statistic in snapshot.statistics("lineno")[:limit]:
+        text.write("%s\n" % statistic)
+    return text.getvalue()
+
+  def close(self):
+    """Stops tracing memory if it was started here."""
+    if self.tracing:
+      tracemalloc.stop()
+      self.tracing = False
+
+
+class Instrumented:
+  """Mixin for game classes that records special actions and precondition
+     checks in the game's metrics."""
+  def check(self, preconditions, print_failure_reasons=True):
+    self.metrics.count_check(preconditions)
+    return super().check(preconditions, print_failure_reasons)
+
+  def run_action(self, function, arguments):
+    return self.metrics.time_action(self, function, arguments)
+
+  def fork(self, output=None):
+    game = super().fork(output)
+    # Captures are for one session, so forks aren't profiled.
+    game.capture = None
+    return game
+
+
+# The instrumented class of each game class
+INSTRUMENTED_CLASSES = {}
+
+def instrumented_class(game_class):
+  """Returns a subclass of a game class with the Instrumented mixin."""
+  if issubclass(game_class, Instrumented):
+    return game_class
+  instrumented = INSTRUMENTED_CLASSES.get(game_class)
+  if instrumented is None:
+    instrumented = INSTRUMENTED_CLASSES[game_class] = type(
+        "Instrumented" + game_class.__name__, (Instrumented, game_class), {})
+  return instrumented
+
+
+# The metrics that games are attached to unless they're given their own
+METRICS = Metrics()
+
+def attach(game, metrics=None, capture=None):
+  """Starts recording the commands of a game (of any game class) in
+     metrics, and profiling them with capture if it isn't None.  Returns
+     the game."""
+  game.__class__ = instrumented_class(type(game))
+  game.metrics = metrics if metrics is not None else METRICS
+  game.capture = capture
+  return game
+
+
+def build_game(output=None):
+  """Starts a new game of Action Castle that records its commands in
+     METRICS."""
+  return attach(build_action_castle(output))
+
+
+def main(argv=None):
+  # env imports the engine too, so import it here rather than at the top.
+  from env import GameEnv, benchmark
+  arguments = argparse.ArgumentParser(description="Record metrics of random play.")
+  arguments.add_argument("--world", default=DEFAULT_WORLD,
+                         help="module:function that starts a new game")
+  arguments.add_argument("--steps", type=int, default=100000)
+  arguments.add_argument("--sample-every", type=int, default=1,
+                         help="time one command in every N")
+  arguments.add_argument("--output", help="write the metrics to this file "
+                         "(in the Prometheus text format if it ends in .prom)")
+  arguments.add_argument("--format", choices=("json", "prometheus"))
+  arguments.add_argument("--profile", action="store_true",
+                         help="profile every command with cProfile")
+  arguments.add_argument("--memory", action="store_true",
+                         help="trace memory with tracemalloc while profiling")
+  args = arguments.parse_args(argv)
+  factory = load_factory(args.world)
+  metrics = Metrics(args.sample_every)
+  capture = Capture(args.memory) if args.profile or args.memory else None
+  plain = benchmark(GameEnv(factory), args.steps)
+  instrumented = benchmark(GameEnv(
+      lambda output: attach(factory(output), metrics, capture)),
+      args.steps)
+  print("%.0f steps/sec without metrics, %.0f steps/sec with them." % (
+      plain, instrumented))
+  for intent, summary in sorted(metrics.to_dict()["command_latency"].items()):
+    print("%-12s %8d commands  p50 %8.1f us  p99 %8.1f us" % (
+        intent, summary["count"], summary["p50"] * 1e6, summary["p99"] * 1e6))
+  if capture is not None:
+    print(capture.report())
+    capture.close()
+  if args.output:
+    metrics.write(args.output, args.format)
+
+
+if __name__ == "__main__":
+  main()
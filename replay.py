@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Replaying transcripts
+# A transcript is a text file with one command per line, like `playthrough.txt`.  Replaying it runs each command through `Parser.parse_command` in a fresh game and compares what the player sees after every command, and whether it ended the game, with a golden file recorded earlier.  The golden file for `foo.txt` is `foo.txt.golden.json`.
+#
+# Transcripts are replayed in parallel in a pool of worker processes.  Each worker imports the game and builds its world once, when it starts, and then replays many transcripts.
+#
+# Usage:
+#
+#     python -m replay --record transcripts/*.txt    # write the golden files
+#     python -m replay transcripts/*.txt             # check against them
+#     python -m replay --world my_game:build_game playthrough.txt
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from action_castle import BufferedOutput, Parser
+
+DEFAULT_WORLD = "action_castle:build_game"
+
+# The function that starts a new game, loaded once in each worker process.
+game_factory = None
+
+
+def load_factory(world):
+  """Returns the function named by a "module:function" string."""
+  module_name, function_name = world.split(":")
+  return getattr(importlib.import_module(module_name), function_name)
+
+
+def start_worker(world):
+  """Runs once in each worker process, before it replays any transcripts."""
+  global game_factory
+  game_factory = load_factory(world)
+
+
+def golden_path(transcript):
+  return transcript + ".golden.json"
+
+
+def read_commands(transcript):
+  with open(transcript) as f:
+    return [line.strip() for line in f if line.strip()]
+
+
+def play(commands):
+  """Plays the commands in a new game until one of them ends it.  Returns
+     the text shown at the start of the game and a list of steps, each a
+     dictionary with the command, the text shown after it, and whether it
+     ended the game."""
+  game = game_factory()
+  output = game.output = BufferedOutput()
+  parser = Parser(game)
+  game.describe()
+  intro = output.getvalue()
+  steps = []
+  for command in commands:
+    output.clear()
+    end_game = bool(parser.parse_command(command))
+    steps.append({"command": command, "output": output.getvalue(),
+                  "end_game": end_game})
+    if end_game:
+      break
+  return intro, steps
+
+
+def record(transcript):
+  """Replays a transcript and writes its golden file.  Returns the same
+     kind of tuple as check."""
+  intro, steps = play(read_commands(transcript))
+  with open(golden_path(transcript), "w") as f:
+    json.dump({"intro": intro, "steps": steps}, f, indent=1)
+  return transcript, len(steps), None
+
+
+def check(transcript):
+  """Replays a transcript and compares it with its golden file.  Returns
+     the transcript, the number of commands played and a description of the
+     first difference (or None if there are no differences)."""
+  try:
+    with open(golden_path(transcript)) as f:
+      golden = json.load(f)
+  except FileNotFoundError:
+    return transcript, 0, "no golden file; run with --record"
+  intro, steps = play(read_commands(transcript))
+  if intro != golden["intro"]:
+    return transcript, len(steps), "the text at the start of the game differs"
+  for number, (step, expected) in enumerate(zip(steps, golden["steps"]), 1):
+    if step != expected:
+      return transcript, len(steps), "command %d (%r) differs:\n--- expected\n%s--- got\n%s" % (
+          number, step["command"], format_step(expected), format_step(step))
+  if len(steps) != len(golden["steps"]):
+    return transcript, len(steps), "played %d commands, expected %d" % (
+        len(steps), len(golden["steps"]))
+  return transcript, len(steps), None
+
+
+def format_step(step):
+  text = step["output"]
+  if step["end_game"]:
+    text += "[the game ended]\n"
+  return text
+
+
+def replay(transcripts, world=DEFAULT_WORLD, record_golden=False, jobs=None):
+  """Replays the transcripts in a pool of worker processes.  Returns a list
+     of (transcript, commands played, difference) tuples and the number of
+     commands played per second."""
+  task = record if record_golden else check
+  jobs = jobs or os.cpu_count() or 1
+  chunksize = max(1, len(transcripts) // (jobs * 4))
+  start = time.perf_counter()
+  with ProcessPoolExecutor(jobs, initializer=start_worker,
+                           initargs=(world,)) as pool:
+    results = list(pool.map(task, transcripts, chunksize=chunksize))
+  elapsed = time.perf_counter() - start
+  commands = sum(result[1] for result in results)
+  return results, commands / elapsed if elapsed else 0.0
+
+
+def main(argv=None):
+  arguments = argparse.ArgumentParser(description="Replay transcripts against golden files.")
+  arguments.add_argument("transcripts", nargs="+")
+  arguments.add_argument("--world", default=DEFAULT_WORLD,
+                         help="module:function that starts a new game")
+  arguments.add_argument("--record", action="store_true",
+                         help="write the golden files instead of checking them")
+  arguments.add_argument("--jobs", type=int, default=None,
+                         help="number of worker processes (default: all cores)")
+  args = arguments.parse_args(argv)
+
+  results, commands_per_second = replay(args.transcripts, args.world,
+                                        args.record, args.jobs)
+  failures = [result for result in results if result[2]]
+  for transcript, commands, difference in failures:
+    print("FAIL %s: %s" % (transcript, difference))
+  commands = sum(result[1] for result in results)
+  print("%d transcripts, %d commands, %d failed, %.0f commands/sec" % (
+      len(results), commands, len(failures), commands_per_second))
+  return 1 if failures else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Game server
+# An asyncio server that lets many players play at once over TCP.  Every connection gets its own `Game` and `Parser` (all sharing one world template), so one process can host thousands of players.  The protocol is line based: the player sends one command per line, and the server answers with what the player sees followed by the prompt `"> "`, just like the game loop.  You can play with `telnet localhost 8023` or `nc localhost 8023`.
+#
+# Commands take microseconds, so they run directly on the event loop.  What can block is the network, so:
+# * each session is closed after `idle_timeout` seconds without a command,
+# * commands longer than `max_line` bytes close the session,
+# * the server waits for each response to drain before reading the next command, so a slow reader can't make output pile up in memory.
+#
+# The load test opens many connections to a running server, plays commands on all of them at once, and reports the p50 and p99 latency of a command.
+#
+# Usage:
+#
+#     python -m server                          # serve on localhost:8023
+#     python -m server --load-test 2000         # 2000 players against that server
+#
+# Opening thousands of connections may need a higher limit on open files (`ulimit -n`).
+
+import argparse
+import asyncio
+import time
+
+from action_castle import BufferedOutput, Parser
+from replay import DEFAULT_WORLD, load_factory
+
+PROMPT = b"> "
+
+# Commands played by each connection in the load test (none of them ends
+# the game).
+LOAD_TEST_COMMANDS = ["look", "take pole", "go out", "pick rose", "inventory",
+                      "go south", "catch fish with pole", "examine pond",
+                      "go north", "go north", "go up", "take branch"]
+
+
+class GameServer:
+  """Serves a game to every player that connects."""
+  def __init__(self, world=DEFAULT_WORLD, idle_timeout=300, max_line=1024,
+               write_buffer=64 * 1024):
+    # The function that starts a new game
+    self.game_factory = load_factory(world)
+    # Seconds that a session can be idle before it is closed
+    self.idle_timeout = idle_timeout
+    # The longest command that a player can send, in bytes
+    self.max_line = max_line
+    # High water mark of each connection's output buffer, in bytes
+    self.write_buffer = write_buffer
+    # The number of sessions being played right now
+    self.sessions = 0
+
+  async def start(self, host="localhost", port=8023):
+    """Start listening for players.  Returns the asyncio server."""
+    return await asyncio.start_server(self.play, host, port,
+                                      limit=self.max_line, backlog=4096)
+
+  async def play(self, reader, writer):
+    """Plays one session of the game with the player on this connection."""
+    writer.transport.set_write_buffer_limits(high=self.write_buffer)
+    self.sessions += 1
+    game = self.game_factory()
+    game.keep_journal()
+    output = game.output = BufferedOutput()
+    parser = Parser(game)
+    try:
+      game.describe()
+      await self.send(writer, output)
+      while True:
+        try:
+          line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        except asyncio.TimeoutError:
+          writer.write(b"\nYou have been idle for too long.\n")
+          break
+        except ValueError:
+          # The command was longer than max_line.
+          writer.write(b"That command is too long.\n")
+          break
+        if not line:
+          # The player hung up.
+          break
+        command = line.decode("utf-8", "replace").strip()
+        if command.lower() in ("exit", "q"):
+          break
+        if parser.parse_command(command):
+          output.write("THE GAME HAS ENDED.\n")
+          await self.send(writer, output, prompt=False)
+          break
+        await self.send(writer, output)
+    except ConnectionError:
+      pass
+    finally:
+      self.sessions -= 1
+      writer.close()
+
+  async def send(self, writer, output, prompt=True):
+    """Sends the text collected in the output buffer to the player, and
+       waits until the connection can take more."""
+    writer.write(output.getvalue().encode("utf-8"))
+    if prompt:
+      writer.write(PROMPT)
+    output.clear()
+    await writer.drain()
+
+
+async def serve(host, port, world):
+  server = await GameServer(world).start(host, port)
+  print("Serving on %s:%d" % (host, port))
+  async with server:
+    await server.serve_forever()
+
+
+# ## Load testing
+
+async def load_test_client(host, port, commands, latencies):
+  """Plays the commands on one connection, adding the latency of each one
+     (in seconds) to latencies."""
+  reader, writer = await asyncio.open_connection(host, port)
+  try:
+    await reader.readuntil(PROMPT)
+    for command in commands:
+      start = time.perf_counter()
+      writer.write(command.encode("utf-8") + b"\n")
+      await writer.drain()
+      await reader.readuntil(PROMPT)
+      latencies.append(time.perf_counter() - start)
+  finally:
+    writer.close()
+
+
+async def load_test(host, port, clients, commands=LOAD_TEST_COMMANDS):
+  """Opens a connection per client and plays the commands on all of them at
+     once.  Returns a dictionary with the number of commands, the commands
+     per second and the p50 and p99 latency in milliseconds."""
+  latencies = []
+  start = time.perf_counter()
+  results = await asyncio.gather(
+      *[load_test_client(host, port, commands, latencies)
+        for _ in range(clients)],
+      return_exceptions=True)
+  elapsed = time.perf_counter() - start
+  latencies.sort()
+  def percentile(p):
+    if not latencies:
+      return 0.0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+  return {"clients": clients,
+          "failed_clients": sum(isinstance(r, Exception) for r in results),
+          "commands": len(latencies),
+          "commands_per_second": len(latencies) / elapsed,
+          "p50_ms": percentile(0.50),
+          "p99_ms": percentile(0.99)}
+
+
+def main(argv=None):
+  arguments = argparse.ArgumentParser(description="Serve the game over TCP.")
+  arguments.add_argument("--host", default="localhost")
+  arguments.add_argument("--port", type=int, default=8023)
+  arguments.add_argument("--world", default=DEFAULT_WORLD,
+                         help="module:function that starts a new game")
+  arguments.add_argument("--load-test", type=int, metavar="CLIENTS",
+                         help="run a load test against a running server")
+  args = arguments.parse_args(argv)
+  if args.load_test:
+    report = asyncio.run(load_test(args.host, args.port, args.load_test))
+    print("%(clients)d clients (%(failed_clients)d failed), %(commands)d commands, "
+          "%(commands_per_second).0f commands/sec, "
+          "p50 %(p50_ms).2f ms, p99 %(p99_ms).2f ms" % report)
+  else:
+    try:
+      asyncio.run(serve(args.host, args.port, args.world))
+    except KeyboardInterrupt:
+      pass
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Solving your game
+# The solver does a breadth-first search over the states of a game to find the shortest sequence of commands that wins it.  The moves it tries from each state are the exits of the current location, taking and dropping items, and the special commands of the items in scope.  Every move is played on a silent fork of the game, so the solver follows exactly the same rules as a player would.  States are deduplicated by a key that ignores things that don't affect play (like the order of the inventory, or which locations have been visited).
+#
+# Because the search is exhaustive, it can also prove that a game cannot be won from some state, like after attacking the troll.
+#
+# From the command line, `python -m solver` prints the shortest winning sequence for Action Castle.
+
+from collections import deque
+
+from action_castle import Parser, build_game
+from bitset import BitsetGame
+
+
+def won(game, end_game):
+  """The default goal: the game ended with the player winning."""
+  return end_game and game.has_won
+
+
+def state_key(game):
+  """Returns a hashable key for the state of the game.  Two games with the
+     same key behave the same way for every command the player can type."""
+  if isinstance(game, BitsetGame):
+    return game.state_key()
+  (curr_location, inventory, location_items, flags, is_married,
+   princess_has, visited, has_won) = game.get_state()
+  locations = game.world.locations
+  items = game.world.items
+  placed = []
+  for l, ids in location_items:
+    ids = frozenset(ids)
+    # Skip locations that still have their starting items.
+    if ids != frozenset(game.world.item_ids[item] 
+                        for item in locations[l].items.values()):
+      placed.append((l, ids))
+  flags = frozenset((i, flag, value) for i, flag, value in flags
+                    if value != items[i].get_flag(flag))
+  return (curr_location, frozenset(inventory), frozenset(placed), flags,
+          is_married, frozenset(princess_has))
+
+
+def moves(game, drops=False):
+  """Returns the commands worth trying in the current state of the game.
+     Dropping items is only tried if drops is True, since it multiplies 
+     the number of states (every item can end up in every location) and 
+     nothing in the engine ever requires it."""
+  commands = []
+  for direction in game.curr_location.connections:
+    commands.append("go " + direction)
+  for item in game.items_at().values():
+    if item.gettable:
+      commands.append("take " + item.name)
+  if drops:
+    for item_name in game.inventory:
+      commands.append("drop " + item_name)
+  for entries in game.command_index.values():
+    commands.append(entries[0][1])
+  return commands
+
+
+def play(game, command):
+  """Plays a command on a silent fork of the game.  Returns the fork and 
+     whether the command ended the game."""
+  game = game.fork()
+  end_game = Parser(game).parse_command(command)
+  return game, end_game
+
+
+def solve(game, goal=won, max_states=None, drops=False):
+  """Returns the shortest list of commands that reaches the goal from the
+     current state of the game, or None if the goal can't be reached.  The
+     goal is a function of the game and whether the last command ended it.
+     If max_states is given, give up (and return None) after visiting that
+     many states.  Dropping items is only tried if drops is True."""
+  start = game.fork()
+  visited = {state_key(start): None}
+  # Each entry in the frontier is a game and the key of its state.
+  frontier = deque([(start, state_key(start))])
+  # Dictionary mapping from a state key to the (previous key, command) pair
+  # that first reached it.
+  parents = {}
+  while frontier:
+    current, key = frontier.popleft()
+    for command in moves(current, drops):
+      next_game, end_game = play(current, command)
+      if goal(next_game, end_game):
+        path = [command]
+        while key in parents:
+          key, command = parents[key]
+          path.append(command)
+        return path[::-1]
+      if end_game:
+        continue
+      next_key = state_key(next_game)
+      if next_key in visited:
+        continue
+      visited[next_key] = None
+      parents[next_key] = (key, command)
+      if max_states and len(visited) >= max_states:
+        return None
+      frontier.append((next_game, next_key))
+  return None
+
+
+def is_dead_end(game, commands, goal=won, drops=False):
+  """Returns True if the goal can no longer be reached after playing the 
+     commands, either because they end the game without reaching the goal
+     or because no sequence of commands reaches it from there."""
+  for command in commands:
+    game, end_game = play(game, command)
+    if goal(game, end_game):
+      return False
+    if end_game:
+      return True
+  return solve(game, goal, drops=drops) is None
+
+
+def dead_ends(game, goal=won, drops=False):
+  """Explores every state that can be reached from the current state of the
+     game, and returns the moves that make the goal unreachable.  Each dead
+     end is a (commands, command) pair: the shortest commands that reach a
+     state where the goal can still be reached, and the command that then
+     makes it unreachable."""
+  start = game.fork()
+  start_key = state_key(start)
+  # The shortest commands reaching each state, and its outgoing moves as
+  # (command, next key) pairs.  The next key is "goal" when the move 
+  # reaches the goal and None when it ends the game otherwise.
+  paths = {start_key: []}
+  edges = {}
+  frontier = deque([(start, start_key)])
+  while frontier:
+    current, key = frontier.popleft()
+    edges[key] = []
+    for command in moves(current, drops):
+      next_game, end_game = play(current, command)
+      if goal(next_game, end_game):
+        edges[key].append((command, "goal"))
+        continue
+      if end_game:
+        edges[key].append((command, None))
+        continue
+      next_key = state_key(next_game)
+      edges[key].append((command, next_key))
+      if next_key not in paths:
+        paths[next_key] = paths[key] + [command]
+        frontier.append((next_game, next_key))
+
+  # Work backwards from the goal to find every state that can reach it.
+  reverse = {}
+  winnable = set()
+  pending = []
+  for key, moves_from_key in edges.items():
+    for command, next_key in moves_from_key:
+      if next_key == "goal":
+        if key not in winnable:
+          winnable.add(key)
+          pending.append(key)
+      elif next_key is not None:
+        reverse.setdefault(next_key, []).append(key)
+  while pending:
+    key = pending.pop()
+    for previous_key in reverse.get(key, []):
+      if previous_key not in winnable:
+        winnable.add(previous_key)
+        pending.append(previous_key)
+
+  found = []
+  for key in winnable:
+    for command, next_key in edges[key]:
+      if next_key != "goal" and next_key not in winnable:
+        found.append((paths[key], command))
+  found.sort(key=lambda dead_end: (len(dead_end[0]), dead_end))
+  return found
+
+
+if __name__ == "__main__":
+  solution = solve(build_game())
+  if solution is None:
+    print("Action Castle cannot be won.")
+  else:
+    print("Action Castle can be won in %d commands:" % len(solution))
+    for command in solution:
+      print("  " + command)
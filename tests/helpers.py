@@ -0,0 +1,53 @@
+from action_castle import BufferedOutput, Parser
+from env import GameEnv, random_command
+
+
+def canonical_state(game):
+  """Returns the state of a game from get_state, with the parts that can
+     come out in a different order (or that say nothing has changed) put 
+     into a canonical form, so that two games in the same state compare
+     equal."""
+  (curr_location, inventory, location_items, flags, is_married,
+   princess_has, visited, has_won) = game.get_state()
+  world = game.world
+  placed = frozenset(
+      (l, frozenset(ids)) for l, ids in location_items
+      if frozenset(ids) != frozenset(world.item_ids[item] for item 
+                                     in world.locations[l].items.values()))
+  flags = frozenset((i, flag, value) for i, flag, value in flags
+                    if value != world.items[i].get_flag(flag))
+  return (curr_location, frozenset(inventory), placed, flags, is_married,
+          tuple(sorted(princess_has)), frozenset(visited), has_won)
+
+
+def random_commands(factory, steps, seed):
+  """Returns a list of random commands that make sense when played in 
+     order in a new game, starting new games when they end (with None)."""
+  env = GameEnv(factory)
+  observation, info = env.reset(seed)
+  commands = []
+  for _ in range(steps):
+    command = random_command(env, observation)
+    commands.append(command)
+    observation, reward, done, info = env.step(command)
+    if done:
+      commands.append(None)
+      observation, info = env.reset()
+  return commands
+
+
+def transcript(factory, commands):
+  """Plays commands (None starts a new game) and returns the text shown
+     after each one."""
+  texts = []
+  game = parser = None
+  for command in [None] + commands:
+    if command is None:
+      game = factory(BufferedOutput())
+      parser = Parser(game)
+      game.describe()
+    else:
+      parser.parse_command(command)
+    texts.append(game.output.getvalue())
+    game.output.clear()
+  return texts
@@ -0,0 +1,44 @@
+import pytest
+
+from action_castle import BufferedOutput, Parser, build_game, check_preconditions
+from bitset import build_game as build_bitset_game
+from helpers import canonical_state, random_commands, transcript
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_bitset_game_plays_like_game(seed):
+  commands = random_commands(build_game, 2000, seed)
+  assert transcript(build_bitset_game, commands) == transcript(build_game, commands)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_bitset_game_has_the_same_state(seed):
+  games = [build_game(BufferedOutput()), build_bitset_game(BufferedOutput())]
+  parsers = [Parser(game) for game in games]
+  for command in random_commands(build_game, 500, seed):
+    if command is None:
+      break
+    for parser in parsers:
+      parser.parse_command(command)
+    assert canonical_state(games[1]) == canonical_state(games[0])
+
+
+def test_bitset_state_restores_into_game():
+  bitset_game = build_bitset_game(BufferedOutput())
+  parser = Parser(bitset_game)
+  for command in ["take pole", "go out", "go south", "catch fish with pole",
+                  "go north", "pick rose", "light lamp"]:
+    parser.parse_command(command)
+  game = build_game(BufferedOutput())
+  game.restore(bitset_game.snapshot())
+  assert canonical_state(game) == canonical_state(bitset_game)
+
+
+def test_checking_a_dictionary_does_not_grow_the_layout():
+  game = build_bitset_game(BufferedOutput())
+  game.world.index()
+  lamp = next(item for item in game.world.items if item.name == "lamp")
+  before = len(game.layout.compiled)
+  for _ in range(100):
+    assert check_preconditions({"inventory_contains": lamp}, game, False)
+  assert len(game.layout.compiled) == before
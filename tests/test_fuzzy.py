@@ -0,0 +1,41 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from action_castle import BufferedOutput, Parser
+import fuzzy
+
+
+def game_at_the_troll():
+  game = fuzzy.build_game(BufferedOutput())
+  parser = Parser(game)
+  for command in ["take pole", "go out", "go south", "catch fish with pole",
+                  "go to drawbridge"]:
+    parser.parse_command(command)
+  assert game.curr_location.name == "Drawbridge"
+  game.output.clear()
+  return game, parser
+
+
+def test_near_misses_run_the_most_similar_command():
+  game, parser = game_at_the_troll()
+  parser.parse_command("give the fish to troll")
+  assert "The troll has taken the fish and left." in game.output.getvalue()
+
+
+@pytest.mark.parametrize("command", ["hit troll", "attack"])
+def test_commands_that_end_the_game_are_not_guessed(command):
+  game, parser = game_at_the_troll()
+  assert not parser.parse_command(command)
+  assert game.output.getvalue() == "I'm not sure what you want to do.\n"
+  assert parser.parse_command("attack troll")
+
+
+def test_undo_is_not_matched_fuzzily():
+  game, parser = game_at_the_troll()
+  game.keep_journal()
+  parser.parse_command("give fish to troll")
+  game.output.clear()
+  parser.parse_command("undo")
+  assert "You take back your last move." in game.output.getvalue()
+  assert "fish" in game.inventory
@@ -0,0 +1,34 @@
+from action_castle import BufferedOutput, Parser, build_game, check_preconditions
+import instrument
+
+
+def attached_game():
+  return instrument.attach(build_game(BufferedOutput()), instrument.Metrics())
+
+
+def test_metrics_can_be_set_without_attaching():
+  game = build_game(BufferedOutput())
+  game.metrics = instrument.Metrics()
+  Parser(game).parse_command("look")
+  assert game.metrics.commands == {"redescribe": 1}
+
+
+def test_checking_a_dictionary_does_not_grow_the_metrics():
+  game = attached_game()
+  for _ in range(1000):
+    check_preconditions({"is_married": True}, game, False)
+  metrics = game.metrics
+  assert len(metrics.checks) == 0
+  assert len(metrics.check_kinds) == 1
+  assert metrics.check_counts() == {"is_married": 1000}
+  assert metrics.to_dict()["precondition_evaluations"] == 1000
+
+
+def test_sequences_are_counted_apart_from_their_parts():
+  game = attached_game()
+  parser = Parser(game)
+  parser.parse_command("take pole, go out, look")
+  metrics = game.metrics
+  assert metrics.commands == {"take": 1, "direction": 1, "redescribe": 1}
+  assert metrics.sequences == 1
+  assert "adventure_sequences_total 1" in metrics.to_prometheus()
@@ -0,0 +1,138 @@
+import random
+
+import pytest
+
+from action_castle import HISTORY_SIZE, BufferedOutput, Parser, build_game
+from bitset import build_game as build_bitset_game
+from env import GameEnv, random_command
+from helpers import canonical_state
+from solver import solve, state_key
+
+FACTORIES = [build_game, build_bitset_game]
+
+
+def play_with_undo(factory, seed, steps=300, turns=100, checkpoint_every=7):
+  """Plays random commands in a game with a journal, undoing and going 
+     back at random, and checks that every earlier turn comes back exactly.
+     Returns the number of times it went back."""
+  env = GameEnv(factory)
+  observation, info = env.reset(seed)
+  game = env.game
+  journal = game.keep_journal(turns, checkpoint_every)
+  states = {0: canonical_state(game)}
+  keys = {0: state_key(game)}
+  random_numbers = random.Random(seed)
+  went_back = 0
+  for _ in range(steps):
+    roll = random_numbers.random()
+    if roll < 0.1 and journal.turn > journal.first_turn:
+      env.parser.parse_command("undo")
+      went_back += 1
+    elif roll < 0.15:
+      journal.go_back(random_numbers.randint(journal.first_turn, journal.turn))
+      went_back += 1
+    elif roll < 0.2:
+      turn = random_numbers.randint(journal.first_turn, journal.turn)
+      fork = journal.game_at(turn)
+      assert canonical_state(fork) == states[turn]
+      assert state_key(fork) == keys[turn]
+    else:
+      observation, reward, done, info = env.step(random_command(env, observation))
+      if done:
+        break
+      states[journal.turn] = canonical_state(game)
+      keys[journal.turn] = state_key(game)
+    assert canonical_state(game) == states[journal.turn]
+    assert state_key(game) == keys[journal.turn]
+    observation = env.observation()
+  return went_back
+
+
+@pytest.mark.parametrize("factory", FACTORIES)
+@pytest.mark.parametrize("seed", range(10))
+def test_undo_restores_every_turn(factory, seed):
+  play_with_undo(factory, seed)
+
+
+@pytest.mark.parametrize("factory", FACTORIES)
+def test_going_back_from_snapshots(factory, monkeypatch):
+  # Make restoring a snapshot look free, so going back always uses one.
+  monkeypatch.setattr("action_castle.RESTORE_COST", -1000)
+  assert sum(play_with_undo(factory, seed) for seed in range(5)) > 0
+
+
+@pytest.mark.parametrize("factory", FACTORIES)
+def test_undone_state_can_be_set(factory):
+  game = factory(BufferedOutput())
+  game.keep_journal()
+  parser = Parser(game)
+  start = game.get_state()
+  for command in ["take pole", "go out", "go south", "catch fish with pole",
+                  "go north", "pick rose"]:
+    parser.parse_command(command)
+  for _ in range(6):
+    parser.parse_command("undo")
+  assert game.journal.turn == 0
+  fresh = factory(BufferedOutput())
+  fresh.set_state(game.get_state())
+  assert state_key(fresh) == state_key(game)
+  assert canonical_state(fresh) == canonical_state(game)
+  unplayed = factory(BufferedOutput())
+  unplayed.set_state(start)
+  assert canonical_state(game) == canonical_state(unplayed)
+
+
+def test_undo_says_when_there_is_nothing_to_undo():
+  game = build_game(BufferedOutput())
+  parser = Parser(game)
+  parser.parse_command("undo")
+  assert game.output.getvalue() == "There is nothing to undo.\n"
+  game.keep_journal()
+  game.output.clear()
+  parser.parse_command("take pole")
+  parser.parse_command("undo")
+  assert "You take back your last move." in game.output.getvalue()
+  assert "pole" not in game.inventory
+  game.output.clear()
+  parser.parse_command("undo")
+  assert game.output.getvalue() == "There is nothing to undo.\n"
+
+
+def test_journal_and_history_are_bounded():
+  game = build_game(BufferedOutput())
+  journal = game.keep_journal(turns=20, checkpoint_every=5)
+  parser = Parser(game)
+  for _ in range(HISTORY_SIZE + 10):
+    parser.parse_command("look")
+  assert len(parser.command_history) == HISTORY_SIZE
+  assert len(journal.turns) == 20
+  assert all(turn >= journal.first_turn for turn in journal.checkpoints)
+  assert journal.undo(100) == 20
+
+
+def test_restoring_a_snapshot_starts_the_journal_again():
+  game = build_game(BufferedOutput())
+  journal = game.keep_journal()
+  parser = Parser(game)
+  snapshot = game.snapshot()
+  parser.parse_command("take pole")
+  game.restore(snapshot)
+  assert journal.undo() == 0
+  assert "pole" not in game.inventory
+
+
+@pytest.mark.parametrize("factory", FACTORIES)
+def test_undoing_the_winning_move(factory):
+  game = factory(BufferedOutput())
+  commands = solve(game)
+  journal = game.keep_journal()
+  parser = Parser(game)
+  for command in commands[:-1]:
+    parser.parse_command(command)
+  before = canonical_state(game)
+  assert parser.parse_command(commands[-1])
+  assert game.has_won
+  parser.parse_command("undo")
+  assert not game.has_won
+  assert canonical_state(game) == before
+  assert not journal.game_at(journal.turn).has_won
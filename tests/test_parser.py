@@ -0,0 +1,35 @@
+from action_castle import (BufferedOutput, Parser, build_game, build_world,
+                           describe_something)
+
+
+def test_taking_an_item_in_the_inventory_does_not_correct_typos(monkeypatch):
+  game = build_game(BufferedOutput())
+  parser = Parser(game)
+  parser.parse_command("take pole")
+  def correct_typos(command):
+    raise AssertionError("corrected %r" % command)
+  monkeypatch.setattr(parser, "correct_typos", correct_typos)
+  parser.parse_command("take pole")
+  assert game.output.getvalue().endswith("You already have the pole.\n")
+
+
+def test_taking_a_mistyped_item():
+  game = build_game(BufferedOutput())
+  parser = Parser(game)
+  parser.parse_command("take pople")
+  assert "pole" in game.inventory
+
+
+def test_location_items_win_special_commands_shared_with_the_inventory():
+  world = build_world()
+  world.index()
+  items = {item.name: item for item in world.items}
+  items["pole"].add_action("wave", describe_something, ("You wave the pole."))
+  items["rosebush"].add_action("wave", describe_something, ("The rosebush waves back."))
+  game = world.new_game(BufferedOutput())
+  parser = Parser(game)
+  parser.parse_command("take pole")
+  parser.parse_command("go out")
+  game.output.clear()
+  parser.parse_command("wave")
+  assert game.output.getvalue() == "The rosebush waves back.\n"
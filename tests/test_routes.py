@@ -0,0 +1,51 @@
+import pytest
+
+from action_castle import BufferedOutput, Parser, build_game, build_world
+from helpers import transcript
+import worldfile
+
+
+@pytest.fixture(scope="module")
+def compiled_path(tmp_path_factory):
+  path = str(tmp_path_factory.mktemp("worlds") / "castle.world")
+  worldfile.compile_world(build_world(), path)
+  return path
+
+
+def compiled_game(path):
+  def factory(output=None):
+    return worldfile.load_world(path).new_game(output)
+  return factory
+
+
+@pytest.mark.parametrize("name", ["Cottage", "Garden Path", "Fishing Pond",
+                                  "Winding Path", "Top of the Tall Tree",
+                                  "Drawbridge"])
+def test_going_to_a_location_before_the_troll(name):
+  game = build_game(BufferedOutput())
+  Parser(game).parse_command("go to " + name.lower())
+  assert game.curr_location.name == name
+
+
+def test_going_to_a_location_stops_at_a_block():
+  game = build_game(BufferedOutput())
+  Parser(game).parse_command("go to courtyard")
+  assert game.curr_location.name == "Drawbridge"
+  assert "troll" in game.output.getvalue()
+
+
+def test_going_to_every_location_of_a_compiled_world(compiled_path):
+  world = build_world()
+  world.index()
+  for location in world.locations:
+    commands = ["take pole", "go out", "go to " + location.name.lower()]
+    assert (transcript(compiled_game(compiled_path), commands) ==
+            transcript(build_game, commands))
+
+
+def test_going_somewhere_only_loads_the_way_there(compiled_path):
+  world = worldfile.open_world(compiled_path)
+  game = world.new_game(BufferedOutput())
+  Parser(game).parse_command("go to fishing pond")
+  assert game.curr_location.name == "Fishing Pond"
+  assert len(world.loaded_locations) < len(world.locations)
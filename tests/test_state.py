@@ -0,0 +1,26 @@
+from action_castle import BufferedOutput, Parser, build_game
+from bitset import build_game as build_bitset_game
+from helpers import canonical_state
+
+
+def test_restoring_a_snapshot_from_before_winning():
+  game = build_game(BufferedOutput())
+  snapshot = game.snapshot()
+  game.has_won = True
+  game.restore(snapshot)
+  assert not game.has_won
+  assert not game.fork().has_won
+
+
+def test_snapshots_restore_into_any_kind_of_game():
+  game = build_game(BufferedOutput())
+  parser = Parser(game)
+  for command in ["take pole", "go out", "go south", "catch fish with pole",
+                  "go north", "pick rose"]:
+    parser.parse_command(command)
+  game.has_won = True
+  for factory in [build_game, build_bitset_game]:
+    restored = factory(BufferedOutput())
+    restored.restore(game.snapshot())
+    assert canonical_state(restored) == canonical_state(game)
+    assert restored.has_won
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from action_castle import build_game, build_world
+from helpers import random_commands, transcript
+import worldfile
+
+
+@pytest.fixture(scope="module")
+def world_files(tmp_path_factory):
+  directory = tmp_path_factory.mktemp("worlds")
+  json_path = str(directory / "castle.json")
+  compiled_path = str(directory / "castle.world")
+  worldfile.save_json(build_world(), json_path)
+  worldfile.compile_world(worldfile.load_json(json_path), compiled_path)
+  return json_path, compiled_path
+
+
+def factory_for(path):
+  def factory(output=None):
+    return worldfile.load_world(path).new_game(output)
+  return factory
+
+
+def read_playthrough():
+  path = os.path.join(os.path.dirname(__file__), "..", "playthrough.txt")
+  with open(path) as f:
+    return [line.strip() for line in f if line.strip()]
+
+
+def test_world_files_play_the_playthrough_like_the_python_world(world_files):
+  commands = read_playthrough()
+  expected = transcript(build_game, commands)
+  for path in world_files:
+    assert transcript(factory_for(path), commands) == expected
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_world_files_play_like_the_python_world(world_files, seed):
+  json_path, compiled_path = world_files
+  commands = random_commands(build_game, 1000, seed)
+  expected = transcript(build_game, commands)
+  assert transcript(factory_for(json_path), commands) == expected
+  assert transcript(factory_for(compiled_path), commands) == expected
+
+
+def test_locations_of_a_compiled_world_are_a_sequence(world_files):
+  json_path, compiled_path = world_files
+  world = worldfile.open_world(compiled_path)
+  locations = list(world.locations)
+  assert len(locations) == len(world.locations)
+  assert world.locations[-1] is locations[-1]
+  assert world.locations[1:3] == locations[1:3]
+  with pytest.raises(IndexError):
+    world.locations[len(locations)]
+  with pytest.raises(IndexError):
+    world.locations[-len(locations) - 1]
+
+
+def test_compiled_worlds_have_every_attribute_of_a_world(world_files):
+  json_path, compiled_path = world_files
+  world = worldfile.open_world(compiled_path)
+  assert set(vars(build_world())) <= set(vars(world))
+  assert world.start_at.name == "Cottage"
+  assert [location.name for location in world.dangerous_locations] == [
+      "Drawbridge", "Courtyard", "Dungeon"]
@@ -0,0 +1,16 @@
+import pytest
+
+import worldgen
+
+
+@pytest.mark.parametrize("size", [2, 3, 5, 9, 17, 45, 51, 97, 333, 1000])
+@pytest.mark.parametrize("seed", [0, 13, 27, 38])
+def test_generated_worlds_are_connected_and_winnable(size, seed):
+  world, commands = worldgen.generate(size, seed)
+  assert worldgen.reachable(world) == size
+  assert worldgen.check(world, commands)
+
+
+def test_worlds_need_two_locations():
+  with pytest.raises(ValueError):
+    worldgen.generate(1)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Visualize your game
+# The code below allows you to create a directed graph that shows the locations in your game and how they are connected.  You can also save a PDF of your graph to your Google Drive with the `save_to_drive` method.  The output file will be called `game-visualization.pdf`.
+#
+# Graphviz is only imported when a graph is actually built, so importing the game engine never pays for it.  From the command line, `python -m visualize` renders the Action Castle map to `game-visualization.pdf`.
+
+import queue
+
+from action_castle import build_game
+
+
+def DFS(game, graph):
+  """Do a depth-first-search traversal of the locations in the game
+     starting at the start location, and create a GraphViz graph
+     to vizualize the connections between the locations, and the items
+     that are located at each location."""
+  start_location = game.curr_location
+  frontier = queue.Queue()
+  frontier.put(start_location)
+  visited = {}
+  visited[start_location.name] = True
+
+  while not frontier.empty():
+    current_location = frontier.get()
+    name = current_location.name
+    description = current_location.description
+    items_html = describe_items(current_location, game=game)
+    html = "<<b>%s</b><br />%s<br />%s>" % (name, description, items_html)
+    # Create a new node in the graph for this location
+    graph.node(name, label=html)
+
+    for direction, next_location in current_location.connections.items():
+      if game.is_open(current_location, direction):
+        # Create an edge between the current location and its successor
+        graph.edge(name, next_location.name, label=direction.capitalize())
+      else:
+        # Create a dotted edge for connected locations that are blocked
+        block_description = "%s\n%s" % (direction.capitalize(), current_location.get_block_description(direction))
+        graph.edge(name, next_location.name, label=block_description, style="dotted")
+      if not next_location.name in visited:
+        visited[next_location.name] = True
+        frontier.put(next_location)
+
+def describe_items(location, print_commands=True, game=None):
+    """Describe what objects are in the current location.  If a game is
+       given, describe the items that are there in that game, using the
+       game's cache of rendered text."""
+    if game:
+      return game.rendered(location, render_items, print_commands)
+    return render_items(None, location, print_commands)
+
+def render_items(game, location, print_commands=True):
+    items = game.items_at(location) if game else location.items
+    items_html = ""
+    if len(items.keys()) > 0:
+      items_html = "You see: "
+    for item_name in items:
+      item = items[item_name]
+      items_html += item.description
+      if print_commands:
+        special_commands = item.get_commands()
+        for cmd in special_commands:
+          items_html += "<br/><i>%s</i>" % cmd
+    return items_html
+
+def visualize(game=None):
+  """Returns a GraphViz graph of the game's map.  Defaults to a fresh game
+     of Action Castle."""
+  # get_ipython().system('pip install graphviz')
+  from graphviz import Digraph
+  graph = Digraph(node_attr={'color': 'lightblue2', 'style': 'filled'})
+  DFS(game or build_game(), graph)
+  return graph
+
+def save_to_drive(graph):
+  from google.colab import drive
+  drive.mount('/content/drive/')
+  graph.render('/content/drive/My Drive/game-visualization', view=True)
+
+
+if __name__ == "__main__":
+  visualize().render('game-visualization')
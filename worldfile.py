@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # World files
+# Worlds can be written as data instead of Python code.  A world file is JSON that lists the locations (with their connections, blocks and the items in them) and the items (with their actions and preconditions).  Items and locations are referred to by name, as `{"item": "lamp"}` or `{"location": "Tower"}`, and actions refer to one of the registered action functions, like `give_to` or `light_item`, by name.  For example:
+#
+#     {"start": "Cottage",
+#      "inventory": ["lamp"],
+#      "locations": [{"name": "Cottage", "description": "You are standing in a small cottage.",
+#                     "connections": {"out": "Garden Path"},
+#                     "items": ["pole"]}, ...],
+#      "items": [{"name": "lamp", "description": "a lamp", "flags": {"lit": false},
+#                 "actions": [{"command": "light lamp", "function": "light_item",
+#                              "arguments": [{"item": "lamp"}, "Lighting up the lamp", "The lamp is already lit"],
+#                              "preconditions": {"inventory_contains": {"item": "lamp"}}}]},
+#                ...]}
+#
+# A world file can be compiled into an indexed binary file.  Opening a compiled world only reads its header; each location is read from the memory-mapped file and turned into a `Location` the first time something needs it (usually when the player first reaches it), so even the biggest worlds start in constant time and only use memory for the parts that have been visited.
+#
+# Usage:
+#
+#     python -m worldfile export action_castle:build_world castle.json
+#     python -m worldfile compile castle.json castle.world
+#     python -m worldfile play castle.world
+
+import argparse
+import collections.abc
+import json
+import mmap
+import struct
+
+from action_castle import (DIRECTIONS, PARSER_WORDS, BreadthFirstRoutes, Item,
+                           Location, Parser, TypoIndex, World,
+                           add_item_to_inventory,
+                           describe_something, destroy_item, end_game,
+                           game_loop, give_to, kiss, light_candle, light_item,
+                           marry, unlock_item, wear_item, win_game)
+from replay import load_factory
+
+# The action functions that world files can refer to, by name.
+ACTION_FUNCTIONS = {}
+
+def register_action(function):
+  """Lets world files use a new action function.  Can be used as a 
+     decorator."""
+  ACTION_FUNCTIONS[function.__name__] = function
+  return function
+
+for function in (add_item_to_inventory, describe_something, destroy_item,
+                 end_game, win_game, marry, give_to, light_candle, light_item,
+                 wear_item, unlock_item, kiss):
+  register_action(function)
+
+
+# ## Converting between worlds and data
+
+def encode(value, item_ref, location_ref):
+  """Turns an argument or precondition value into JSON data, replacing 
+     items and locations with references made by item_ref and 
+     location_ref."""
+  if isinstance(value, Item):
+    return {"item": item_ref(value)}
+  if isinstance(value, Location):
+    return {"location": location_ref(value)}
+  if isinstance(value, (list, tuple)):
+    return [encode(each, item_ref, location_ref) for each in value]
+  if value is None or isinstance(value, (str, int, float, bool)):
+    return value
+  raise ValueError("Can't save %r in a world file" % (value,))
+
+
+def decode(value, item, location):
+  """The opposite of encode: item and location look up references."""
+  if isinstance(value, dict):
+    if "item" in value:
+      return item(value["item"])
+    return location(value["location"])
+  if isinstance(value, list):
+    return [decode(each, item, location) for each in value]
+  return value
+
+
+def decode_arguments(arguments, item, location):
+  """Action arguments are usually a tuple, which JSON saves as a list."""
+  arguments = decode(arguments, item, location)
+  if isinstance(arguments, list):
+    return tuple(arguments)
+  return arguments
+
+
+def world_to_data(world, item_ref=None, location_ref=None):
+  """Returns the JSON data for a world.  By default items and locations are
+     referred to by name."""
+  world.index()
+  item_ref = item_ref or (lambda item: item.name)
+  location_ref = location_ref or (lambda location: location.name)
+  def values(value):
+    return encode(value, item_ref, location_ref)
+  def preconditions_data(preconditions):
+    return {check: values(value) for check, value
+            in preconditions.preconditions.items()}
+
+  locations = []
+  for location in world.locations:
+    data = {"name": location.name, "description": location.description}
+    if location.end_game:
+      data["end_game"] = True
+    data["connections"] = {direction: location_ref(connected)
+                           for direction, connected in location.connections.items()}
+    if location.travel:
+      data["travel_descriptions"] = dict(location.travel)
+    if location.items:
+      data["items"] = [item_ref(item) for item in location.items.values()]
+    if location.blocks:
+      data["blocks"] = {
+          direction: {"description": description,
+                      "preconditions": preconditions_data(preconditions)}
+          for direction, (description, preconditions) in location.blocks.items()}
+    locations.append(data)
+
+  items = []
+  for item in world.items:
+    data = {"name": item.name, "description": item.description}
+    if item.examine_text:
+      data["examine_text"] = item.examine_text
+    if item.custom_take_text:
+      data["take_text"] = item.custom_take_text
+    if not item.gettable:
+      data["gettable"] = False
+    if item.end_game:
+      data["end_game"] = True
+    if item.flags:
+      data["flags"] = dict(item.flags)
+    actions = []
+    for command, (function, arguments, preconditions, fail_text) in item.commands.items():
+      action = {"command": command, "function": function.__name__,
+                "arguments": values(arguments)}
+      if preconditions.preconditions:
+        action["preconditions"] = preconditions_data(preconditions)
+      if fail_text:
+        action["fail_text"] = fail_text
+      actions.append(action)
+    if actions:
+      data["actions"] = actions
+    items.append(data)
+
+  return {"start": location_ref(world.start_at),
+          "inventory": [item_ref(item) for item in world.inventory.values()],
+          "dangerous_locations": [location_ref(location)
+                                  for location in world.dangerous_locations],
+          "locations": locations,
+          "items": items}
+
+
+def make_location(data, location_class=Location):
+  """Makes a Location from its data, apart from its connections, items and
+     blocks."""
+  return location_class(data["name"], data["description"],
+                        end_game=data.get("end_game", False))
+
+
+def fill_location(new_location, data, location, item):
+  """Adds the travel descriptions, items and blocks of a location from its
+     data."""
+  new_location.travel_descriptions = data.get("travel_descriptions", {})
+  for ref in data.get("items", []):
+    placed = item(ref)
+    new_location.add_item(placed.name, placed)
+  for direction, block in data.get("blocks", {}).items():
+    preconditions = {check: decode(value, item, location)
+                     for check, value in block["preconditions"].items()}
+    new_location.add_block(direction, block["description"], preconditions)
+
+
+def make_item(data):
+  """Makes an Item from its data, apart from its actions."""
+  new_item = Item(data["name"], data["description"], data.get("examine_text", ""),
+                  data.get("take_text", ""), gettable=data.get("gettable", True),
+                  end_game=data.get("end_game", False))
+  for flag, value in data.get("flags", {}).items():
+    new_item.set_flag(flag, value)
+  return new_item
+
+
+def fill_item(new_item, data, location, item):
+  """Adds the actions of an item from its data."""
+  for action in data.get("actions", []):
+    preconditions = {check: decode(value, item, location)
+                     for check, value in action.get("preconditions", {}).items()}
+    new_item.add_action(action["command"], ACTION_FUNCTIONS[action["function"]],
+                        decode_arguments(action["arguments"], item, location),
+                        preconditions=preconditions,
+                        fail_text=action.get("fail_text", ""))
+
+
+def data_to_world(data):
+  """Builds a World from JSON data, all at once."""
+  locations = {}
+  items = {}
+  for item_data in data["items"]:
+    items[item_data["name"]] = make_item(item_data)
+  for location_data in data["locations"]:
+    locations[location_data["name"]] = make_location(location_data)
+  for item_data in data["items"]:
+    fill_item(items[item_data["name"]], item_data, locations.get, items.get)
+  for location_data in data["locations"]:
+    location = locations[location_data["name"]]
+    location.connections = {direction: locations[name] for direction, name
+                            in location_data["connections"].items()}
+    fill_location(location, location_data, locations.get, items.get)
+  world = World(locations[data["start"]])
+  for name in data.get("inventory", []):
+    world.add_to_inventory(items[name])
+  world.dangerous_locations = [locations[name] for name in
+                               data.get("dangerous_locations", [])]
+  return world
+
+
+def save_json(world, path):
+  with open(path, "w") as f:
+    json.dump(world_to_data(world), f, indent=1)
+
+
+def load_json(path):
+  with open(path) as f:
+    return data_to_world(json.load(f))
+
+
+# ## Compiled worlds
+# A compiled world file starts with a fixed-size header, followed by the records of every location and item (each one the JSON data from above with items and locations referred to by number instead of name), a table of where each record starts, a little JSON with the start and the starting inventory, and finally a JSON list of the names of all the locations (which is only read if a location is looked up by name).
+
+MAGIC = b"ACWORLD1"
+# magic, number of locations, number of items, offsets of the location 
+# table, item table, metadata and location names, and the length of the 
+# location names
+HEADER = struct.Struct("<8sIIQQQQQ")
+OFFSET = struct.Struct("<Q")
+
+
+def compile_world(world, path):
+  """Writes a world to a compiled world file."""
+  world.index()
+  def item_ref(item):
+    return world.item_ids[item]
+  def location_ref(location):
+    return world.location_ids[location]
+  data = world_to_data(world, item_ref, location_ref)
+  with open(path, "wb") as f:
+    f.seek(HEADER.size)
+    tables = []
+    for records in (data["locations"], data["items"]):
+      offsets = []
+      for record in records:
+        offsets.append(f.tell())
+        f.write(json.dumps(record, separators=(",", ":")).encode("utf-8"))
+      offsets.append(f.tell())
+      tables.append(f.tell())
+      for offset in offsets:
+        f.write(OFFSET.pack(offset))
+    metadata_offset = f.tell()
+    f.write(json.dumps({
+        "start": data["start"], "inventory": data["inventory"],
+        "dangerous_locations": data["dangerous_locations"]},
+        separators=(",", ":")).encode("utf-8"))
+    names_offset = f.tell()
+    f.write(json.dumps([location["name"] for location in data["locations"]],
+                       separators=(",", ":")).encode("utf-8"))
+    names_end = f.tell()
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, len(data["locations"]), len(data["items"]),
+                        tables[0], tables[1], metadata_offset, names_offset,
+                        names_end - names_offset))
+
+
+class LazyLocation(Location):
+  """A location in a compiled world.  Its exits hold the ids of the 
+     locations they lead to, and those locations are only loaded when 
+     they're looked up."""
+  __slots__ = ("world",)
+
+  def exit_at(self, position):
+    return self.world.location(self.exit_locations[position])
+
+
+class LazySequence(collections.abc.Sequence):
+  """Stands in for the list of every location or item in a compiled world,
+     loading them as they are looked up by id."""
+  def __init__(self, load, length):
+    self.load = load
+    self.length = length
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self.load(j) for j in range(*i.indices(self.length))]
+    if i < 0:
+      i += self.length
+    if not 0 <= i < self.length:
+      raise IndexError(i)
+    return self.load(i)
+
+  def __len__(self):
+    return self.length
+
+
+class LazyWorld(World):
+  """A world that is loaded from a compiled world file bit by bit, as the
+     player explores it."""
+  def __init__(self, path):
+    with open(path, "rb") as f:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, location_count, item_count, self.location_table, self.item_table,
+     self.metadata_offset, self.names_offset, self.names_length
+     ) = HEADER.unpack_from(self.data)
+    if magic != MAGIC:
+      raise ValueError("%s is not a compiled world file" % path)
+    # Dictionaries mapping from the locations and items loaded so far to 
+    # their ids, and back.
+    self.location_ids = {}
+    self.item_ids = {}
+    self.loaded_locations = {}
+    self.loaded_items = {}
+    self.metadata = json.loads(self.data[self.metadata_offset:self.names_offset])
+    super().__init__(None)
+    self.start_at = self.location(self.metadata["start"])
+    # Ids are the positions of the records in the file.
+    self.locations = LazySequence(self.location, location_count)
+    self.items = LazySequence(self.item, item_count)
+    dangerous = self.metadata["dangerous_locations"]
+    self.dangerous_locations = LazySequence(
+        lambda i: self.location(dangerous[i]), len(dangerous))
+    # location_names maps from lowercased location names to ids, and is 
+    # read when first needed.
+    for i in self.metadata["inventory"]:
+      self.add_to_inventory(self.item(i))
+
+  def location_id(self, name):
+    """Returns the id of the location with this name (in any case), or
+       None."""
+    if self.location_names is None:
+      start = self.names_offset
+      names = json.loads(self.data[start:start + self.names_length])
+      self.location_names = {name.lower(): i for i, name in enumerate(names)}
+    return self.location_names.get(name.lower())
+
+  def location_named(self, name):
+    i = self.location_id(name)
+    return None if i is None else self.location(i)
+
+  def index(self):
+    """Every location and item in a compiled world already has an id."""
+    pass
+
+  def route_index(self):
+    """Routes in a compiled world are found without landmarks, which would
+       load every location."""
+    if self.landmarks is None:
+      self.landmarks = BreadthFirstRoutes(self)
+    return self.landmarks
+
+  def typo_index(self):
+    """Returns the TypoIndex of the words of the items loaded so far.  The
+       words of other items are added as they are loaded."""
+    if self.typos is None:
+      self.typos = TypoIndex(PARSER_WORDS + DIRECTIONS)
+      for item in list(self.loaded_items.values()):
+        self.typos.add_item(item)
+    return self.typos
+
+  def record(self, table, i):
+    start, end = struct.unpack_from("<QQ", self.data, table + OFFSET.size * i)
+    return json.loads(self.data[start:end])
+
+  def location(self, i):
+    """Returns the location with id i, loading it if necessary."""
+    location = self.loaded_locations.get(i)
+    if location is None:
+      data = self.record(self.location_table, i)
+      location = make_location(data, LazyLocation)
+      location.world = self
+      self.loaded_locations[i] = location
+      self.location_ids[location] = i
+      location.connections = data["connections"]
+      fill_location(location, data, self.location, self.item)
+    return location
+
+  def item(self, i):
+    """Returns the item with id i, loading it if necessary."""
+    item = self.loaded_items.get(i)
+    if item is None:
+      data = self.record(self.item_table, i)
+      item = make_item(data)
+      self.loaded_items[i] = item
+      self.item_ids[item] = i
+      fill_item(item, data, self.location, self.item)
+      if self.typos is not None:
+        self.typos.add_item(item)
+    return item
+
+
+def open_world(path):
+  """Opens a compiled world file."""
+  return LazyWorld(path)
+
+
+def load_world(path):
+  """Loads a world from a JSON world file or a compiled world file."""
+  with open(path, "rb") as f:
+    compiled = f.read(len(MAGIC)) == MAGIC
+  return open_world(path) if compiled else load_json(path)
+
+
+def main(argv=None):
+  arguments = argparse.ArgumentParser(description="Convert and play world files.")
+  commands = arguments.add_subparsers(dest="command", required=True)
+  export = commands.add_parser("export", help="save a world built in Python as JSON")
+  export.add_argument("builder", help="module:function that returns a World")
+  export.add_argument("output")
+  compile_command = commands.add_parser("compile", help="compile a world file")
+  compile_command.add_argument("input", help="a JSON world file or module:function")
+  compile_command.add_argument("output")
+  play = commands.add_parser("play", help="play a world file")
+  play.add_argument("input")
+  args = arguments.parse_args(argv)
+
+  if args.command == "export":
+    save_json(load_factory(args.builder)(), args.output)
+  elif args.command == "compile":
+    if ":" in args.input:
+      world = load_factory(args.input)()
+    else:
+      world = load_json(args.input)
+    compile_world(world, args.output)
+  else:
+    game_loop(load_world(args.input).new_game())
+    print('THE GAME HAS ENDED.')
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Generating large worlds
+# The generator builds worlds of any size out of the same `Location` and `Item` building blocks as `build_world`, for testing how the engine behaves at scale.  Given the same size and seed it always builds the same world.
+#
+# A generated world is a long corridor of rooms running east, with branches of side rooms leading off it to the north, south, up and down.  Every few rooms the way east is blocked by one of three kinds of obstacle:
+# * a locked gate, which is unlocked with a key,
+# * a guardian, who leaves when given a token,
+# * darkness, which can only be crossed with a lit torch.
+#
+# The key, token or torch for each obstacle is hidden at the end of one of the branches before it.  Rooms are also furnished with scenery that has a few special commands of its own.  At the far end of the corridor there is a throne, and sitting on it wins the game, but only with a chain of preconditions met: the player must be holding the last thing they found, and the latest gate and torch must be unlocked and lit.
+#
+# The generator also returns the winning sequence of commands, so that solvers and replay tools can be checked on large worlds.
+#
+# Usage: `python -m worldgen SIZE [--seed SEED] [--check]`
+
+import argparse
+import gc
+import random
+import time
+
+from action_castle import (Item, Location, NullOutput, Parser, World,
+                           describe_something, destroy_item, light_item,
+                           unlock_item, win_game)
+
+# Directions that branches of side rooms can lead off the corridor, and the
+# way back.
+BRANCH_DIRECTIONS = [("north", "south"), ("south", "north"),
+                     ("up", "down"), ("down", "up")]
+
+# Scenery and the things you can do to it.  None of these words contain a
+# direction or one of the parser's keywords (like "take").
+SCENERY = ["statue", "fountain", "painting", "barrel", "crate", "banner",
+           "tapestry", "anvil", "mirror", "bookcase"]
+VERBS = ["admire", "polish", "knock on", "sniff", "study", "tap", "climb"]
+
+# How many corridor rooms there are between obstacles
+OBSTACLE_SPACING = 8
+
+
+def generate(size, seed=0, scenery=0.3, actions=3):
+  """Generates a world with size locations.  scenery is the fraction of
+     rooms that have a piece of scenery in them, and actions is the number
+     of special commands each piece of scenery has.  Returns the World and
+     a list of commands that wins the game."""
+  if size < 2:
+    raise ValueError("a world needs at least 2 locations, not %d" % size)
+  random_numbers = random.Random(seed)
+  width = len(str(size))
+  # Garbage collection passes slow down building a very large number of
+  # objects without freeing any, so they are paused until we're done.
+  collecting = gc.isenabled()
+  gc.disable()
+  try:
+    return build(size, width, random_numbers, scenery, actions)
+  finally:
+    if collecting:
+      gc.enable()
+
+
+def build(size, width, random_numbers, scenery, actions):
+  # A quarter of the rooms make up the corridor, and the rest are split
+  # into branches.
+  corridor_length = max(2, size // 4)
+  branch_rooms = size - corridor_length
+  branch_length = 3
+
+  def number(i):
+    return str(i).zfill(width)
+
+  corridor = []
+  # For each corridor room, a list of its branches.  Each branch is a list
+  # of (direction, direction back, room) tuples, from the corridor outwards.
+  branches = []
+  room_number = 0
+  for i in range(corridor_length):
+    room = Location("Room %s" % number(room_number),
+                    "You are in a long corridor of rooms (room %s)." % number(room_number))
+    room_number += 1
+    if corridor:
+      corridor[-1].add_connection("east", room)
+    corridor.append(room)
+    branches.append([])
+
+  # Hang branches off the corridor rooms, round robin, until the rooms run
+  # out.  Each round gives every corridor room a branch in the next
+  # direction, so no two branches of a room lead the same way.
+  for (direction, back) in BRANCH_DIRECTIONS:
+    for i in range(corridor_length):
+      if branch_rooms <= 0:
+        break
+      branch = []
+      previous = corridor[i]
+      for _ in range(min(branch_length, branch_rooms)):
+        room = Location("Room %s" % number(room_number),
+                        "You are in a quiet side room (room %s)." % number(room_number))
+        room_number += 1
+        previous.add_connection(direction, room)
+        branch.append((direction, back, room))
+        previous = room
+        branch_rooms -= 1
+      branches[i].append(branch)
+  if branch_rooms > 0:
+    raise ValueError("%d rooms don't fit in the branches" % branch_rooms)
+
+  # Furnish the rooms with scenery.
+  scenery_number = 0
+  for room in corridor + [room for room_branches in branches
+                          for branch in room_branches
+                          for (direction, back, room) in branch]:
+    if random_numbers.random() < scenery:
+      kind = random_numbers.choice(SCENERY)
+      name = "%s %s" % (kind, number(scenery_number))
+      scenery_number += 1
+      thing = Item(name, "a %s" % kind, "IT IS AN ORDINARY %s." % kind.upper(),
+                   start_at=room, gettable=False)
+      for verb in random_numbers.sample(VERBS, actions):
+        thing.add_action("%s %s" % (verb, name), describe_something,
+                         ("You %s the %s. Nothing happens." % (verb, kind)))
+
+  # Place the obstacles, and hide what is needed to get past each one in a
+  # branch between it and the one before.
+  commands = []
+  # (kind, item found, item in the way) for each obstacle
+  obstacles = []
+  # For each corridor room, the (branch, item) pairs hidden in its branches
+  hidden = {}
+  obstacle_rooms = {}
+  previous_obstacle = 0
+  for obstacle, at in enumerate(range(OBSTACLE_SPACING - 1, corridor_length - 1,
+                                      OBSTACLE_SPACING)):
+    candidates = [r for r in range(previous_obstacle, at + 1) if branches[r]]
+    previous_obstacle = at + 1
+    if not candidates:
+      continue
+    hiding_room = random_numbers.choice(candidates)
+    branch = random_numbers.choice(branches[hiding_room])
+    hideout = branch[-1][2]
+    room = corridor[at]
+    name = number(obstacle)
+    kind = obstacle % 3
+    if kind == 0:
+      key = Item("key %s" % name, "a brass key", start_at=hideout)
+      gate = Item("gate %s" % name, "a locked gate", "THE GATE IS LOCKED.",
+                  start_at=room, gettable=False)
+      gate.is_unlocked = False
+      gate.add_action("unlock gate %s" % name, unlock_item,
+                      (gate, "The gate is now unlocked.", "The gate is already unlocked."),
+                      preconditions={"inventory_contains": key},
+                      fail_text="You need the right key.")
+      room.add_block("east", "The gate is locked.", preconditions={"is_unlocked": gate})
+      obstacles.append(("gate", key, gate))
+      solution = ["unlock gate %s" % name]
+    elif kind == 1:
+      token = Item("token %s" % name, "a silver token", start_at=hideout)
+      guardian = Item("guardian %s" % name, "a stern guardian",
+                      "THE GUARDIAN WANTS A TOKEN.", start_at=room, gettable=False)
+      guardian.add_action("offer token %s to guardian %s" % (name, name), destroy_item,
+                          (guardian, "The guardian accepts the token and leaves."),
+                          preconditions={"inventory_contains": token},
+                          fail_text="The guardian ignores you.")
+      room.add_block("east", "The guardian will not let you pass.",
+                     preconditions={"is_gone": guardian})
+      obstacles.append(("guardian", token, guardian))
+      solution = ["offer token %s to guardian %s" % (name, name)]
+    else:
+      torch = Item("torch %s" % name, "an unlit torch", start_at=hideout)
+      torch.lit = False
+      torch.add_action("light torch %s" % name, light_item,
+                       (torch, "The torch flares into life.", "The torch is already lit."),
+                       preconditions={"inventory_contains": torch})
+      room.add_block("east", "It is too dark to go on.", preconditions={"is_lit": torch})
+      obstacles.append(("torch", torch, torch))
+      solution = ["light torch %s" % name]
+    hidden.setdefault(hiding_room, []).append((branch, obstacles[-1][1]))
+    obstacle_rooms[at] = solution
+
+  # The throne at the end of the corridor.  Sitting on it needs a chain of
+  # preconditions on the last few obstacles.
+  throne = Item("throne", "a golden throne", start_at=corridor[-1], gettable=False)
+  chain = {"in_location": corridor[-1]}
+  for (kind, found_item, obstacle_item) in obstacles[-3:]:
+    if kind == "gate":
+      chain["is_unlocked"] = obstacle_item
+    elif kind == "torch":
+      chain["is_lit"] = found_item
+    chain["inventory_contains"] = found_item
+  throne.add_action("sit on throne", win_game, ("You have become the ruler of this land!"),
+                    preconditions=chain, fail_text="You are not yet worthy.")
+
+  # Walk the corridor to write down the winning commands.
+  for i in range(corridor_length):
+    for branch, item in hidden.get(i, []):
+      for (direction, back, room) in branch:
+        commands.append("go %s" % direction)
+      commands.append("take %s" % item.name)
+      for (direction, back, room) in reversed(branch):
+        commands.append("go %s" % back)
+    if i in obstacle_rooms:
+      commands.extend(obstacle_rooms[i])
+    if i < corridor_length - 1:
+      commands.append("go east")
+  commands.append("sit on throne")
+
+  world = World(corridor[0])
+  return world, commands
+
+
+def reachable(world):
+  """Returns the number of locations that can be reached from the start,
+     ignoring blocks."""
+  seen = {world.start_at}
+  frontier = [world.start_at]
+  while frontier:
+    location = frontier.pop()
+    for next_location in location.connections.values():
+      if next_location not in seen:
+        seen.add(next_location)
+        frontier.append(next_location)
+  return len(seen)
+
+
+def check(world, commands):
+  """Plays the commands in a new game of the world.  Returns True if they
+     win the game."""
+  game = world.new_game(NullOutput())
+  parser = Parser(game)
+  for command in commands:
+    if parser.parse_command(command):
+      return game.has_won
+  return False
+
+
+def main(argv=None):
+  arguments = argparse.ArgumentParser(description="Generate a large world.")
+  arguments.add_argument("size", type=int)
+  arguments.add_argument("--seed", type=int, default=0)
+  arguments.add_argument("--check", action="store_true",
+                         help="play the winning commands to check that they win")
+  args = arguments.parse_args(argv)
+  start = time.perf_counter()
+  world, commands = generate(args.size, args.seed)
+  elapsed = time.perf_counter() - start
+  print("Generated %d locations in %.2f s; the winning path is %d commands." % (
+      args.size, elapsed, len(commands)))
+  if args.check:
+    locations = reachable(world)
+    if locations != args.size:
+      print("Only %d of the locations CAN BE REACHED." % locations)
+    start = time.perf_counter()
+    won = check(world, commands)
+    print("The winning path %s (%.2f s)." % (
+        "wins" if won else "DOES NOT WIN", time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+  main()